@@ -0,0 +1,138 @@
+import argparse
+import itertools
+import os
+import time
+from datetime import timedelta
+from helpers import get_current_time, as_utc
+
+# Loan accrual: once per ACCRUAL_PERIOD a loan is charged interest on its amount
+# until its due date and a penalty on what is left to repay after it. Open loans
+# are streamed in _id order and charged in batches with one bulk write for the
+# loans and one for the users' loan_due. The job checkpoints after every batch
+# and resumes from there after a crash.
+#
+#   python accrual.py --batch-size 1000
+#
+# bot.py runs it every LOAN_ACCRUAL_INTERVAL seconds; run it from one process only.
+
+# Days a loan runs before it is overdue
+LOAN_TERM = timedelta(days=int(os.getenv("LOAN_TERM_DAYS", 7)))
+
+# Interest per period on the loan amount until the due date
+LOAN_PERIOD_INTEREST = float(os.getenv("LOAN_DAILY_INTEREST", 0.01))
+
+# Penalty per overdue period on the amount left to repay
+LOAN_PERIOD_PENALTY = float(os.getenv("LOAN_DAILY_PENALTY", 0.02))
+
+ACCRUAL_PERIOD = timedelta(days=1)
+
+# bot_stats document holding the job's progress
+CHECKPOINT = 'loan_accrual'
+
+def compute_accrual(loan, cutoff):
+    # Charges for the whole periods between the loan's last accrual and cutoff
+    if 'last_accrued' not in loan:
+        # Loans taken before accrual existed start their term now instead of
+        # being charged for the time since they were taken
+        start = as_utc(cutoff)
+        return {'_id': loan['_id'], 'loan_id': loan['loan_id'], 'previous': None, 'last_accrued': start,
+                'due_date': start + LOAN_TERM, 'interest': 0, 'penalty': 0}
+    last_accrued = as_utc(loan['last_accrued'])
+    due_date = as_utc(loan['due_date'])
+    periods = (as_utc(cutoff) - last_accrued) // ACCRUAL_PERIOD
+    if periods <= 0:
+        return None
+    remaining = loan.get('remaining', loan['total_to_repay'])
+    interest = penalty = 0
+    for period in range(1, periods + 1):
+        if last_accrued + period * ACCRUAL_PERIOD <= due_date:
+            charge = loan['amount'] * LOAN_PERIOD_INTEREST
+            interest += charge
+        else:
+            charge = remaining * LOAN_PERIOD_PENALTY
+            penalty += charge
+        remaining += charge
+    return {
+        '_id': loan['_id'],
+        'loan_id': loan['loan_id'],
+        'previous': loan.get('last_accrued'),
+        'last_accrued': last_accrued + periods * ACCRUAL_PERIOD,
+        'interest': interest,
+        'penalty': penalty
+    }
+
+def accrue_batch(loans, cutoff):
+    loan_updates = []
+    user_updates = []
+    for loan in loans:
+        update = compute_accrual(loan, cutoff)
+        if not update:
+            continue
+        loan_updates.append(update)
+        if not update['interest'] and not update['penalty']:
+            continue
+        user_updates.append({
+            'user_id': loan['user_id'],
+            'loan_id': loan['loan_id'],
+            'amount': update['interest'] + update['penalty'],
+            'marker': f"{loan['loan_id']}@{update['last_accrued'].isoformat()}"
+        })
+    return loan_updates, user_updates
+
+def run_loan_accrual(storage, batch_size=1000):
+    checkpoint = storage.get_checkpoint(CHECKPOINT)
+    if checkpoint and not checkpoint.get('finished_at'):
+        # Resume the interrupted run; its last batch may have been half written
+        cutoff = checkpoint['cutoff']
+        after_id = checkpoint['last_id']
+        processed = checkpoint['processed']
+        charged = checkpoint['charged']
+        if checkpoint.get('pending'):
+            storage.apply_loan_accruals([], checkpoint['pending'])
+        print(f"Resuming loan accrual after {processed} loans")
+    else:
+        cutoff = get_current_time()
+        after_id = None
+        processed = charged = 0
+    state = {'cutoff': cutoff, 'last_id': after_id, 'processed': processed, 'charged': charged,
+             'pending': [], 'started_at': get_current_time(), 'finished_at': None}
+    storage.save_checkpoint(CHECKPOINT, state)
+
+    start = time.perf_counter()
+    resumed_from = processed
+    loans = storage.iter_loans_to_accrue(as_utc(cutoff) - ACCRUAL_PERIOD, after_id, batch_size)
+    while True:
+        batch = list(itertools.islice(loans, batch_size))
+        if not batch:
+            break
+        loan_updates, user_updates = accrue_batch(batch, cutoff)
+        # The user updates go into the checkpoint first, so a crash between the
+        # two bulk writes cannot lose them
+        storage.save_checkpoint(CHECKPOINT, dict(state, pending=user_updates))
+        storage.apply_loan_accruals(loan_updates, user_updates)
+        state.update({
+            'last_id': batch[-1]['_id'],
+            'processed': state['processed'] + len(batch),
+            'charged': state['charged'] + len(user_updates)
+        })
+        storage.save_checkpoint(CHECKPOINT, state)
+
+    elapsed = time.perf_counter() - start
+    state['finished_at'] = get_current_time()
+    storage.save_checkpoint(CHECKPOINT, state)
+    count = state['processed'] - resumed_from
+    rate = count / elapsed if elapsed else 0
+    print(f"Loan accrual: {count} loans in {elapsed:.2f}s ({rate:.0f} loans/s), {state['charged']} charged")
+    return {'processed': count, 'charged': state['charged'], 'elapsed': elapsed, 'loans_per_second': rate}
+
+def main():
+    parser = argparse.ArgumentParser(description="Charge interest and overdue penalties on open loans")
+    parser.add_argument('--batch-size', type=int, default=1000, help="loans per bulk write")
+    args = parser.parse_args()
+
+    from storage import MongoStorage
+    storage = MongoStorage(f"mongodb+srv://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_CLUSTER')}/")
+    run_loan_accrual(storage, args.batch_size)
+
+if __name__ == "__main__":
+    main()
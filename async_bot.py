@@ -0,0 +1,157 @@
+from telebot.async_telebot import AsyncTeleBot
+import asyncio
+import threading
+import time
+import os
+from conversations import AsyncMongoConversationStore
+from outbox import AsyncOutboundScheduler
+from storage import MongoStorage
+from async_storage import AsyncMongoStorage
+from cache import UserCache
+from gifts import GiftWindow
+from accrual import run_loan_accrual
+from journal import OPENING_CHECKPOINT, is_running, take_snapshots
+from snowflake import NodeLease, configured_node_id
+from helpers import id_generator
+from flows import BankApp, register_handlers
+
+# Asyncio runtime: the flows of flows.py, as in bot.py, awaited on AsyncTeleBot
+# and the Motor driver. Run with `python async_bot.py`.
+
+# Bot token
+TOKEN = os.getenv("TOKEN")
+
+# MongoDB connection
+MONGODB_USER = os.getenv("DB_USER")
+MONGODB_PASSWORD = os.getenv("DB_PASS")
+MONGODB_CLUSTER = os.getenv("DB_CLUSTER")
+MONGODB_URI = f"mongodb+srv://{MONGODB_USER}:{MONGODB_PASSWORD}@{MONGODB_CLUSTER}/"
+
+# Flows and startup await the Motor backed storage. The node id lease and the
+# background jobs run in their own threads on the blocking MongoStorage, with
+# the same code as bot.py.
+storage = AsyncMongoStorage(MONGODB_URI)
+sync_storage = MongoStorage(MONGODB_URI)
+
+bot = AsyncTeleBot(TOKEN)
+
+# User document cache: maximum entries and seconds before an entry expires
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 60))
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# Outgoing message limits: messages per second for the whole bot and per chat,
+# and the number of sends in flight
+SEND_RATE_GLOBAL = float(os.getenv("SEND_RATE_GLOBAL", 30))
+SEND_RATE_PER_CHAT = float(os.getenv("SEND_RATE_PER_CHAT", 1))
+SEND_BURST_PER_CHAT = int(os.getenv("SEND_BURST_PER_CHAT", 3))
+SENDER_THREADS = int(os.getenv("SENDER_THREADS", 4))
+
+outbox = AsyncOutboundScheduler(
+    bot.send_message, global_rate=SEND_RATE_GLOBAL, chat_rate=SEND_RATE_PER_CHAT,
+    chat_burst=SEND_BURST_PER_CHAT, num_senders=SENDER_THREADS
+)
+
+# Seconds between full recomputations of the total user balance counter
+TOTAL_BALANCE_RECONCILE_INTERVAL = 600
+
+# Seconds between loan accrual runs (interest and overdue penalties); 0 turns
+# the job off, keep it on in one bot process only
+LOAN_ACCRUAL_INTERVAL = int(os.getenv("LOAN_ACCRUAL_INTERVAL", 3600))
+
+# Seconds between journal balance snapshots; 0 turns them off, keep them on in
+# one bot process only
+JOURNAL_SNAPSHOT_INTERVAL = int(os.getenv("JOURNAL_SNAPSHOT_INTERVAL", 3600))
+
+# Seconds of daily gift claims booked together: one total balance and metrics
+# write per window instead of one per claim
+GIFT_CLAIM_WINDOW = int(os.getenv("GIFT_CLAIM_WINDOW", 60))
+
+# Seconds an unanswered step of the transfer or slots flow stays valid
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", 600))
+
+# Shared with bot.py, so either runtime can continue a flow
+conversations = AsyncMongoConversationStore(storage.db['conversations'], CONVERSATION_TTL)
+
+# Daily gift claims of the current window
+gift_window = GiftWindow(sync_storage, GIFT_CLAIM_WINDOW)
+
+def run_gift_window_flush(interval=GIFT_CLAIM_WINDOW):
+    while True:
+        time.sleep(interval)
+        try:
+            gift_window.flush()
+        except Exception as e:
+            print(f"Gift window flush error: {e}")
+
+def run_total_balance_reconciliation(interval=TOTAL_BALANCE_RECONCILE_INTERVAL):
+    while True:
+        time.sleep(interval)
+        try:
+            # Gift windows still pending in some process are left out
+            sync_storage.reconcile_total_user_balance(gift_window.pending_since())
+        except Exception as e:
+            print(f"Total balance reconciliation error: {e}")
+
+def run_loan_accrual_schedule(interval=LOAN_ACCRUAL_INTERVAL):
+    while True:
+        try:
+            if run_loan_accrual(sync_storage)['charged']:
+                # loan_due of cached users may have changed
+                user_cache.clear()
+        except Exception as e:
+            print(f"Loan accrual error: {e}")
+        time.sleep(interval)
+
+def run_journal_snapshot_schedule(interval=JOURNAL_SNAPSHOT_INTERVAL):
+    while True:
+        time.sleep(interval)
+        try:
+            take_snapshots(sync_storage)
+        except Exception as e:
+            print(f"Journal snapshot error: {e}")
+
+# AsyncTeleBot awaits the coroutine each handler returns
+app = BankApp(storage, conversations, bot, outbox, lambda flow: flow, user_cache, gift_window)
+
+register_handlers(bot, app)
+
+async def prepare_storage():
+    # Same startup steps as bot.py
+    await storage.ensure_indexes()
+    if configured_node_id() is None:
+        # Before any ID is generated; the first lease is taken in a thread
+        await asyncio.to_thread(NodeLease(sync_storage, id_generator).start)
+    if is_running(await storage.get_checkpoint(OPENING_CHECKPOINT)):
+        # Checked after taking the lease, which journal.py --opening looks for
+        raise SystemExit("The journal is being opened (python journal.py --opening); start the bot once it finishes")
+    await storage.check_query_plans()
+    await storage.migrate_liquidity_history()
+    await storage.migrate_loans()
+    await storage.migrate_user_documents()
+
+# Main coroutine to run the bot
+async def run():
+    print("Starting the bot (asyncio)...")
+    await prepare_storage()
+    await conversations.ensure_indexes()
+    outbox.start()
+    threading.Thread(target=run_total_balance_reconciliation, daemon=True).start()
+    threading.Thread(target=run_gift_window_flush, daemon=True).start()
+    if LOAN_ACCRUAL_INTERVAL:
+        threading.Thread(target=run_loan_accrual_schedule, daemon=True).start()
+    if JOURNAL_SNAPSHOT_INTERVAL:
+        threading.Thread(target=run_journal_snapshot_schedule, daemon=True).start()
+    while True:
+        try:
+            await bot.polling(non_stop=True, interval=0, timeout=20)
+        except Exception as e:
+            print(f"Bot polling error: {e}")
+            await asyncio.sleep(15)
+
+def main():
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main()
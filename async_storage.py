@@ -0,0 +1,301 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, DESCENDING
+from pymongo.errors import DuplicateKeyError
+from journal import build_transaction_entry, build_transfer_entry, build_leg_sum_pipeline
+from storage import (
+    INITIAL_LIQUIDITY, USER_DOCUMENTS_MIGRATION, LOANS_MIGRATION, get_bot_queries, find_plan_stages,
+    build_liquidity_buckets, build_user_backfill, build_loan_migrations
+)
+from helpers import (
+    INDEXES, RECENT_ACTIVITY_SIZE, TOTAL_BALANCE_PIPELINE, get_current_time, build_liquidity_change, build_history_query,
+    build_statement_query, build_repayment_update, build_balance_change, build_gift_claim, build_stats_updates,
+    build_transfer, build_repayment
+)
+
+class AsyncMongoStorage:
+    # The Storage methods behind the bot's flows and startup, awaited on the
+    # Motor driver for async_bot.py. Filters, updates and ledger rows come from
+    # the builders MongoStorage uses, so both runtimes write the same documents;
+    # methods keep the names, arguments and results of the Storage interface.
+    # Background jobs are not here: async_bot.py runs them on MongoStorage.
+
+    def __init__(self, uri, database='bank_bot'):
+        self.client = AsyncIOMotorClient(uri)
+        self.db = self.client[database]
+        self.users_collection = self.db['users']
+        self.transactions_collection = self.db['transactions']
+        self.bot_stats_collection = self.db['bot_stats']
+        self.transfer_requests_collection = self.db['transfer_requests']
+        self.loans_collection = self.db['loans']
+        self.liquidity_history_collection = self.db['liquidity_history']
+        self.journal_collection = self.db['journal']
+        self.statements_collection = self.db['statements']
+        self.journal_snapshots_collection = self.db['journal_snapshots']
+
+    # Startup, same steps as MongoStorage
+    async def ensure_indexes(self):
+        for collection_name, keys, unique in INDEXES:
+            await self.db[collection_name].create_index(keys, unique=unique)
+
+    async def check_query_plans(self):
+        collection_scans = []
+        for name, cursor in get_bot_queries(self.db):
+            plan = (await cursor.explain())['queryPlanner']['winningPlan']
+            if 'COLLSCAN' in find_plan_stages(plan):
+                collection_scans.append(name)
+        if collection_scans:
+            raise RuntimeError(f"Queries planned as COLLSCAN: {', '.join(collection_scans)}")
+
+    async def migrate_liquidity_history(self):
+        stats = await self.bot_stats_collection.find_one({'_id': 'liquidity', 'history': {'$exists': True}})
+        if not stats:
+            return
+        buckets = build_liquidity_buckets(stats['history'])
+        if buckets:
+            await self.liquidity_history_collection.insert_many(buckets)
+        await self.bot_stats_collection.update_one({'_id': 'liquidity'}, {'$unset': {'history': ''}})
+
+    async def migrate_user_documents(self):
+        if await self.get_checkpoint(USER_DOCUMENTS_MIGRATION):
+            return
+        async for user in self.users_collection.find({'recent': {'$exists': False}}, {'user_id': 1}):
+            transactions = self.transactions_collection.find({'user_id': user['user_id']}).sort('timestamp', -1).limit(RECENT_ACTIVITY_SIZE)
+            fields = build_user_backfill(
+                await transactions.to_list(length=RECENT_ACTIVITY_SIZE), await self.get_user_loans(user['user_id'])
+            )
+            await self.users_collection.update_one({'_id': user['_id']}, {'$set': fields})
+        await self.save_checkpoint(USER_DOCUMENTS_MIGRATION, {'finished_at': get_current_time()})
+
+    async def migrate_loans(self):
+        if await self.get_checkpoint(LOANS_MIGRATION):
+            return
+        for query, update in build_loan_migrations():
+            await self.loans_collection.update_many(query, update)
+        await self.save_checkpoint(LOANS_MIGRATION, {'finished_at': get_current_time()})
+
+    async def get_checkpoint(self, name):
+        return await self.bot_stats_collection.find_one({'_id': name})
+
+    async def save_checkpoint(self, name, state):
+        await self.bot_stats_collection.replace_one({'_id': name}, state, upsert=True)
+
+    async def ping(self):
+        await self.client.admin.command('ping')
+
+    # Users
+    async def get_user(self, user_id):
+        return await self.users_collection.find_one({'user_id': user_id})
+
+    async def change_user_balance(self, user_id, amount, min_balance=None, transaction=None):
+        query, update, upsert = build_balance_change(user_id, amount, min_balance, transaction)
+        if transaction:
+            entry = build_transaction_entry(transaction)
+        state = {}
+
+        async def run(session):
+            state.clear()
+            user = await self.users_collection.find_one_and_update(
+                query,
+                update,
+                upsert=upsert,
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            if not user:
+                await session.abort_transaction()
+                return
+            await self.bot_stats_collection.update_one({'_id': 'user_balances'}, {'$inc': {'total': amount}}, upsert=True, session=session)
+            if transaction:
+                await self.transactions_collection.insert_one(transaction, session=session)
+                await self.journal_collection.insert_one(entry, session=session)
+            state['user'] = user
+
+        async with await self.client.start_session() as session:
+            await session.with_transaction(run)
+        return state.get('user')
+
+    async def set_user_fields(self, user_id, fields):
+        return await self.users_collection.find_one_and_update(
+            {'user_id': user_id},
+            {'$set': fields},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def claim_daily_gift(self, user_id, amount, transaction, interval):
+        query, update = build_gift_claim(user_id, amount, transaction, interval)
+        entry = build_transaction_entry(transaction)
+        try:
+            user = await self.users_collection.find_one_and_update(
+                query,
+                update,
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The user exists but the filter did not match: claimed within interval
+            return None
+        await self.transactions_collection.insert_one(transaction)
+        await self.journal_collection.insert_one(entry)
+        return user
+
+    async def get_total_user_balance(self):
+        stats = await self.bot_stats_collection.find_one({'_id': 'user_balances'})
+        if not stats:
+            return await self.reconcile_total_user_balance()
+        return stats['total']
+
+    async def reconcile_total_user_balance(self):
+        result = await self.users_collection.aggregate(TOTAL_BALANCE_PIPELINE).to_list(length=1)
+        total = result[0]['total'] if result else 0
+        await self.bot_stats_collection.update_one(
+            {'_id': 'user_balances'},
+            {'$set': {'total': total, 'reconciled_at': get_current_time()}},
+            upsert=True
+        )
+        return total
+
+    # Transactions
+    async def log_transaction(self, transaction):
+        await self.transactions_collection.insert_one(transaction)
+
+    async def get_transaction_page(self, user_id, limit, cursor=None, newer=False):
+        query, sort = build_history_query(user_id, cursor, newer)
+        return await self.transactions_collection.find(query).sort(sort).limit(limit).to_list(length=limit)
+
+    async def get_transaction_batch(self, user_id, start, end, after=None, limit=500):
+        query, sort = build_statement_query(user_id, start, end, after)
+        return await self.transactions_collection.find(query).sort(sort).limit(limit).to_list(length=limit)
+
+    # Statements
+    async def get_statement(self, user_id, month):
+        return await self.statements_collection.find_one({'user_id': user_id, 'month': month})
+
+    async def save_statement(self, user_id, month, file_id, last_transaction, created_at=None):
+        await self.statements_collection.update_one(
+            {'user_id': user_id, 'month': month},
+            {'$set': {'file_id': file_id, 'last_transaction': last_transaction, 'created_at': created_at or get_current_time()}},
+            upsert=True
+        )
+
+    # Liquidity
+    async def get_bot_liquidity(self):
+        stats = await self.bot_stats_collection.find_one({'_id': 'liquidity'})
+        if not stats:
+            await self.bot_stats_collection.insert_one({'_id': 'liquidity', 'amount': INITIAL_LIQUIDITY})
+            return INITIAL_LIQUIDITY
+        return stats['amount']
+
+    async def update_bot_liquidity(self, amount, reason=None):
+        current_time = get_current_time()
+        await self.bot_stats_collection.update_one({'_id': 'liquidity'}, {'$inc': {'amount': amount}}, upsert=True)
+        await self.record_liquidity_change(amount, reason, current_time)
+
+    async def record_liquidity_change(self, amount, reason, current_time, session=None):
+        query, update = build_liquidity_change(amount, reason, current_time)
+        await self.liquidity_history_collection.update_one(query, update, upsert=True, session=session)
+
+    # Transfers
+    async def insert_transfer_request(self, transfer_request):
+        await self.transfer_requests_collection.insert_one(transfer_request)
+
+    async def delete_transfer_request(self, transfer_id, sender_id):
+        result = await self.transfer_requests_collection.delete_one({'transfer_id': transfer_id, 'sender_id': sender_id})
+        return result.deleted_count > 0
+
+    async def execute_transfer(self, transfer_id, sender_id):
+        # Same transaction as MongoStorage.execute_transfer
+        state = {'round_trips': 0, 'transfer_request': None}
+
+        async def run(session):
+            state['round_trips'] = 0
+            state['transfer_request'] = None
+
+            transfer_request = await self.transfer_requests_collection.find_one_and_delete(
+                {'transfer_id': transfer_id, 'sender_id': sender_id, 'status': 'pending'},
+                session=session
+            )
+            state['round_trips'] += 1
+            if not transfer_request:
+                await session.abort_transaction()
+                return 'not_found'
+            state['transfer_request'] = transfer_request
+
+            fee = transfer_request['fee']
+            transfer_out, transfer_in, user_updates = build_transfer(transfer_request)
+            result = await self.users_collection.bulk_write(user_updates, ordered=True, session=session)
+            state['round_trips'] += 1
+            if result.matched_count + result.upserted_count < 2:
+                await session.abort_transaction()
+                return 'insufficient_funds'
+
+            current_time = get_current_time()
+            await self.bot_stats_collection.bulk_write(build_stats_updates(fee, -fee), session=session)
+            await self.record_liquidity_change(fee, 'transfer_fee', current_time, session=session)
+            await self.transactions_collection.insert_many([transfer_out, transfer_in], session=session)
+            await self.journal_collection.insert_one(build_transfer_entry(transfer_out, transfer_in), session=session)
+            state['round_trips'] += 4
+            return 'completed'
+
+        async with await self.client.start_session() as session:
+            status = await session.with_transaction(run)
+        if status == 'completed':
+            state['round_trips'] += 1  # commit
+        return status, state['transfer_request'], state['round_trips']
+
+    # Loans
+    async def get_user_loans(self, user_id):
+        return await self.loans_collection.find({'user_id': user_id, 'paid': False}).to_list(length=None)
+
+    async def insert_loan(self, loan):
+        loan.setdefault('updated_at', loan['timestamp'])
+        await self.loans_collection.insert_one(loan)
+        await self.users_collection.update_one({'user_id': loan['user_id']}, {'$inc': {'loan_due': loan['total_to_repay']}})
+
+    async def repay_loan(self, loan_id, user_id, amount=None, auto=False):
+        # Same transaction as MongoStorage.repay_loan
+        state = {}
+
+        async def run(session):
+            state.clear()
+            loan = await self.loans_collection.find_one_and_update(
+                {'loan_id': loan_id, 'user_id': user_id, 'paid': False, 'remaining': {'$gt': 0}},
+                build_repayment_update(get_current_time(), amount),
+                session=session
+            )
+            if not loan:
+                await session.abort_transaction()
+                return 'not_found'
+
+            repaid, left, transaction, query, update = build_repayment(loan, user_id, amount, auto)
+            user = await self.users_collection.find_one_and_update(
+                query,
+                update,
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            if not user:
+                await session.abort_transaction()
+                return 'insufficient_funds'
+
+            await self.bot_stats_collection.bulk_write(build_stats_updates(repaid, -repaid), session=session)
+            await self.record_liquidity_change(repaid, 'loan_repayment', transaction['timestamp'], session=session)
+            await self.transactions_collection.insert_one(transaction, session=session)
+            await self.journal_collection.insert_one(build_transaction_entry(transaction), session=session)
+            state['repayment'] = {'amount': repaid, 'remaining': left, 'balance': user['balance'], 'transaction': transaction}
+            return 'completed'
+
+        async with await self.client.start_session() as session:
+            status = await session.with_transaction(run)
+        return status, state.get('repayment')
+
+    # Journal
+    async def sum_account_legs(self, account, after=None, until=None):
+        result = await self.journal_collection.aggregate(build_leg_sum_pipeline(account, after, until)).to_list(length=1)
+        return result[0]['total'] if result else 0
+
+    async def get_latest_snapshot(self, account, at=None):
+        query = {'account': account}
+        if at is not None:
+            query['timestamp'] = {'$lte': at}
+        return await self.journal_snapshots_collection.find_one(query, sort=[('timestamp', DESCENDING)])
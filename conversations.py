@@ -0,0 +1,109 @@
+import threading
+import time
+from datetime import datetime, timedelta
+import pytz
+
+# Seconds an unanswered conversation step stays valid
+DEFAULT_TTL = 600
+
+class ConversationStore:
+    # Pending step of each user's multi-message flow (transfer, slots bet) as
+    # {'step': name, 'data': {...}}. Entries expire after ttl seconds. pop()
+    # reads and removes in one call, so a step runs once even when several bot
+    # processes share the store.
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+
+    def ensure_indexes(self):
+        pass
+
+    def set(self, user_id, step, data=None):
+        raise NotImplementedError
+
+    def pop(self, user_id):
+        raise NotImplementedError
+
+    def clear(self, user_id):
+        raise NotImplementedError
+
+class MemoryConversationStore(ConversationStore):
+    def __init__(self, ttl=DEFAULT_TTL):
+        super().__init__(ttl)
+        self.lock = threading.Lock()
+        self.states = {}
+
+    def set(self, user_id, step, data=None):
+        with self.lock:
+            self.states[user_id] = ({'step': step, 'data': data or {}}, time.monotonic() + self.ttl)
+            if len(self.states) % 1000 == 0:
+                self._drop_expired()
+
+    def _drop_expired(self):
+        now = time.monotonic()
+        for user_id, (_, expires_at) in list(self.states.items()):
+            if expires_at <= now:
+                del self.states[user_id]
+
+    def pop(self, user_id):
+        with self.lock:
+            entry = self.states.pop(user_id, None)
+        if not entry or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def clear(self, user_id):
+        with self.lock:
+            self.states.pop(user_id, None)
+
+class MongoConversationStore(ConversationStore):
+    # One document per user keyed by user id. A TTL index deletes expired
+    # documents; reads also check expires_at since the TTL monitor runs only
+    # about once a minute.
+
+    def __init__(self, collection, ttl=DEFAULT_TTL):
+        super().__init__(ttl)
+        self.collection = collection
+
+    def ensure_indexes(self):
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+
+    def set(self, user_id, step, data=None):
+        expires_at = datetime.now(pytz.utc) + timedelta(seconds=self.ttl)
+        self.collection.replace_one(
+            {'_id': user_id},
+            {'step': step, 'data': data or {}, 'expires_at': expires_at},
+            upsert=True
+        )
+
+    def pop(self, user_id):
+        return self.collection.find_one_and_delete(
+            {'_id': user_id, 'expires_at': {'$gt': datetime.now(pytz.utc)}},
+            projection={'_id': False, 'step': True, 'data': True}
+        )
+
+    def clear(self, user_id):
+        self.collection.delete_one({'_id': user_id})
+
+class AsyncMongoConversationStore(MongoConversationStore):
+    # Same documents through a Motor collection, for async_bot.py
+
+    async def ensure_indexes(self):
+        await self.collection.create_index('expires_at', expireAfterSeconds=0)
+
+    async def set(self, user_id, step, data=None):
+        expires_at = datetime.now(pytz.utc) + timedelta(seconds=self.ttl)
+        await self.collection.replace_one(
+            {'_id': user_id},
+            {'step': step, 'data': data or {}, 'expires_at': expires_at},
+            upsert=True
+        )
+
+    async def pop(self, user_id):
+        return await self.collection.find_one_and_delete(
+            {'_id': user_id, 'expires_at': {'$gt': datetime.now(pytz.utc)}},
+            projection={'_id': False, 'step': True, 'data': True}
+        )
+
+    async def clear(self, user_id):
+        await self.collection.delete_one({'_id': user_id})
@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import deque
+
+# Number of idle lanes kept for their statistics before they are dropped
+MAX_IDLE_LANES = 10000
+
+class Lane:
+    def __init__(self, key):
+        self.key = key
+        self.items = deque()
+        self.active = False
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_used = time.time()
+
+class UserDispatcher:
+    # Runs updates on a pool of worker threads. Updates with the same key (the
+    # user id) run one at a time in arrival order; different keys run in parallel.
+    # With max_pending the queue is bounded: submit() then either waits for room
+    # (block=True) or returns False.
+
+    def __init__(self, handler, num_workers=8, max_pending=None):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.lanes = {}
+        self.ready = deque()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.running = True
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._work, name=f"dispatcher-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, key, item, block=False):
+        with self.condition:
+            while self.max_pending is not None and self.pending >= self.max_pending:
+                if not block:
+                    return False
+                self.not_full.wait()
+            lane = self.lanes.get(key)
+            if lane is None:
+                if len(self.lanes) >= MAX_IDLE_LANES:
+                    self._drop_idle_lanes()
+                lane = self.lanes[key] = Lane(key)
+            lane.items.append((time.perf_counter(), item))
+            lane.last_used = time.time()
+            self.pending += 1
+            if not lane.active:
+                lane.active = True
+                self.ready.append(lane)
+                self.condition.notify()
+        return True
+
+    def _drop_idle_lanes(self):
+        for key, lane in list(self.lanes.items()):
+            if not lane.active:
+                del self.lanes[key]
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while self.running and not self.ready:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                lane = self.ready.popleft()
+                enqueued_at, item = lane.items.popleft()
+
+            wait = time.perf_counter() - enqueued_at
+            try:
+                self.handler(item)
+            except Exception as e:
+                print(f"Error handling update for {lane.key}: {e}")
+
+            with self.condition:
+                self.pending -= 1
+                self.not_full.notify()
+                lane.processed += 1
+                lane.total_wait += wait
+                lane.max_wait = max(lane.max_wait, wait)
+                if lane.items:
+                    # Back of the queue so one busy user cannot starve the others
+                    self.ready.append(lane)
+                    self.condition.notify()
+                else:
+                    lane.active = False
+
+    def queue_depth(self):
+        with self.condition:
+            return self.pending
+
+    def lane_stats(self):
+        with self.condition:
+            return {
+                lane.key: {
+                    'depth': len(lane.items),
+                    'processed': lane.processed,
+                    'avg_wait_ms': lane.total_wait / lane.processed * 1000 if lane.processed else 0.0,
+                    'max_wait_ms': lane.max_wait * 1000
+                }
+                for lane in self.lanes.values()
+            }
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,201 @@
+import argparse
+import csv
+import importlib.util
+import itertools
+import json
+import os
+import time
+from datetime import timedelta
+from bson import ObjectId
+from helpers import get_current_time, as_utc
+
+# Analytics export: streams transactions, loans and liquidity history changes
+# oldest first and writes them batch by batch to chunked CSV files or to
+# Parquet files (one row group per batch; needs pyarrow, which the bot itself
+# does not: pip install pyarrow). Only one batch is held in memory, however big
+# the collections are.
+#
+#   python export.py --out exports                       everything up to now
+#   python export.py --out exports --incremental         only what was added since the last export
+#   python export.py --out exports --format parquet --sources transactions
+#
+# Each source keeps its watermark in bot_stats. A run exports since < timestamp
+# <= until and file names carry until, so rerunning an interrupted export
+# rewrites the same files.
+
+# Columns of each source: (field, kind)
+SOURCES = {
+    'transactions': [
+        ('_id', 'str'), ('transaction_id', 'str'), ('user_id', 'int'), ('type', 'str'),
+        ('amount', 'float'), ('timestamp', 'time'), ('details', 'json')
+    ],
+    # Loans are exported by the time they last changed (updated_at), with their
+    # state at export time: a loan repaid or charged since the previous export
+    # is in the next one again
+    'loans': [
+        ('_id', 'str'), ('loan_id', 'str'), ('user_id', 'int'), ('amount', 'float'), ('interest', 'float'),
+        ('penalty', 'float'), ('total_to_repay', 'float'), ('remaining', 'float'), ('repaid', 'float'),
+        ('paid', 'bool'), ('timestamp', 'time'), ('due_date', 'time'), ('last_accrued', 'time'), ('updated_at', 'time')
+    ],
+    'liquidity': [
+        ('timestamp', 'time'), ('amount', 'float'), ('reason', 'str')
+    ]
+}
+
+# Storage method streaming each source
+SOURCE_ITERATORS = {
+    'transactions': 'iter_transactions_between',
+    'loans': 'iter_loans_between',
+    'liquidity': 'iter_liquidity_changes_between'
+}
+
+# Documents are written right after their timestamp is taken; an export stops
+# this long before it starts so none lands behind the watermark
+WATERMARK_LAG = timedelta(minutes=1)
+
+def get_checkpoint_name(source):
+    return f"export_{source}"
+
+def convert_value(value, kind):
+    if value is None:
+        return None
+    if kind == 'time':
+        return as_utc(value)
+    if kind == 'json':
+        return json.dumps(value, default=str, ensure_ascii=False)
+    if kind == 'str' and isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+def to_row(document, columns):
+    return [convert_value(document.get(field), kind) for field, kind in columns]
+
+class CsvChunkWriter:
+    # One CSV file per chunk_rows rows: <source>-<until>-<part>.csv
+
+    extension = 'csv'
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([field for field, _ in columns])
+
+    def write(self, rows):
+        self.writer.writerows(
+            [value.isoformat() if hasattr(value, 'isoformat') else value for value in row] for row in rows
+        )
+
+    def close(self):
+        self.file.close()
+
+class ParquetChunkWriter:
+    # Same chunks as Parquet files, each batch written as one row group
+
+    extension = 'parquet'
+
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        types = {
+            'str': pa.string(), 'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_(),
+            'time': pa.timestamp('us', tz='UTC'), 'json': pa.string()
+        }
+        self.pa = pa
+        self.schema = pa.schema([(field, types[kind]) for field, kind in columns])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_table(self.pa.Table.from_arrays(
+            [self.pa.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema
+        ))
+
+    def close(self):
+        self.writer.close()
+
+WRITERS = {'csv': CsvChunkWriter, 'parquet': ParquetChunkWriter}
+
+def export_source(storage, source, out_dir, file_format='csv', incremental=False, batch_size=5000, chunk_rows=1000000):
+    checkpoint = storage.get_checkpoint(get_checkpoint_name(source)) or {}
+    if checkpoint.get('until') and not checkpoint.get('finished_at'):
+        # Interrupted: export the same window again into the same files
+        state = checkpoint
+        print(f"Resuming the {source} export up to {state['until']}")
+    else:
+        state = {
+            'since': checkpoint.get('watermark') if incremental else None,
+            'until': get_current_time() - WATERMARK_LAG,
+            'watermark': checkpoint.get('watermark'),
+            'format': file_format,
+            'files': [],
+            'rows': 0,
+            'started_at': get_current_time(),
+            'finished_at': None
+        }
+    storage.save_checkpoint(get_checkpoint_name(source), state)
+
+    columns = SOURCES[source]
+    writer_class = WRITERS[state['format']]
+    os.makedirs(os.path.join(out_dir, source), exist_ok=True)
+    stamp = as_utc(state['until']).strftime('%Y%m%dT%H%M%S%f')
+    documents = iter(getattr(storage, SOURCE_ITERATORS[source])(state['since'], state['until'], batch_size))
+
+    start = time.perf_counter()
+    files = []
+    rows = 0
+    writer = None
+    written = 0
+    while True:
+        batch = list(itertools.islice(documents, batch_size))
+        if not batch:
+            break
+        while batch:
+            if writer is None:
+                path = os.path.join(out_dir, source, f"{source}-{stamp}-{len(files):05d}.{writer_class.extension}")
+                writer = writer_class(path, columns)
+                files.append(path)
+                written = 0
+            part = batch[:chunk_rows - written]
+            batch = batch[len(part):]
+            writer.write([to_row(document, columns) for document in part])
+            written += len(part)
+            rows += len(part)
+            if written >= chunk_rows:
+                writer.close()
+                writer = None
+    if writer is not None:
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    state.update({'files': files, 'rows': rows, 'watermark': state['until'], 'finished_at': get_current_time()})
+    storage.save_checkpoint(get_checkpoint_name(source), state)
+    print(f"Exported {rows} {source} rows to {len(files)} files in {elapsed:.2f}s "
+          f"({rows / elapsed if elapsed else 0:.0f} rows/s)")
+    return state
+
+def main():
+    parser = argparse.ArgumentParser(description="Export transactions, loans and liquidity history to CSV or Parquet")
+    parser.add_argument('--out', default='exports', help="directory for the exported files")
+    parser.add_argument('--format', default='csv', choices=sorted(WRITERS))
+    parser.add_argument('--sources', default=','.join(SOURCES), help="comma separated: " + ', '.join(SOURCES))
+    parser.add_argument('--incremental', action='store_true', help="only documents since the last export")
+    parser.add_argument('--batch-size', type=int, default=5000, help="documents read and written per batch")
+    parser.add_argument('--chunk-rows', type=int, default=1000000, help="rows per file")
+    args = parser.parse_args()
+
+    sources = [source.strip() for source in args.sources.split(',') if source.strip()]
+    unknown = [source for source in sources if source not in SOURCES]
+    if unknown:
+        raise SystemExit(f"Unknown sources: {', '.join(unknown)}")
+
+    if args.format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        raise SystemExit("Parquet export needs pyarrow: pip install pyarrow")
+
+    from storage import MongoStorage
+    storage = MongoStorage(f"mongodb+srv://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_CLUSTER')}/")
+    for source in sources:
+        export_source(storage, source, args.out, args.format, args.incremental, args.batch_size, args.chunk_rows)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,609 @@
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from outbox import PRIORITY_TRANSACTIONAL, PRIORITY_NORMAL, PRIORITY_LOW
+from accrual import LOAN_TERM
+from journal import get_user_balance_at
+from statements import (
+    SPOOL_SIZE, get_recent_months, get_statement_filename, render_statement, get_latest_transaction_id, is_cache_valid
+)
+from slots import MIN_BET, MAX_BET, WIN_MULTIPLIER, spin, is_winning, can_pay
+from helpers import (
+    RECENT_ACTIVITY_SIZE, get_current_time, generate_transaction_id, build_transaction, decode_history_callback,
+    parse_balance_at_args, parse_amount
+)
+import messages
+from messages import (
+    MAIN_MENU_BUTTONS, get_main_keyboard, get_history_keyboard, get_statement_months_keyboard, get_liquidity_keyboard,
+    get_transfer_keyboard, get_other_options_keyboard, get_play_again_keyboard, get_loan_options_keyboard,
+    get_loan_amounts_keyboard, get_loan_keyboard
+)
+
+# What the bot does with an update, shared by bot.py (worker threads) and
+# async_bot.py (asyncio). Flows are coroutines over a BankApp whose storage,
+# conversations and Telegram client are awaited: AsyncMongoStorage and
+# AsyncTeleBot in async_bot.py; in bot.py the blocking objects wrapped in
+# Awaitable, where run_flow() runs a flow to its end on the calling thread.
+
+# Time between two daily gifts of a user
+DAILY_GIFT_INTERVAL = timedelta(days=1)
+
+# Transactions shown per transaction history page
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 10))
+
+# Comma separated Telegram user ids allowed to use admin commands (/balance_at)
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(',') if admin_id.strip()}
+
+class Awaitable:
+    # Blocking object seen by the flows: each method call runs right away and
+    # its result is returned when awaited
+    def __init__(self, target):
+        self.target = target
+
+    def __getattr__(self, name):
+        method = getattr(self.target, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+def run_flow(flow):
+    # Runs a flow over Awaitable objects and returns its result
+    try:
+        flow.send(None)
+    except StopIteration as stop:
+        return stop.value
+    flow.close()
+    raise RuntimeError("A flow awaited something other than an Awaitable")
+
+class BankApp:
+    # The runtime pieces the flows use. storage, conversations and api (the
+    # Telegram client) are awaited; outbox.enqueue never blocks. run turns a
+    # flow into what the runtime executes: run_flow in bot.py, the coroutine
+    # itself in async_bot.py. sweep_loans(user_id, amount) runs
+    # auto_repay_loans for a transfer's recipient (right away by default),
+    # invalidate_remote drops users from other workers' caches and
+    # status_lines() adds runtime lines to the status message.
+
+    def __init__(self, storage, conversations, api, outbox, run, user_cache, gift_window,
+                 sweep_loans=None, invalidate_remote=None, status_lines=None):
+        self.storage = storage
+        self.conversations = conversations
+        self.api = api
+        self.outbox = outbox
+        self.run = run
+        self.user_cache = user_cache
+        self.gift_window = gift_window
+        self.sweep_loans = sweep_loans or (lambda user_id, amount: auto_repay_loans(self, user_id, amount))
+        self.invalidate_remote = invalidate_remote
+        self.status_lines = status_lines
+        self.started_at = get_current_time()
+        self.transfer_stats = {'count': 0, 'round_trips': 0, 'latency_ms': 0.0}
+        self.transfer_stats_lock = threading.Lock()
+
+    def send(self, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+        self.outbox.enqueue(chat_id, text, priority, **kwargs)
+
+    def call_later(self, flow, *args, **kwargs):
+        # flow as an outbox method: started again on every attempt
+        return lambda: self.run(flow(*args, **kwargs))
+
+    def invalidate(self, *user_ids):
+        self.user_cache.invalidate(*user_ids)
+        if self.invalidate_remote:
+            # They may be cached by the worker that owns them
+            self.invalidate_remote(*user_ids)
+
+    def record_transfer(self, round_trips, latency_ms):
+        with self.transfer_stats_lock:
+            self.transfer_stats['count'] += 1
+            self.transfer_stats['round_trips'] += round_trips
+            self.transfer_stats['latency_ms'] += latency_ms
+
+    def get_transfer_stats(self):
+        with self.transfer_stats_lock:
+            return dict(self.transfer_stats)
+
+# Reads through the user cache
+async def get_user(app, user_id):
+    user = app.user_cache.get(user_id)
+    if user is None:
+        user = await app.storage.get_user(user_id)
+        if user:
+            app.user_cache.put(user_id, user)
+    return user
+
+async def get_user_balance(app, user_id):
+    user = await get_user(app, user_id)
+    return user['balance'] if user else 0
+
+async def change_user_balance(app, user_id, amount, min_balance=None, transaction=None):
+    # Atomic $inc of the balance; with min_balance the change only applies while
+    # balance >= min_balance and None is returned otherwise. The transaction, if
+    # any, lands in the user's recent activity in the same write.
+    user = await app.storage.change_user_balance(user_id, amount, min_balance, transaction)
+    if not user:
+        return None
+    app.user_cache.put(user_id, user)
+    return user['balance']
+
+async def get_transaction_page(app, user_id, cursor=None, newer=False):
+    # One extra row tells whether there is another page in the same direction
+    transactions = await app.storage.get_transaction_page(user_id, HISTORY_PAGE_SIZE + 1, cursor, newer)
+    has_more = len(transactions) > HISTORY_PAGE_SIZE
+    transactions = transactions[:HISTORY_PAGE_SIZE]
+    if newer:
+        transactions.reverse()
+        return transactions, has_more, True
+    return transactions, cursor is not None, has_more
+
+async def get_recent_page(app, user_id):
+    # First history page straight from the user document's recent array
+    user = await get_user(app, user_id)
+    if not user or 'recent' not in user or HISTORY_PAGE_SIZE > RECENT_ACTIVITY_SIZE:
+        return await get_transaction_page(app, user_id)
+    recent = user['recent']
+    transactions = recent[::-1][:HISTORY_PAGE_SIZE]
+    # A full array may have dropped older entries that are still in the ledger
+    has_older = len(recent) > HISTORY_PAGE_SIZE or len(recent) == RECENT_ACTIVITY_SIZE
+    return transactions, False, has_older
+
+# Commands and messages
+async def start(app, user_id):
+    await app.conversations.clear(user_id)
+    app.send(user_id, messages.WELCOME, reply_markup=get_main_keyboard())
+
+async def balance_at(app, user_id, text):
+    # Admin command: a user's balance at a past time, from the journal
+    if user_id not in ADMIN_IDS:
+        app.send(user_id, messages.UNKNOWN_COMMAND)
+        return
+    try:
+        target_id, at = parse_balance_at_args(text)
+    except ValueError:
+        app.send(user_id, messages.BALANCE_AT_USAGE)
+        return
+    balance = await get_user_balance_at(app.storage, target_id, at)
+    if balance is None:
+        app.send(user_id, messages.BEFORE_JOURNAL)
+        return
+    app.send(user_id, messages.format_balance_at(target_id, at, balance))
+
+async def handle_message(app, user_id, text):
+    # A pending step takes the message unless it is a main menu button, which
+    # abandons the flow
+    state = await app.conversations.pop(user_id)
+    if state and text not in MAIN_MENU_BUTTONS:
+        await continue_conversation(app, user_id, text, state)
+        return
+
+    if text == '💰 رصيدي':
+        await check_balance(app, user_id)
+    elif text == '📜 العمليات السابقة':
+        await transaction_history(app, user_id)
+    elif text == '🏦 سيولة البوت':
+        await bot_liquidity(app, user_id)
+    elif text == '💸 تحويل':
+        await transfer_start(app, user_id)
+    elif text == '🎮 أخرى':
+        show_other_options(app, user_id)
+    else:
+        app.send(user_id, messages.UNKNOWN_COMMAND)
+
+async def continue_conversation(app, user_id, text, state):
+    steps = {
+        'transfer_recipient': transfer_amount,
+        'transfer_amount': transfer_confirm,
+        'slots_bet': process_slots_bet,
+        'repay_amount': process_repay_amount
+    }
+    await steps[state['step']](app, user_id, text, **state['data'])
+
+async def handle_callback(app, user_id, call_id, data, message_id):
+    # Inline keyboard buttons; answering the callback stops the button's spinner
+    if data.startswith('statement:'):
+        # Answered first, rendering may take a while
+        await app.api.answer_callback_query(call_id)
+        await send_statement(app, user_id, data.split(':', 1)[1])
+        return
+    answer = None
+    if data.startswith('hist:'):
+        await transaction_history_page(app, user_id, data, message_id)
+    elif data.startswith(('confirm_transfer', 'cancel_transfer')):
+        answer = await transfer_callback(app, user_id, data)
+    elif data == 'daily_gift':
+        await daily_gift(app, user_id)
+    elif data in ('play_slots', 'play_slots_again'):
+        await start_slots_game(app, user_id)
+    elif data == 'end_slots':
+        app.send(user_id, messages.THANKS_FOR_PLAYING, reply_markup=get_main_keyboard())
+    elif data == 'loan_options':
+        await show_loan_options(app, user_id)
+    elif data == 'statements':
+        show_statement_months(app, user_id)
+    elif data == 'request_loan':
+        app.send(user_id, messages.CHOOSE_LOAN_AMOUNT, reply_markup=get_loan_amounts_keyboard())
+    elif data == 'repay_loan':
+        await show_active_loans(app, user_id)
+    elif data == 'auto_repay':
+        await toggle_auto_repay(app, user_id)
+    elif data.startswith(('repay_loan_', 'repay_part_')):
+        await repay_loan_callback(app, user_id, data)
+    elif data.startswith('loan_'):
+        await process_loan_request(app, user_id, int(data.split('_')[1]))
+    elif data == 'check_status':
+        await check_status(app, user_id)
+    await app.api.answer_callback_query(call_id, answer)
+
+async def check_balance(app, user_id):
+    user = await get_user(app, user_id) or {}
+    response = messages.format_balance(user_id, user.get('balance', 0), user.get('loan_due', 0))
+    app.send(user_id, response, parse_mode='Markdown')
+
+# Transaction history and statements
+async def transaction_history(app, user_id):
+    transactions, has_newer, has_older = await get_recent_page(app, user_id)
+    if not transactions:
+        app.send(user_id, messages.NO_HISTORY)
+        return
+
+    history = messages.format_transaction_history(transactions)
+    keyboard = get_history_keyboard(transactions, 1, has_newer, has_older)
+    app.send(user_id, history, reply_markup=keyboard, parse_mode='Markdown')
+
+async def transaction_history_page(app, user_id, data, message_id):
+    direction, page, cursor = decode_history_callback(data)
+    transactions, has_newer, has_older = await get_transaction_page(app, user_id, cursor, newer=direction == 'p')
+    if not transactions:
+        return
+
+    history = messages.format_transaction_history(transactions, page)
+    keyboard = get_history_keyboard(transactions, page, has_newer, has_older)
+    app.outbox.enqueue_call(
+        user_id, app.call_later(app.api.edit_message_text, history, user_id, message_id, reply_markup=keyboard, parse_mode='Markdown')
+    )
+
+def show_statement_months(app, user_id):
+    months = get_recent_months(get_current_time())
+    app.send(user_id, messages.CHOOSE_STATEMENT_MONTH, reply_markup=get_statement_months_keyboard(months))
+
+async def send_statement(app, user_id, month):
+    caption = messages.format_statement_caption(month)
+    latest_transaction_id = get_latest_transaction_id(await app.storage.get_user(user_id))
+    now = get_current_time()
+    cached = await app.storage.get_statement(user_id, month)
+    if is_cache_valid(cached, month, now, latest_transaction_id):
+        app.outbox.enqueue_call(user_id, app.call_later(app.api.send_document, user_id, cached['file_id'], caption=caption))
+        return
+
+    statement = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        count = await render_statement(app.storage, user_id, month, statement)
+    except Exception:
+        statement.close()
+        raise
+    if not count:
+        statement.close()
+        app.send(user_id, messages.format_empty_statement(month))
+        return
+    app.outbox.enqueue_call(
+        user_id, app.call_later(upload_statement, app, user_id, month, statement, caption, latest_transaction_id, now),
+        on_done=statement.close
+    )
+
+async def upload_statement(app, user_id, month, statement, caption, latest_transaction_id, rendered_at):
+    # Runs in the outbox, again on every retry; the file_id Telegram returns is
+    # cached so the next request sends no file. The outbox closes the statement
+    # once it was sent or dropped.
+    statement.seek(0)
+    message = await app.api.send_document(user_id, statement, visible_file_name=get_statement_filename(month), caption=caption)
+    await app.storage.save_statement(user_id, month, message.document.file_id, latest_transaction_id, rendered_at)
+
+async def bot_liquidity(app, user_id):
+    liquidity = await app.storage.get_bot_liquidity()
+    total_user_balance = await app.storage.get_total_user_balance()
+    app.send(user_id, messages.format_liquidity(liquidity, total_user_balance), reply_markup=get_liquidity_keyboard())
+
+# Transfers
+async def transfer_start(app, user_id):
+    app.send(user_id, messages.ASK_RECIPIENT)
+    await app.conversations.set(user_id, 'transfer_recipient')
+
+async def transfer_amount(app, user_id, text):
+    if not text.isdigit():
+        app.send(user_id, messages.BAD_RECIPIENT)
+        return
+    recipient_id = int(text)
+    if recipient_id == user_id:
+        app.send(user_id, messages.SELF_TRANSFER)
+        return
+    app.send(user_id, messages.ASK_TRANSFER_AMOUNT)
+    await app.conversations.set(user_id, 'transfer_amount', {'recipient_id': recipient_id})
+
+async def transfer_confirm(app, user_id, text, recipient_id):
+    try:
+        amount = parse_amount(text)
+        if amount <= 0:
+            raise ValueError
+    except ValueError:
+        app.send(user_id, messages.BAD_AMOUNT)
+        return
+
+    if amount < 0.01:
+        app.send(user_id, messages.BELOW_MIN_TRANSFER)
+        return
+
+    fee = amount * 0.02
+    if amount + fee > await get_user_balance(app, user_id):
+        app.send(user_id, messages.TRANSFER_INSUFFICIENT)
+        return
+
+    transfer_id = generate_transaction_id(user_id, is_transfer=True)
+    app.send(
+        user_id, messages.format_transfer_confirmation(amount, fee, recipient_id, transfer_id),
+        reply_markup=get_transfer_keyboard(transfer_id), parse_mode='Markdown'
+    )
+
+    # Store transfer request
+    await app.storage.insert_transfer_request({
+        'transfer_id': transfer_id,
+        'sender_id': user_id,
+        'recipient_id': recipient_id,
+        'amount': amount,
+        'fee': fee,
+        'status': 'pending',
+        'timestamp': get_current_time()
+    })
+
+async def transfer_callback(app, user_id, data):
+    # Returns the callback answer
+    action, transfer_id = data.split(':')
+    if action == 'confirm_transfer':
+        status = await perform_transfer(app, transfer_id, user_id)
+        return messages.TRANSFER_NOT_FOUND if status == 'not_found' else messages.TRANSFER_CONFIRMED
+    if not await app.storage.delete_transfer_request(transfer_id, user_id):
+        return messages.TRANSFER_NOT_FOUND
+    return messages.TRANSFER_CANCELLED
+
+async def execute_transfer(app, transfer_id, sender_id):
+    start_time = time.perf_counter()
+    status, transfer_request, round_trips = await app.storage.execute_transfer(transfer_id, sender_id)
+    if status == 'completed':
+        app.invalidate(sender_id, transfer_request['recipient_id'])
+    app.record_transfer(round_trips, (time.perf_counter() - start_time) * 1000)
+    return status, transfer_request
+
+async def perform_transfer(app, transfer_id, sender_id):
+    status, transfer_request = await execute_transfer(app, transfer_id, sender_id)
+
+    if status == 'insufficient_funds':
+        app.send(sender_id, messages.TRANSFER_INSUFFICIENT)
+    elif status == 'completed':
+        recipient_id = transfer_request['recipient_id']
+        amount = transfer_request['amount']
+        app.send(sender_id, messages.format_transfer_sent(amount, transfer_request['fee'], transfer_id), PRIORITY_TRANSACTIONAL, parse_mode='Markdown')
+        app.send(recipient_id, messages.format_transfer_received(amount, transfer_id), PRIORITY_TRANSACTIONAL, parse_mode='Markdown')
+        await app.sweep_loans(recipient_id, amount)
+    return status
+
+# Daily gift and slots
+def show_other_options(app, user_id):
+    app.send(user_id, messages.CHOOSE_OTHER_OPTION, reply_markup=get_other_options_keyboard())
+
+async def daily_gift(app, user_id):
+    gift_amount = random.uniform(0.005, 0.01)
+    transaction = build_transaction(user_id, 'daily_gift', gift_amount)
+    # One conditional write checks last_gift and adds the gift, so a double tap
+    # cannot claim twice
+    user = await app.storage.claim_daily_gift(user_id, gift_amount, transaction, DAILY_GIFT_INTERVAL)
+    if not user:
+        app.gift_window.count()
+        app.send(user_id, messages.GIFT_ALREADY_CLAIMED)
+        return
+    app.gift_window.count(gift_amount, transaction['timestamp'])
+    app.user_cache.put(user_id, user)
+    response = messages.format_daily_gift(gift_amount, user['balance'], transaction['transaction_id'])
+    app.send(user_id, response, PRIORITY_TRANSACTIONAL, parse_mode='Markdown')
+
+async def start_slots_game(app, user_id):
+    app.send(user_id, messages.ASK_BET)
+    await app.conversations.set(user_id, 'slots_bet')
+
+async def process_slots_bet(app, user_id, text):
+    try:
+        bet_amount = parse_amount(text)
+    except ValueError:
+        app.send(user_id, messages.BAD_BET)
+        await start_slots_game(app, user_id)
+        return
+    if MIN_BET <= bet_amount <= MAX_BET:
+        await play_slots(app, user_id, bet_amount)
+    else:
+        app.send(user_id, messages.BET_OUT_OF_RANGE)
+        await start_slots_game(app, user_id)
+
+async def play_slots(app, user_id, bet_amount):
+    user_balance = await get_user_balance(app, user_id)
+    bot_liquidity = await app.storage.get_bot_liquidity()
+
+    if bet_amount > user_balance:
+        app.send(user_id, messages.SLOTS_INSUFFICIENT)
+        return
+
+    result = spin()
+
+    is_winner = is_winning(result)
+
+    if is_winner and not can_pay(bet_amount, bot_liquidity):
+        is_winner = False  # Force a loss if bot doesn't have enough liquidity
+
+    if is_winner:
+        winnings = bet_amount * WIN_MULTIPLIER
+        transaction = build_transaction(user_id, 'slots_win', winnings - bet_amount)
+        new_user_balance = await change_user_balance(app, user_id, winnings - bet_amount, min_balance=bet_amount, transaction=transaction)
+        if new_user_balance is None:
+            app.send(user_id, messages.SLOTS_INSUFFICIENT)
+            return
+        await app.storage.update_bot_liquidity(-winnings + bet_amount, 'slots_win')
+        message = messages.format_slots_win(result, winnings, new_user_balance, transaction['transaction_id'])
+    else:
+        transaction = build_transaction(user_id, 'slots_loss', -bet_amount)
+        new_user_balance = await change_user_balance(app, user_id, -bet_amount, min_balance=bet_amount, transaction=transaction)
+        if new_user_balance is None:
+            app.send(user_id, messages.SLOTS_INSUFFICIENT)
+            return
+        await app.storage.update_bot_liquidity(bet_amount, 'slots_loss')
+        message = messages.format_slots_loss(result, bet_amount, new_user_balance, transaction['transaction_id'])
+
+    app.send(user_id, message, PRIORITY_TRANSACTIONAL, parse_mode='Markdown')
+    app.send(user_id, messages.PLAY_AGAIN, PRIORITY_LOW, reply_markup=get_play_again_keyboard())
+
+# Loans
+async def show_loan_options(app, user_id):
+    user = await get_user(app, user_id) or {}
+    app.send(user_id, messages.CHOOSE_LOAN_OPTION, reply_markup=get_loan_options_keyboard(user.get('auto_repay')))
+
+async def toggle_auto_repay(app, user_id):
+    user = await get_user(app, user_id) or {}
+    auto_repay = not user.get('auto_repay', False)
+    app.user_cache.put(user_id, await app.storage.set_user_fields(user_id, {'auto_repay': auto_repay}))
+    app.send(user_id, messages.AUTO_REPAY_ON if auto_repay else messages.AUTO_REPAY_OFF)
+
+async def process_loan_request(app, user_id, loan_amount):
+    user_balance = await get_user_balance(app, user_id)
+    bot_liquidity = await app.storage.get_bot_liquidity()
+    existing_loans = await app.storage.get_user_loans(user_id)
+
+    if existing_loans:
+        app.send(user_id, messages.LOAN_EXISTS)
+        return
+
+    if user_balance < loan_amount * 0.9:
+        app.send(user_id, messages.LOAN_BALANCE_TOO_LOW)
+        return
+
+    if loan_amount > bot_liquidity:
+        app.send(user_id, messages.LOAN_NO_LIQUIDITY)
+        return
+
+    interest = loan_amount * 0.25
+    total_to_repay = loan_amount + interest
+
+    transaction = build_transaction(user_id, 'loan', loan_amount)
+    await change_user_balance(app, user_id, loan_amount, transaction=transaction)
+    await app.storage.update_bot_liquidity(-loan_amount, 'loan')
+
+    current_time = get_current_time()
+    loan = {
+        'loan_id': generate_transaction_id(user_id),
+        'user_id': user_id,
+        'amount': loan_amount,
+        'interest': interest,
+        'total_to_repay': total_to_repay,
+        'remaining': total_to_repay,
+        'repaid': 0,
+        'paid': False,
+        'timestamp': current_time,
+        'due_date': current_time + LOAN_TERM,
+        'last_accrued': current_time
+    }
+    await app.storage.insert_loan(loan)
+    app.user_cache.invalidate(user_id)
+    app.send(user_id, messages.format_loan_approved(loan, transaction['transaction_id']), PRIORITY_TRANSACTIONAL, parse_mode='Markdown')
+
+async def show_active_loans(app, user_id):
+    loans = await app.storage.get_user_loans(user_id)
+    if not loans:
+        app.send(user_id, messages.NO_ACTIVE_LOANS)
+        return
+    for loan in loans:
+        app.send(user_id, messages.format_loan(loan), reply_markup=get_loan_keyboard(loan['loan_id']), parse_mode='Markdown')
+
+async def repay_loan_callback(app, user_id, data):
+    loan_id = data.split("_")[2]
+    if data.startswith("repay_part_"):
+        app.send(user_id, messages.ASK_REPAY_AMOUNT)
+        await app.conversations.set(user_id, 'repay_amount', {'loan_id': loan_id})
+    else:
+        await repay_loan(app, user_id, loan_id)
+
+async def process_repay_amount(app, user_id, text, loan_id):
+    try:
+        amount = parse_amount(text)
+        if amount < 0.01:
+            raise ValueError
+    except ValueError:
+        app.send(user_id, messages.BAD_AMOUNT)
+        return
+    await repay_loan(app, user_id, loan_id, amount)
+
+async def repay_loan(app, user_id, loan_id, amount=None):
+    # Without amount the whole remaining amount is repaid
+    status, repayment = await app.storage.repay_loan(loan_id, user_id, amount)
+    if status == 'not_found':
+        app.send(user_id, messages.LOAN_NOT_FOUND)
+        return
+    if status == 'insufficient_funds':
+        app.send(user_id, messages.REPAY_INSUFFICIENT)
+        return
+    app.user_cache.invalidate(user_id)
+    app.send(user_id, messages.format_repayment_receipt(repayment), PRIORITY_TRANSACTIONAL, parse_mode='Markdown')
+
+async def auto_repay_loans(app, user_id, amount):
+    # Sweeps an incoming transfer towards the user's open loans, oldest first
+    user = await get_user(app, user_id)
+    if not user or not user.get('auto_repay') or user.get('loan_due', 0) <= 0:
+        return
+    for loan in sorted(await app.storage.get_user_loans(user_id), key=lambda loan: loan['timestamp']):
+        if amount < 0.01:
+            break
+        status, repayment = await app.storage.repay_loan(loan['loan_id'], user_id, amount, auto=True)
+        if status == 'insufficient_funds':
+            break
+        if status == 'completed':
+            amount -= repayment['amount']
+            app.send(user_id, messages.format_repayment_receipt(repayment, auto=True), PRIORITY_TRANSACTIONAL, parse_mode='Markdown')
+    app.invalidate(user_id)
+
+# Status
+async def check_status(app, user_id):
+    telegram_start_time = time.time()
+    await app.api.get_me()
+    telegram_latency = (time.time() - telegram_start_time) * 1000
+
+    mongo_start_time = time.time()
+    await app.storage.ping()
+    mongo_latency = (time.time() - mongo_start_time) * 1000
+
+    now = get_current_time()
+    status_message = messages.format_status(telegram_latency, mongo_latency, now, now - app.started_at)
+    if app.status_lines:
+        status_message += app.status_lines()
+    status_message += messages.format_activity_status(
+        app.gift_window.pending(), app.user_cache.hit_ratio(), app.outbox.queue_depth(),
+        app.outbox.get_stats(), app.get_transfer_stats()
+    )
+    app.send(user_id, status_message)
+
+def register_handlers(bot, app):
+    # Same handlers on TeleBot and AsyncTeleBot: app.run executes the flow, or
+    # hands its coroutine to AsyncTeleBot to await
+    @bot.message_handler(commands=['start'])
+    def start_handler(message):
+        return app.run(start(app, message.from_user.id))
+
+    @bot.message_handler(commands=['balance_at'])
+    def balance_at_handler(message):
+        return app.run(balance_at(app, message.from_user.id, message.text))
+
+    @bot.message_handler(func=lambda message: True)
+    def message_handler(message):
+        return app.run(handle_message(app, message.from_user.id, message.text))
+
+    @bot.callback_query_handler(func=lambda call: True)
+    def callback_handler(call):
+        message_id = call.message.message_id if call.message else None
+        return app.run(handle_callback(app, call.from_user.id, call.id, call.data, message_id))
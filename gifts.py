@@ -0,0 +1,52 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from helpers import baghdad_tz
+
+class GiftWindow:
+    # Daily gift claims counted in memory per window of interval seconds, aligned
+    # to the epoch, and booked with one record_gift_window() write per window
+    # (total user balance counter and per-window claim counts) by flush(). A
+    # claim goes to the window of its ledger row's timestamp, so the windows
+    # split the ledger exactly. Shared by bot.py and async_bot.py.
+
+    def __init__(self, storage, interval):
+        self.storage = storage
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.windows = {}
+
+    def get_window_start(self, timestamp):
+        seconds = int(timestamp)
+        return datetime.fromtimestamp(seconds - seconds % self.interval, baghdad_tz)
+
+    def count(self, amount=None, timestamp=None):
+        # amount None counts a rejected claim
+        start = self.get_window_start(timestamp.timestamp() if timestamp else time.time())
+        with self.lock:
+            window = self.windows.setdefault(start, {'claims': 0, 'rejected': 0, 'amount': 0})
+            if amount is None:
+                window['rejected'] += 1
+            else:
+                window['claims'] += 1
+                window['amount'] += amount
+
+    def pending(self):
+        # Claims counted since the last flush
+        with self.lock:
+            return {
+                key: sum(window[key] for window in self.windows.values())
+                for key in ('claims', 'rejected', 'amount')
+            }
+
+    def pending_since(self):
+        # Start of the oldest window some process may not have booked yet: each
+        # one flushes every interval
+        return self.get_window_start(time.time()) - timedelta(seconds=2 * self.interval)
+
+    def flush(self):
+        with self.lock:
+            windows = self.windows
+            self.windows = {}
+        for start, window in sorted(windows.items()):
+            self.storage.record_gift_window(start, window['claims'], window['rejected'], window['amount'])
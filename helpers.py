@@ -0,0 +1,244 @@
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from bson import ObjectId
+from snowflake import SnowflakeGenerator
+from datetime import datetime, timedelta
+import math
+import pytz
+
+# Maximum number of liquidity changes stored in one hourly history bucket
+LIQUIDITY_BUCKET_SIZE = 1000
+
+# Latest ledger entries kept in the user document's recent array
+RECENT_ACTIVITY_SIZE = 10
+
+# Indexes created at startup: (collection, keys, unique)
+INDEXES = [
+    ('users', [('user_id', ASCENDING)], True),
+    ('transactions', [('user_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)], False),
+    ('transactions', [('timestamp', ASCENDING)], False),
+    ('transfer_requests', [('transfer_id', ASCENDING)], True),
+    ('loans', [('user_id', ASCENDING), ('paid', ASCENDING)], False),
+    ('loans', [('loan_id', ASCENDING)], True),
+    ('loans', [('paid', ASCENDING), ('_id', ASCENDING)], False),
+    ('loans', [('updated_at', ASCENDING)], False),
+    ('liquidity_history', [('hour', ASCENDING), ('count', ASCENDING)], False),
+    ('gift_windows', [('window', ASCENDING)], True),
+    ('journal', [('entry_id', ASCENDING)], True),
+    ('journal', [('legs.account', ASCENDING), ('timestamp', ASCENDING)], False),
+    ('journal', [('timestamp', ASCENDING)], False),
+    ('journal_snapshots', [('account', ASCENDING), ('timestamp', DESCENDING)], True),
+    ('statements', [('user_id', ASCENDING), ('month', ASCENDING)], True),
+    ('node_leases', [('expires_at', ASCENDING)], False),
+]
+
+# Baghdad timezone
+baghdad_tz = pytz.timezone('Asia/Baghdad')
+
+# Transaction, transfer and loan IDs; bot processes lease their node id at
+# startup unless NODE_ID is set
+id_generator = SnowflakeGenerator()
+
+def get_current_time():
+    return datetime.now(baghdad_tz)
+
+def as_utc(timestamp):
+    # MongoDB returns naive UTC datetimes
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=pytz.utc)
+    return timestamp.astimezone(pytz.utc)
+
+def generate_transaction_id(user_id, is_transfer=False):
+    # IQyy-<snowflake> or IQyy-<user_id>-<snowflake>, unique without a database check
+    if is_transfer:
+        return id_generator.next_transaction_id(user_id)
+    else:
+        return id_generator.next_transaction_id()
+
+def build_transaction(user_id, transaction_type, amount, details=None, transaction_id=None):
+    if not transaction_id:
+        transaction_id = generate_transaction_id(user_id)
+    return {
+        '_id': ObjectId(),
+        'transaction_id': transaction_id,
+        'user_id': user_id,
+        'type': transaction_type,
+        'amount': amount,
+        'timestamp': get_current_time(),
+        'details': details
+    }
+
+def build_recent_push(*transactions):
+    # $push appending ledger entries to the user's capped recent activity array
+    entries = [{key: value for key, value in transaction.items() if key != 'user_id'} for transaction in transactions]
+    return {'recent': {'$each': entries, '$slice': -RECENT_ACTIVITY_SIZE}}
+
+def build_liquidity_change(amount, reason, current_time):
+    # Filter and update appending one change to the current hourly bucket; a full
+    # bucket makes the upsert open a new one
+    hour = current_time.replace(minute=0, second=0, microsecond=0)
+    query = {'hour': hour, 'count': {'$lt': LIQUIDITY_BUCKET_SIZE}}
+    update = {
+        '$push': {
+            'changes': {
+                'amount': amount,
+                'reason': reason,
+                'timestamp': current_time
+            }
+        },
+        '$inc': {'count': 1, 'net': amount}
+    }
+    return query, update
+
+# Filters and updates shared by MongoStorage and AsyncMongoStorage, so both
+# runtimes write the same documents
+
+# Sum of all balances, the value of the total user balance counter
+TOTAL_BALANCE_PIPELINE = [{'$group': {'_id': None, 'total': {'$sum': '$balance'}}}]
+
+def build_balance_change(user_id, amount, min_balance=None, transaction=None):
+    # (filter, update, upsert) of an atomic balance change; with min_balance it
+    # only applies while balance >= min_balance and never creates the user
+    query = {'user_id': user_id}
+    if min_balance is not None:
+        query['balance'] = {'$gte': min_balance}
+    update = {'$inc': {'balance': amount}}
+    if transaction:
+        update['$push'] = build_recent_push(transaction)
+    return query, update, min_balance is None
+
+def build_gift_claim(user_id, amount, transaction, interval):
+    # (filter, update) adding the gift only when last_gift is missing or older
+    # than interval
+    current_time = transaction['timestamp']
+    query = {'user_id': user_id, '$or': [
+        {'last_gift': {'$exists': False}},
+        {'last_gift': {'$lte': current_time - interval}}
+    ]}
+    update = {'$inc': {'balance': amount}, '$set': {'last_gift': current_time}, '$push': build_recent_push(transaction)}
+    return query, update
+
+def build_stats_updates(liquidity, total):
+    # bot_stats writes adding to the bot's liquidity and the total user balance counter
+    return [
+        UpdateOne({'_id': 'liquidity'}, {'$inc': {'amount': liquidity}}, upsert=True),
+        UpdateOne({'_id': 'user_balances'}, {'$inc': {'total': total}}, upsert=True)
+    ]
+
+def build_transfer(transfer_request):
+    # (transfer_out, transfer_in, user writes) of a claimed transfer request; the
+    # debit only applies while balance >= amount + fee
+    transfer_id = transfer_request['transfer_id']
+    sender_id = transfer_request['sender_id']
+    recipient_id = transfer_request['recipient_id']
+    amount = transfer_request['amount']
+    total_amount = amount + transfer_request['fee']
+    transfer_out = build_transaction(sender_id, 'transfer_out', -total_amount,
+                                     {'recipient_id': recipient_id, 'transfer_id': transfer_id}, transfer_id)
+    transfer_in = build_transaction(recipient_id, 'transfer_in', amount,
+                                    {'sender_id': sender_id, 'transfer_id': transfer_id}, transfer_id)
+    user_updates = [
+        UpdateOne({'user_id': sender_id, 'balance': {'$gte': total_amount}},
+                  {'$inc': {'balance': -total_amount}, '$push': build_recent_push(transfer_out)}),
+        UpdateOne({'user_id': recipient_id},
+                  {'$inc': {'balance': amount}, '$push': build_recent_push(transfer_in)}, upsert=True)
+    ]
+    return transfer_out, transfer_in, user_updates
+
+def build_repayment(loan, user_id, amount=None, auto=False):
+    # (repaid, left, ledger row, user filter, user update) of a repayment, given
+    # the loan as it was before build_repayment_update() applied
+    repaid, left = split_repayment(loan['remaining'], amount)
+    transaction = build_transaction(user_id, 'loan_repayment', -repaid, {'loan_id': loan['loan_id'], 'auto': auto})
+    query = {'user_id': user_id, 'balance': {'$gte': repaid}}
+    update = {'$inc': {'balance': -repaid, 'loan_due': left - loan['remaining']}, '$push': build_recent_push(transaction)}
+    return repaid, left, transaction, query, update
+
+# A loan with less than this left to repay counts as paid
+LOAN_SETTLED_BELOW = 0.005
+
+def split_repayment(remaining, amount=None):
+    # (repaid, left to repay) of paying amount, or everything with None
+    repaid = remaining if amount is None else min(amount, remaining)
+    left = remaining - repaid
+    if left < LOAN_SETTLED_BELOW:
+        left = 0
+    return repaid, left
+
+def build_repayment_update(current_time, amount=None):
+    # Update pipeline applying split_repayment() to the loan document itself
+    repaid = '$remaining' if amount is None else {'$min': [amount, '$remaining']}
+    return [
+        {'$set': {
+            'updated_at': current_time,
+            'repaid': {'$add': [{'$ifNull': ['$repaid', 0]}, repaid]},
+            'remaining': {'$let': {
+                'vars': {'left': {'$subtract': ['$remaining', repaid]}},
+                'in': {'$cond': [{'$lt': ['$$left', LOAN_SETTLED_BELOW]}, 0, '$$left']}
+            }}
+        }},
+        {'$set': {'paid': {'$eq': ['$remaining', 0]}}}
+    ]
+
+# Transaction history pages: the cursor is (timestamp in microseconds since the epoch, _id)
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+def get_history_key(transaction):
+    timestamp = transaction['timestamp']
+    if timestamp.tzinfo is None:
+        # MongoDB returns naive UTC datetimes
+        timestamp = timestamp.replace(tzinfo=pytz.utc)
+    return (timestamp - EPOCH) // timedelta(microseconds=1), transaction['_id']
+
+def build_history_query(user_id, cursor=None, newer=False):
+    # Range on the (user_id, timestamp, _id) index strictly after the cursor
+    order = ASCENDING if newer else DESCENDING
+    query = {'user_id': user_id}
+    if cursor:
+        timestamp_us, transaction_id = cursor
+        timestamp = EPOCH + timedelta(microseconds=timestamp_us)
+        operator = '$gt' if newer else '$lt'
+        query['$or'] = [
+            {'timestamp': {operator: timestamp}},
+            {'timestamp': timestamp, '_id': {operator: transaction_id}}
+        ]
+    return query, [('timestamp', order), ('_id', order)]
+
+def build_statement_query(user_id, start, end, after=None):
+    # start <= timestamp < end on the same index, past the last row of the
+    # previous batch
+    query = {'user_id': user_id, 'timestamp': {'$gte': start, '$lt': end}}
+    if after:
+        query['$or'] = [
+            {'timestamp': {'$gt': after['timestamp']}},
+            {'timestamp': after['timestamp'], '_id': {'$gt': after['_id']}}
+        ]
+    return query, [('timestamp', ASCENDING), ('_id', ASCENDING)]
+
+def encode_history_callback(direction, page, transaction):
+    timestamp_us, transaction_id = get_history_key(transaction)
+    return f"hist:{direction}:{page}:{timestamp_us}:{transaction_id}"
+
+def decode_history_callback(data):
+    _, direction, page, timestamp_us, transaction_id = data.split(':')
+    return direction, int(page), (int(timestamp_us), ObjectId(transaction_id))
+
+def parse_balance_at_args(text):
+    # "/balance_at <user_id> <YYYY-MM-DD> [HH:MM]" in Baghdad time; a date alone
+    # means the end of that day. Raises ValueError on anything else.
+    parts = text.split()[1:]
+    if len(parts) not in (2, 3):
+        raise ValueError(text)
+    user_id = int(parts[0])
+    if len(parts) == 3:
+        at = datetime.strptime(f"{parts[1]} {parts[2]}", "%Y-%m-%d %H:%M")
+    else:
+        at = datetime.strptime(parts[1], "%Y-%m-%d") + timedelta(days=1, microseconds=-1)
+    return user_id, baghdad_tz.localize(at)
+
+def parse_amount(text):
+    # float() also accepts "nan" and "inf", which pass every amount comparison
+    # below; raises ValueError on them like on any other bad amount
+    amount = float(text)
+    if not math.isfinite(amount):
+        raise ValueError(text)
+    return amount
@@ -0,0 +1,266 @@
+import argparse
+import itertools
+import os
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from helpers import get_current_time, as_utc
+
+# Double-entry journal: every movement of money is one append-only entry whose
+# legs add up to zero, e.g. a transfer debits the sender and credits the
+# recipient and the bot's liquidity with the fee. Entries are never updated or
+# deleted. Accounts are user:<user_id> and the bot's own accounts below.
+#
+# Balances come from per-account snapshots plus the legs posted after them, so
+# reading one costs a snapshot and the recent legs instead of the whole history.
+# Snapshots are taken periodically for the accounts that changed since the last
+# run; bot.py does it every JOURNAL_SNAPSHOT_INTERVAL seconds. They are kept, so
+# the balance at any earlier time is the last snapshot before it plus the legs
+# up to it: at most one snapshot interval of legs.
+#
+#   python journal.py                        take snapshots
+#   python journal.py --opening              post opening balances (once, with every bot process stopped)
+#   python journal.py --balance user:123     print an account balance
+#   python journal.py --balance user:123 --at 2024-05-01T12:00+03:00
+
+# The bot's liquidity: slots results, loans, repayments and transfer fees
+LIQUIDITY_ACCOUNT = 'bot:liquidity'
+
+# Where daily gifts come from; they do not touch the liquidity
+GIFTS_ACCOUNT = 'bot:gifts'
+
+# Counterpart of the balances that existed before the journal
+OPENING_ACCOUNT = 'bot:opening'
+
+# Account on the other side of each single-user ledger row
+COUNTER_ACCOUNTS = {
+    'daily_gift': GIFTS_ACCOUNT,
+    'slots_win': LIQUIDITY_ACCOUNT,
+    'slots_loss': LIQUIDITY_ACCOUNT,
+    'loan': LIQUIDITY_ACCOUNT,
+    'loan_repayment': LIQUIDITY_ACCOUNT
+}
+
+# Legs summing to less than this count as balanced (float rounding)
+BALANCE_TOLERANCE = 1e-9
+
+# Snapshots cover entries up to this long before the run starts; an entry is
+# written right after its timestamp is taken, so none lands behind a snapshot
+SNAPSHOT_LAG = timedelta(minutes=1)
+
+# bot_stats documents holding the progress of the jobs
+SNAPSHOT_CHECKPOINT = 'journal_snapshots'
+OPENING_CHECKPOINT = 'journal_opening'
+
+def user_account(user_id):
+    return f"user:{user_id}"
+
+def build_entry(entry_id, entry_type, timestamp, legs):
+    # legs: [(account, amount)]; refuses entries that do not balance
+    if abs(sum(amount for _, amount in legs)) > BALANCE_TOLERANCE:
+        raise ValueError(f"Journal entry {entry_id} does not balance: {legs}")
+    return {
+        '_id': ObjectId(),
+        'entry_id': entry_id,
+        'type': entry_type,
+        'timestamp': timestamp,
+        'legs': [{'account': account, 'amount': amount} for account, amount in legs]
+    }
+
+def build_transaction_entry(transaction):
+    # Entry of a single-user ledger row against its counter account
+    counter_account = COUNTER_ACCOUNTS.get(transaction['type'])
+    if not counter_account:
+        raise ValueError(f"No journal account for {transaction['type']} transactions")
+    amount = transaction['amount']
+    return build_entry(transaction['transaction_id'], transaction['type'], transaction['timestamp'], [
+        (user_account(transaction['user_id']), amount),
+        (counter_account, -amount)
+    ])
+
+def build_transfer_entry(transfer_out, transfer_in):
+    # One entry for both sides of a transfer; what the sender pays on top of
+    # what the recipient gets is the fee
+    fee = -transfer_out['amount'] - transfer_in['amount']
+    return build_entry(transfer_out['transaction_id'], 'transfer', transfer_out['timestamp'], [
+        (user_account(transfer_out['user_id']), transfer_out['amount']),
+        (user_account(transfer_in['user_id']), transfer_in['amount']),
+        (LIQUIDITY_ACCOUNT, fee)
+    ])
+
+def build_leg_sum_pipeline(account, after=None, until=None):
+    # Sum of the account's legs with after < timestamp <= until, read through
+    # the (legs.account, timestamp) index
+    match = {'legs.account': account}
+    timestamp = {}
+    if after is not None:
+        timestamp['$gt'] = after
+    if until is not None:
+        timestamp['$lte'] = until
+    if timestamp:
+        match['timestamp'] = timestamp
+    return [
+        {'$match': match},
+        {'$unwind': '$legs'},
+        {'$match': {'legs.account': account}},
+        {'$group': {'_id': None, 'total': {'$sum': '$legs.amount'}}}
+    ]
+
+def get_balance(storage, account, at=None):
+    # Latest snapshot at or before at (now with None) plus the legs after it
+    snapshot = storage.get_latest_snapshot(account, at)
+    if not snapshot:
+        return storage.sum_account_legs(account, until=at)
+    return snapshot['balance'] + storage.sum_account_legs(account, after=snapshot['timestamp'], until=at)
+
+def get_opened_at(checkpoint):
+    # Start of a finished journal opening, from its checkpoint
+    if not checkpoint or not checkpoint.get('finished_at'):
+        return None
+    return checkpoint['started_at']
+
+def is_running(checkpoint):
+    checkpoint = checkpoint or {}
+    return bool(checkpoint.get('started_at')) and not checkpoint.get('finished_at')
+
+def is_opening_running(storage):
+    # True from the start of post_opening_balances until it finishes; bot
+    # processes refuse to start meanwhile
+    return is_running(storage.get_checkpoint(OPENING_CHECKPOINT))
+
+async def get_user_balance_at(storage, user_id, at):
+    # The user's balance at at, or None before the journal was opened. Same
+    # reads as get_balance, awaited so that both runtimes run it from flows.py
+    opened_at = get_opened_at(await storage.get_checkpoint(OPENING_CHECKPOINT))
+    if opened_at is None or as_utc(at) < as_utc(opened_at):
+        return None
+    account = user_account(user_id)
+    snapshot = await storage.get_latest_snapshot(account, at)
+    if not snapshot:
+        return await storage.sum_account_legs(account, until=at)
+    return snapshot['balance'] + await storage.sum_account_legs(account, after=snapshot['timestamp'], until=at)
+
+def build_opening_entry(entry_id, account, balance, posted, timestamp):
+    # posted: {account: sum of the legs already in the journal}
+    amount = balance - posted.get(account, 0)
+    return build_entry(entry_id, 'opening', timestamp, [
+        (account, amount),
+        (OPENING_ACCOUNT, -amount)
+    ])
+
+def post_opening_balances(storage, batch_size=1000):
+    # Opens the journal with the balances and liquidity that existed before it.
+    # A one-off step for when no bot process is running: a balance read while a
+    # bot moves money can miss or repeat that movement. Each opening leg is the
+    # balance less the legs the account already has, so entries posted before
+    # the journal was opened are not counted twice. Entry ids are derived from
+    # the account, so resuming an interrupted run posts nothing twice.
+    checkpoint = storage.get_checkpoint(OPENING_CHECKPOINT) or {}
+    if checkpoint.get('finished_at'):
+        return checkpoint
+    if checkpoint.get('started_at'):
+        state = checkpoint
+    else:
+        state = {'started_at': get_current_time(), 'finished_at': None, 'last_user_id': None, 'accounts': 0}
+    # Marked as running before looking for bots: one starting now sees the mark
+    # after taking its lease, so either it or this run stops
+    storage.save_checkpoint(OPENING_CHECKPOINT, state)
+    running = storage.count_node_leases()
+    if running:
+        storage.save_checkpoint(OPENING_CHECKPOINT, checkpoint)
+        raise RuntimeError(f"{running} bot processes are running; stop them before opening the journal")
+    timestamp = state['started_at']
+
+    balances = iter(storage.iter_user_balances(state['last_user_id'], batch_size=batch_size))
+    while True:
+        batch = list(itertools.islice(balances, batch_size))
+        if not batch:
+            break
+        posted = storage.sum_accounts_legs([user_account(row['user_id']) for row in batch])
+        storage.post_journal_entries([
+            build_opening_entry(f"opening:{row['user_id']}", user_account(row['user_id']), row.get('balance', 0), posted, timestamp)
+            for row in batch
+        ])
+        state['last_user_id'] = batch[-1]['user_id']
+        state['accounts'] += len(batch)
+        storage.save_checkpoint(OPENING_CHECKPOINT, state)
+
+    posted = storage.sum_accounts_legs([LIQUIDITY_ACCOUNT])
+    storage.post_journal_entries([build_opening_entry(
+        f"opening:{LIQUIDITY_ACCOUNT}", LIQUIDITY_ACCOUNT, storage.get_bot_liquidity(), posted, timestamp
+    )])
+    state['accounts'] += 1
+    state['finished_at'] = get_current_time()
+    storage.save_checkpoint(OPENING_CHECKPOINT, state)
+    print(f"Journal opened with {state['accounts']} account balances")
+    return state
+
+def take_snapshots(storage, batch_size=1000):
+    # Snapshots as of cutoff for every account with legs since the previous
+    # cutoff. Each run only reads the legs of its own window; an interrupted run
+    # resumes after the last account it snapshotted.
+    checkpoint = storage.get_checkpoint(SNAPSHOT_CHECKPOINT) or {}
+    if checkpoint.get('cutoff') and not checkpoint.get('finished_at'):
+        state = checkpoint
+        print(f"Resuming journal snapshots after {state['last_account']}")
+    else:
+        state = {
+            'since': checkpoint.get('cutoff'),
+            'cutoff': get_current_time() - SNAPSHOT_LAG,
+            'last_account': None,
+            'snapshots': 0,
+            'started_at': get_current_time(),
+            'finished_at': None
+        }
+    storage.save_checkpoint(SNAPSHOT_CHECKPOINT, state)
+
+    start = time.perf_counter()
+    snapshots_before = state['snapshots']
+    deltas = iter(storage.iter_account_deltas(state['since'], state['cutoff'], state['last_account'], batch_size))
+    while True:
+        batch = list(itertools.islice(deltas, batch_size))
+        if not batch:
+            break
+        previous = storage.get_latest_snapshots([row['_id'] for row in batch], before=state['cutoff'])
+        storage.insert_snapshots([
+            {
+                'account': row['_id'],
+                'timestamp': state['cutoff'],
+                'balance': previous.get(row['_id'], {}).get('balance', 0) + row['delta'],
+                'legs': previous.get(row['_id'], {}).get('legs', 0) + row['legs']
+            }
+            for row in batch
+        ])
+        state['last_account'] = batch[-1]['_id']
+        state['snapshots'] += len(batch)
+        storage.save_checkpoint(SNAPSHOT_CHECKPOINT, state)
+
+    elapsed = time.perf_counter() - start
+    state['finished_at'] = get_current_time()
+    storage.save_checkpoint(SNAPSHOT_CHECKPOINT, state)
+    count = state['snapshots'] - snapshots_before
+    print(f"Journal snapshots: {count} accounts in {elapsed:.2f}s")
+    return {'snapshots': count, 'elapsed': elapsed}
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot journal balances, open the journal or read a balance")
+    parser.add_argument('--opening', action='store_true', help="post the opening balances")
+    parser.add_argument('--balance', metavar='ACCOUNT', help="print the balance of an account, e.g. user:123")
+    parser.add_argument('--at', type=datetime.fromisoformat, help="with --balance: ISO time to read it at (default now)")
+    parser.add_argument('--batch-size', type=int, default=1000, help="accounts per batch")
+    args = parser.parse_args()
+
+    from storage import MongoStorage
+    storage = MongoStorage(f"mongodb+srv://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_CLUSTER')}/")
+    if args.balance:
+        print(f"{args.balance}: ${get_balance(storage, args.balance, args.at):,.2f}")
+    elif args.opening:
+        try:
+            post_opening_balances(storage, args.batch_size)
+        except RuntimeError as e:
+            raise SystemExit(str(e))
+    else:
+        take_snapshots(storage, args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+import argparse
+import json
+import os
+import queue
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# End-to-end load test: runs bot.py against a local stand-in for api.telegram.org
+# and drives it with synthetic users.
+#
+#   python loadtest.py --users 200 --duration 60 --mix balance=4,transfer=2,slots=3,loan=1,start=1
+#
+# Uses the in-memory storage backend unless --storage mongo is given (then the
+# usual DB_USER/DB_PASS/DB_CLUSTER variables apply).
+
+TOKEN = '123456:LOADTEST'
+
+# Sent to the recipient of a transfer while they may be waiting for their own reply
+TRANSFER_NOTIFICATION = "💰 لقد استلمت تحويلاً"
+
+DEFAULT_MIX = 'start=1,balance=4,transfer=2,slots=3,loan=1'
+
+class FakeTelegram:
+    def __init__(self):
+        self.updates = []
+        self.updates_condition = threading.Condition()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.inboxes = {}
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def inbox(self, chat_id):
+        with self.lock:
+            if chat_id not in self.inboxes:
+                self.inboxes[chat_id] = queue.Queue()
+            return self.inboxes[chat_id]
+
+    def push_update(self, update):
+        with self.updates_condition:
+            update['update_id'] = self.next_update_id
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.updates_condition.notify_all()
+
+    def get_updates(self, params):
+        timeout = float(params.get('timeout', 0))
+        limit = int(params.get('limit', 100))
+        with self.updates_condition:
+            if not self.updates:
+                self.updates_condition.wait(timeout)
+            updates, self.updates = self.updates[:limit], self.updates[limit:]
+        return updates
+
+    def send_message(self, params):
+        chat_id = int(params['chat_id'])
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', '')
+        }
+        reply_markup = json.loads(params['reply_markup']) if params.get('reply_markup') else None
+        self.inbox(chat_id).put((time.perf_counter(), message['text'], reply_markup))
+        return message
+
+    def handle(self, method, params):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return self.get_updates(params)
+        if method == 'sendMessage':
+            return self.send_message(params)
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+        return True
+
+def make_handler(telegram):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.respond()
+
+        def do_POST(self):
+            self.respond()
+
+        def respond(self):
+            url = urlparse(self.path)
+            method = url.path.rsplit('/', 1)[-1]
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                self.rfile.read(length)
+            body = json.dumps({'ok': True, 'result': telegram.handle(method, params)}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+class SimulatedUser:
+    def __init__(self, user_id, telegram, results, timeout):
+        self.user_id = user_id
+        self.telegram = telegram
+        self.inbox = telegram.inbox(user_id)
+        self.results = results
+        self.timeout = timeout
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+        self.chat = {'id': user_id, 'type': 'private'}
+
+    def send_text(self, text):
+        self.telegram.push_update({'message': {
+            'message_id': random.randint(1, 2 ** 31),
+            'date': int(time.time()),
+            'chat': self.chat,
+            'from': self.user,
+            'text': text
+        }})
+
+    def press(self, data):
+        self.telegram.push_update({'callback_query': {
+            'id': str(random.randint(1, 2 ** 31)),
+            'chat_instance': str(self.user_id),
+            'from': self.user,
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': self.chat, 'text': ''},
+            'data': data
+        }})
+
+    def step(self, name, action, wait_for=None):
+        # Run one interaction and wait for the bot's reply (or the reply matching wait_for)
+        start = time.perf_counter()
+        action()
+        first_reply = None
+        while True:
+            try:
+                received_at, text, reply_markup = self.inbox.get(timeout=self.timeout)
+            except queue.Empty:
+                self.results.record_timeout(name)
+                return None, None
+            if text.startswith(TRANSFER_NOTIFICATION):
+                continue
+            if first_reply is None:
+                first_reply = received_at
+                self.results.record(name, received_at - start)
+            if wait_for is None or wait_for(text, reply_markup):
+                return text, reply_markup
+
+    def run_start(self):
+        self.step('start', lambda: self.send_text('/start'))
+
+    def run_balance(self):
+        self.step('balance', lambda: self.send_text('💰 رصيدي'))
+
+    def run_transfer(self, recipient_id):
+        self.step('transfer_start', lambda: self.send_text('💸 تحويل'))
+        self.step('transfer_recipient', lambda: self.send_text(str(recipient_id)))
+        amount = f"{random.uniform(0.01, 2):.2f}"
+        _, reply_markup = self.step('transfer_amount', lambda: self.send_text(amount))
+        if not reply_markup:
+            return
+        confirm = reply_markup['inline_keyboard'][0][0]['callback_data']
+        self.step('transfer_confirm', lambda: self.press(confirm))
+
+    def run_slots(self):
+        self.step('slots_start', lambda: self.press('play_slots'))
+        bet = str(random.choice([5, 10, 20]))
+        _, reply_markup = self.step('slots_spin', lambda: self.send_text(bet),
+                                    wait_for=lambda text, markup: markup is not None or 'غير كافٍ' in text)
+        if reply_markup:
+            self.step('slots_end', lambda: self.press('end_slots'))
+
+    def run_loan(self):
+        self.step('loan_options', lambda: self.press('loan_options'))
+        text, _ = self.step('loan_request', lambda: self.press('loan_5'))
+        if text and text.startswith('✅'):
+            _, reply_markup = self.step('loan_list', lambda: self.press('repay_loan'))
+            if reply_markup:
+                repay = reply_markup['inline_keyboard'][0][0]['callback_data']
+                self.step('loan_repay', lambda: self.press(repay))
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.timeouts = {}
+        self.flows = 0
+
+    def record(self, name, latency):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(latency)
+
+    def record_timeout(self, name):
+        with self.lock:
+            self.timeouts[name] = self.timeouts.get(name, 0) + 1
+
+    def record_flow(self):
+        with self.lock:
+            self.flows += 1
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, weight = part.split('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+def run_user(simulated_user, user_ids, weights, deadline, results):
+    flows = list(weights)
+    flow_weights = [weights[flow] for flow in flows]
+    simulated_user.run_start()
+    while time.time() < deadline:
+        flow = random.choices(flows, flow_weights)[0]
+        if flow == 'start':
+            simulated_user.run_start()
+        elif flow == 'balance':
+            simulated_user.run_balance()
+        elif flow == 'transfer':
+            recipient_id = random.choice(user_ids)
+            while recipient_id == simulated_user.user_id:
+                recipient_id = random.choice(user_ids)
+            simulated_user.run_transfer(recipient_id)
+        elif flow == 'slots':
+            simulated_user.run_slots()
+        elif flow == 'loan':
+            simulated_user.run_loan()
+        results.record_flow()
+
+def print_report(results, elapsed, op_counts, telegram_calls, bot_module):
+    all_latencies = [latency for values in results.latencies.values() for latency in values]
+    print(f"\nDuration: {elapsed:.1f} s, flows: {results.flows}, handler replies: {len(all_latencies)}")
+    print(f"Throughput: {len(all_latencies) / elapsed:.1f} replies/s, {results.flows / elapsed:.1f} flows/s")
+    print(f"\n{'step':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'timeouts':>10}")
+    for name in sorted(results.latencies):
+        values = results.latencies[name]
+        print(f"{name:<20}{len(values):>8}{percentile(values, 0.5) * 1000:>10.2f}"
+              f"{percentile(values, 0.95) * 1000:>10.2f}{percentile(values, 0.99) * 1000:>10.2f}"
+              f"{results.timeouts.get(name, 0):>10}")
+    print(f"{'all':<20}{len(all_latencies):>8}{percentile(all_latencies, 0.5) * 1000:>10.2f}"
+          f"{percentile(all_latencies, 0.95) * 1000:>10.2f}{percentile(all_latencies, 0.99) * 1000:>10.2f}"
+          f"{sum(results.timeouts.values()):>10}")
+
+    total_ops = sum(op_counts.values())
+    print(f"\nStorage operations: {total_ops} ({total_ops / max(results.flows, 1):.1f} per flow)")
+    for name, count in sorted(op_counts.items(), key=lambda item: -item[1]):
+        print(f"  {name:<30}{count:>10}")
+    print("\nTelegram API calls:")
+    for name, count in sorted(telegram_calls.items(), key=lambda item: -item[1]):
+        print(f"  {name:<30}{count:>10}")
+    print(f"\nTransfers: {bot_module.app.get_transfer_stats()['count']}, user cache hit ratio: {bot_module.user_cache.hit_ratio() * 100:.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test bot.py against a fake Telegram Bot API server")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="flow weights, e.g. " + DEFAULT_MIX)
+    parser.add_argument('--initial-balance', type=float, default=100)
+    parser.add_argument('--initial-liquidity', type=float, default=100000)
+    parser.add_argument('--storage', default='memory', choices=['memory', 'mongo'])
+    parser.add_argument('--workers', type=int, default=8, help="dispatcher worker threads")
+    parser.add_argument('--timeout', type=float, default=10, help="seconds to wait for a reply")
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--send-rate', type=float, default=100000, help="bot-wide outgoing messages per second")
+    parser.add_argument('--chat-rate', type=float, default=100000, help="outgoing messages per second per chat")
+    args = parser.parse_args()
+
+    telegram = FakeTelegram()
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(telegram))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    os.environ['TOKEN'] = TOKEN
+    os.environ['STORAGE_BACKEND'] = args.storage
+    os.environ['WORKERS'] = str(args.workers)
+    # Telegram's real limits would make the outbox the bottleneck of the test
+    os.environ['SEND_RATE_GLOBAL'] = str(args.send_rate)
+    os.environ['SEND_RATE_PER_CHAT'] = str(args.chat_rate)
+    os.environ['SEND_BURST_PER_CHAT'] = str(max(3, int(args.chat_rate)))
+
+    from telebot import apihelper
+    apihelper.API_URL = f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+
+    import bot
+
+    user_ids = list(range(1000001, 1000001 + args.users))
+    bot.storage.get_bot_liquidity()
+    bot.storage.update_bot_liquidity(args.initial_liquidity, 'loadtest')
+    for user_id in user_ids:
+        bot.storage.change_user_balance(user_id, args.initial_balance)
+
+    threading.Thread(target=bot.poll_updates, daemon=True).start()
+
+    results = Results()
+    weights = parse_mix(args.mix)
+    ops_before = bot.storage.op_counts()
+    start = time.time()
+    deadline = start + args.duration
+    threads = []
+    for user_id in user_ids:
+        simulated_user = SimulatedUser(user_id, telegram, results, args.timeout)
+        thread = threading.Thread(target=run_user, args=(simulated_user, user_ids, weights, deadline, results), daemon=True)
+        thread.start()
+        threads.append(thread)
+    print(f"Running {args.users} users for {args.duration:.0f} s ({args.storage} storage, {args.workers} workers)...")
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    ops_after = bot.storage.op_counts()
+    op_counts = {name: count - ops_before.get(name, 0) for name, count in ops_after.items() if count - ops_before.get(name, 0)}
+    print_report(results, elapsed, op_counts, telegram.calls, bot)
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+from telebot.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from slots import MIN_BET, MAX_BET
+from helpers import encode_history_callback
+
+# Texts and keyboards the bot sends, shared by both runtimes through flows.py
+
+WELCOME = "👋 مرحبًا بك في البوت البنكي! يمكنك استخدام الأزرار أدناه للتحكم."
+UNKNOWN_COMMAND = "عذرًا، لم أفهم هذا الأمر. يرجى استخدام الأزرار المتاحة."
+BALANCE_AT_USAGE = "الاستخدام: /balance_at <رقم المستخدم> <YYYY-MM-DD> [HH:MM]"
+BEFORE_JOURNAL = "⚠️ هذا الوقت قبل بدء السجل المحاسبي، لا يمكن معرفة الرصيد فيه."
+NO_HISTORY = "📭 لا توجد عمليات سابقة."
+CHOOSE_STATEMENT_MONTH = "اختر الشهر لإرسال كشف الحساب كملف:"
+ASK_RECIPIENT = "🔢 أدخل رقم حساب المستلم (معرف المستخدم):"
+BAD_RECIPIENT = "❌ رقم الحساب غير صحيح. يرجى إدخال رقم صحيح."
+SELF_TRANSFER = "❌ لا يمكنك التحويل لنفسك. يرجى إدخال رقم حساب آخر."
+ASK_TRANSFER_AMOUNT = "💲 أدخل المبلغ المراد تحويله (الحد الأدنى 0.01$):"
+BAD_AMOUNT = "❌ مبلغ غير صحيح. يرجى إدخال رقم أكبر من 0.01$."
+BELOW_MIN_TRANSFER = "❌ الحد الأدنى للتحويل هو 0.01$."
+TRANSFER_INSUFFICIENT = "❌ رصيدك غير كافٍ لإتمام هذه العملية."
+TRANSFER_NOT_FOUND = "❌ عملية التحويل غير صالحة أو منتهية الصلاحية."
+TRANSFER_CONFIRMED = "✅ تم تأكيد عملية التحويل."
+TRANSFER_CANCELLED = "❌ تم إلغاء عملية التحويل."
+CHOOSE_OTHER_OPTION = "اختر إحدى الخيارات التالية:"
+GIFT_ALREADY_CLAIMED = "⏳ لقد حصلت بالفعل على هديتك اليومية. يرجى المحاولة غدًا."
+ASK_BET = f"أدخل مبلغ الرهان (من {MIN_BET}$ إلى {MAX_BET}$):"
+BET_OUT_OF_RANGE = f"المبلغ يجب أن يكون بين {MIN_BET}$ و {MAX_BET}$. حاول مرة أخرى."
+BAD_BET = "الرجاء إدخال رقم صحيح. حاول مرة أخرى."
+SLOTS_INSUFFICIENT = "رصيدك غير كافٍ للعب بهذا المبلغ."
+PLAY_AGAIN = "هل تريد اللعب مرة أخرى؟"
+THANKS_FOR_PLAYING = "شكرًا للعب! يمكنك العودة إلى القائمة الرئيسية."
+CHOOSE_LOAN_OPTION = "اختر أحد الخيارات:"
+AUTO_REPAY_ON = "🔁 تم تفعيل السداد التلقائي. ستُستخدم التحويلات الواردة لسداد قروضك القائمة."
+AUTO_REPAY_OFF = "تم إيقاف السداد التلقائي."
+CHOOSE_LOAN_AMOUNT = "اختر مبلغ القرض:"
+LOAN_EXISTS = "عذرًا، لديك قرض قائم بالفعل. يجب سداده قبل طلب قرض جديد."
+LOAN_BALANCE_TOO_LOW = "عذرًا، رصيدك غير كافٍ للحصول على هذا القرض. يجب أن يكون لديك 90% على الأقل من مبلغ القرض."
+LOAN_NO_LIQUIDITY = "عذرًا، لا تتوفر سيولة كافية في البوت حاليًا لمنح هذا القرض."
+NO_ACTIVE_LOANS = "ليس لديك قروض نشطة حاليًا."
+ASK_REPAY_AMOUNT = "أدخل المبلغ الذي تريد سداده:"
+LOAN_NOT_FOUND = "عذرًا، لم يتم العثور على القرض المحدد."
+REPAY_INSUFFICIENT = "عذرًا، رصيدك غير كافٍ لسداد هذا القرض."
+
+# Keyboard markup
+MAIN_MENU_BUTTONS = ['💰 رصيدي', '📜 العمليات السابقة', '🏦 سيولة البوت', '💸 تحويل', '🎮 أخرى']
+
+def get_main_keyboard():
+    keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
+    keyboard.row(KeyboardButton('💰 رصيدي'), KeyboardButton('📜 العمليات السابقة'))
+    keyboard.row(KeyboardButton('🏦 سيولة البوت'), KeyboardButton('💸 تحويل'))
+    keyboard.row(KeyboardButton('🎮 أخرى'))
+    return keyboard
+
+def get_history_keyboard(transactions, page, has_newer, has_older):
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton("◀️ الأحدث", callback_data=encode_history_callback('p', page - 1, transactions[0])))
+    if has_older:
+        buttons.append(InlineKeyboardButton("الأقدم ▶️", callback_data=encode_history_callback('n', page + 1, transactions[-1])))
+    if not buttons:
+        return None
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(*buttons)
+    return keyboard
+
+def get_statement_months_keyboard(months):
+    keyboard = InlineKeyboardMarkup()
+    for i in range(0, len(months), 2):
+        keyboard.row(*[InlineKeyboardButton(f"📄 {month}", callback_data=f"statement:{month}") for month in months[i:i + 2]])
+    return keyboard
+
+def get_liquidity_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("📊 الحالة", callback_data="check_status"))
+    return keyboard
+
+def get_transfer_keyboard(transfer_id):
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("✅ تأكيد", callback_data=f"confirm_transfer:{transfer_id}"),
+                 InlineKeyboardButton("❌ إلغاء", callback_data=f"cancel_transfer:{transfer_id}"))
+    return keyboard
+
+def get_other_options_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("🎁 الهدية اليومية", callback_data="daily_gift"),
+                 InlineKeyboardButton("🎰 لعبة Slots", callback_data="play_slots"))
+    keyboard.row(InlineKeyboardButton("💸 القرض", callback_data="loan_options"),
+                 InlineKeyboardButton("📄 كشف الحساب", callback_data="statements"))
+    return keyboard
+
+def get_play_again_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("نعم", callback_data="play_slots_again"),
+                 InlineKeyboardButton("لا", callback_data="end_slots"))
+    return keyboard
+
+def get_loan_options_keyboard(auto_repay):
+    auto_repay = "مفعل ✅" if auto_repay else "معطل ❌"
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("طلب قرض", callback_data="request_loan"),
+                 InlineKeyboardButton("سداد قرض", callback_data="repay_loan"))
+    keyboard.row(InlineKeyboardButton(f"🔁 السداد التلقائي: {auto_repay}", callback_data="auto_repay"))
+    return keyboard
+
+def get_loan_amounts_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("$5", callback_data="loan_5"),
+                 InlineKeyboardButton("$25", callback_data="loan_25"),
+                 InlineKeyboardButton("$100", callback_data="loan_100"))
+    return keyboard
+
+def get_loan_keyboard(loan_id):
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("سداد القرض", callback_data=f"repay_loan_{loan_id}"),
+                 InlineKeyboardButton("سداد جزئي", callback_data=f"repay_part_{loan_id}"))
+    return keyboard
+
+# Message formatting
+def format_uptime(uptime):
+    days, remainder = divmod(uptime.total_seconds(), 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, _ = divmod(remainder, 60)
+    return f"{int(days)} يوم, {int(hours)} ساعة, {int(minutes)} دقيقة"
+
+def format_balance(user_id, balance, loan_due):
+    total_loan = round(loan_due, 2)
+    response = f"💰 رصيدك الحالي: ${balance:.2f}\n"
+    if total_loan > 0:
+        response += f"💸 إجمالي القروض المستحقة: ${total_loan:.2f}\n"
+    response += f"🆔 رقم حسابك (معرف المستخدم): `{user_id}`"
+    return response
+
+def format_balance_at(user_id, at, balance):
+    return f"💰 رصيد المستخدم {user_id} في {at.strftime('%Y-%m-%d %H:%M')}: ${balance:.2f}"
+
+def format_transaction_history(transactions, page=1):
+    history = f"📜 العمليات السابقة - صفحة {page}:\n\n"
+    for transaction in transactions:
+        date = transaction['timestamp'].strftime("%H:%M:%S %d/%m/%Y")
+        transaction_id = transaction['transaction_id']
+        if transaction['type'] == 'transfer_out':
+            history += f"🔸 {date}: تحويل ${transaction['amount']:.2f} إلى {transaction['details']['recipient_id']}\n   🆔 رقم العملية: `{transaction_id}`\n\n"
+        elif transaction['type'] == 'transfer_in':
+            history += f"🔹 {date}: استلام ${transaction['amount']:.2f} من {transaction['details']['sender_id']}\n   🆔 رقم العملية: `{transaction_id}`\n\n"
+        elif transaction['type'] == 'daily_gift':
+            history += f"🎁 {date}: هدية يومية ${transaction['amount']:.2f}\n   🆔 رقم العملية: `{transaction_id}`\n\n"
+        elif transaction['type'] in ['slots_win', 'slots_loss']:
+            action = "ربح" if transaction['type'] == 'slots_win' else "خسارة"
+            history += f"🎰 {date}: {action} في Slots ${abs(transaction['amount']):.2f}\n   🆔 رقم العملية: `{transaction_id}`\n\n"
+        elif transaction['type'] == 'loan':
+            history += f"💸 {date}: قرض ${transaction['amount']:.2f}\n   🆔 رقم العملية: `{transaction_id}`\n\n"
+        elif transaction['type'] == 'loan_repayment':
+            history += f"💰 {date}: سداد قرض ${transaction['amount']:.2f}\n   🆔 رقم العملية: `{transaction_id}`\n\n"
+    return history
+
+def format_statement_caption(month):
+    return f"📄 كشف الحساب لشهر {month}"
+
+def format_empty_statement(month):
+    return f"📭 لا توجد عمليات في شهر {month}."
+
+def format_liquidity(liquidity, total_user_balance):
+    return (
+        f"🏦 سيولة البوت الحالية: ${liquidity:.2f}\n"
+        f"💰 إجمالي أرصدة المستخدمين: ${total_user_balance:.2f}\n"
+    )
+
+def format_transfer_confirmation(amount, fee, recipient_id, transfer_id):
+    return f"📝 تأكيد التحويل:\nالمبلغ: ${amount:.2f}\nالرسوم: ${fee:.2f}\nالإجمالي: ${amount + fee:.2f}\nالمستلم: {recipient_id}\n\n🆔 رقم العملية: `{transfer_id}`"
+
+def format_transfer_sent(amount, fee, transfer_id):
+    return f"✅ تم التحويل بنجاح. المبلغ: ${amount:.2f}, الرسوم: ${fee:.2f}\n🆔 رقم العملية: `{transfer_id}`"
+
+def format_transfer_received(amount, transfer_id):
+    return f"💰 لقد استلمت تحويلاً بقيمة ${amount:.2f}\n🆔 رقم العملية: `{transfer_id}`"
+
+def format_daily_gift(amount, balance, transaction_id):
+    return (
+        f"🎉 مبروك! لقد حصلت على هدية يومية بقيمة ${amount:.3f}\n"
+        f"💰 رصيدك الجديد: ${balance:.2f}\n"
+        f"🆔 رقم العملية: `{transaction_id}`"
+    )
+
+def format_slots_win(result, winnings, balance, transaction_id):
+    return (
+        f"🎰 نتيجة اللعبة: {''.join(result)}\n"
+        f"🎉 مبروك! لقد ربحت في لعبة Slots!\n"
+        f"💰 المبلغ: ${winnings:.2f}\n"
+        f"💳 رصيدك الجديد: ${balance:.2f}\n"
+        f"🆔 رقم العملية: `{transaction_id}`"
+    )
+
+def format_slots_loss(result, bet_amount, balance, transaction_id):
+    return (
+        f"🎰 نتيجة اللعبة: {''.join(result)}\n"
+        f"😢 للأسف، لم تربح هذه المرة في لعبة Slots.\n"
+        f"💸 خسرت: ${bet_amount:.2f}\n"
+        f"💳 رصيدك الجديد: ${balance:.2f}\n"
+        f"🆔 رقم العملية: `{transaction_id}`"
+    )
+
+def format_loan_approved(loan, transaction_id):
+    return (
+        f"✅ تمت الموافقة على القرض الخاص بك!\n"
+        f"💰 مبلغ القرض: ${loan['amount']:.2f}\n"
+        f"💸 الفائدة: ${loan['interest']:.2f}\n"
+        f"🔄 المبلغ الإجمالي للسداد: ${loan['total_to_repay']:.2f}\n"
+        f"📅 تاريخ الاستحقاق: {loan['due_date'].strftime('%Y-%m-%d')}\n"
+        f"🆔 رقم القرض: `{loan['loan_id']}`\n"
+        f"🆔 رقم العملية: `{transaction_id}`"
+    )
+
+def format_loan(loan):
+    return (
+        f"🆔 رقم القرض: `{loan['loan_id']}`\n"
+        f"💰 مبلغ القرض: ${loan['amount']:.2f}\n"
+        f"💸 الفائدة: ${loan['interest']:.2f}\n"
+        f"🔄 المبلغ الإجمالي للسداد: ${loan['total_to_repay']:.2f}\n"
+        f"⏳ المتبقي للسداد: ${loan.get('remaining', loan['total_to_repay']):.2f}\n"
+        f"📅 تاريخ القرض: {loan['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}"
+        + (f"\n⏳ تاريخ الاستحقاق: {loan['due_date'].strftime('%Y-%m-%d')}" if 'due_date' in loan else "")
+    )
+
+def format_repayment_receipt(repayment, auto=False):
+    if repayment['remaining']:
+        message = (
+            f"✅ تم سداد جزء من القرض.\n"
+            f"💰 المبلغ المسدد: ${repayment['amount']:.2f}\n"
+            f"⏳ المتبقي للسداد: ${repayment['remaining']:.2f}\n"
+        )
+    else:
+        message = (
+            f"✅ تم سداد القرض بنجاح!\n"
+            f"💰 المبلغ المسدد: ${repayment['amount']:.2f}\n"
+        )
+    if auto:
+        message = "🔁 سداد تلقائي من التحويل الوارد\n" + message
+    message += (
+        f"💳 رصيدك الجديد: ${repayment['balance']:.2f}\n"
+        f"🆔 رقم العملية: `{repayment['transaction']['transaction_id']}`"
+    )
+    return message
+
+def format_status(telegram_latency, mongo_latency, now, uptime):
+    return (
+        f"📊 حالة النظام:\n\n"
+        f"🚀 تأخير Telegram API: {telegram_latency:.2f} مللي ثانية\n"
+        f"🗄️ تأخير قاعدة البيانات: {mongo_latency:.2f} مللي ثانية\n"
+        f"⏰ الوقت الحالي (بغداد): {now.strftime('%Y-%m-%d %H:%M:%S')}\n"
+        f"⌛ وقت التشغيل: {format_uptime(uptime)}"
+    )
+
+def format_lanes_status(queue_depth, lanes):
+    busy_lanes = [lane for lane in lanes.values() if lane['depth']]
+    return (
+        f"\n🧵 التحديثات المنتظرة: {queue_depth} في {len(busy_lanes)} طابور, "
+        f"أقصى انتظار: {max((lane['max_wait_ms'] for lane in lanes.values()), default=0):.2f} مللي ثانية"
+    )
+
+def format_activity_status(gifts, cache_hit_ratio, outbox_depth, sends, transfers):
+    status = f"\n🎁 هدايا النافذة الحالية: {gifts['claims']} (مرفوضة: {gifts['rejected']})"
+    status += f"\n🗃️ نسبة إصابة ذاكرة المستخدمين: {cache_hit_ratio * 100:.1f}%"
+    status += (
+        f"\n📤 الرسائل المنتظرة: {outbox_depth}, "
+        f"إعادة المحاولة: {sends['retried']}, المفقودة: {sends['dropped']}"
+    )
+    if transfers['count']:
+        status += (
+            f"\n💸 متوسط التحويل: {transfers['round_trips'] / transfers['count']:.1f} طلب لقاعدة البيانات, "
+            f"{transfers['latency_ms'] / transfers['count']:.2f} مللي ثانية"
+        )
+    return status
@@ -0,0 +1,289 @@
+import asyncio
+import heapq
+import itertools
+import queue
+import threading
+import time
+import aiohttp
+import requests
+from telebot import asyncio_helper
+from telebot.apihelper import ApiTelegramException
+
+# Message priorities, lower is sent first
+PRIORITY_TRANSACTIONAL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Seconds of the first retry after a transient error, doubled on every attempt
+RETRY_BACKOFF = 0.5
+
+# Seconds between pruning rate limit state of idle chats
+PRUNE_INTERVAL = 60
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+class OutgoingMessage:
+    def __init__(self, chat_id, method, args, kwargs, priority, seq, on_done=None):
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.priority = priority
+        self.seq = seq
+        self.kwargs = kwargs
+        self.on_done = on_done
+        self.attempts = 0
+
+class Outbox:
+    # Sends messages from a queue within Telegram's limits: a global token bucket
+    # (~30 msg/s) and one bucket per chat (~1 msg/s with a small burst). Each chat
+    # has at most one message in flight so its messages keep their order; across
+    # chats the highest priority ready message goes first. 429 responses pause
+    # the chat for retry_after, network errors and 5xx are retried with backoff.
+    # The scheduling is shared: OutboundScheduler runs it on threads with the
+    # blocking Bot API client, AsyncOutboundScheduler on asyncio with AsyncTeleBot.
+
+    # Errors of the client the subclass calls
+    api_errors = (ApiTelegramException,)
+    network_errors = (requests.ConnectionError, requests.Timeout)
+
+    def __init__(self, send, global_rate=30, chat_rate=1, chat_burst=3, max_retries=5):
+        self.send = send
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.chats = {}
+        self.scheduled = set()
+        self.in_flight = set()
+        self.waiting = []
+        self.ready = []
+        self.seq = itertools.count()
+        self.last_prune = time.monotonic()
+        self.stats = {'queued': 0, 'sent': 0, 'retried': 0, 'rate_limited': 0, 'dropped': 0}
+
+    def enqueue(self, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+        self.enqueue_call(chat_id, self.send, chat_id, text, priority=priority, **kwargs)
+
+    def enqueue_call(self, chat_id, method, *args, priority=PRIORITY_NORMAL, on_done=None, **kwargs):
+        # Any Bot API call counted against the limits of chat_id, e.g. edit_message_text.
+        # on_done is called once the call succeeded or was dropped, not between
+        # retries, e.g. to close a file it sends.
+        message = OutgoingMessage(chat_id, method, args, kwargs, priority, next(self.seq), on_done)
+        self._push(message)
+        self.stats['queued'] += 1
+        if chat_id not in self.scheduled and chat_id not in self.in_flight:
+            self._schedule_chat(chat_id, time.monotonic())
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    def queue_depth(self):
+        return sum(len(messages) for messages in self.chats.values())
+
+    def _wake(self):
+        raise NotImplementedError
+
+    def _push(self, message):
+        messages = self.chats.setdefault(message.chat_id, [])
+        heapq.heappush(messages, (message.priority, message.seq, message))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _schedule_chat(self, chat_id, now, not_before=0):
+        ready_at = max(now + self._chat_bucket(chat_id).wait_time(now), not_before)
+        priority = self.chats[chat_id][0][0]
+        if ready_at <= now:
+            heapq.heappush(self.ready, (priority, next(self.seq), chat_id))
+        else:
+            heapq.heappush(self.waiting, (ready_at, next(self.seq), chat_id))
+        self.scheduled.add(chat_id)
+        self._wake()
+
+    def _prune(self, now):
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in self.chats and bucket.wait_time(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+        self.last_prune = now
+
+    def _next_message(self, now):
+        # (message to send now, None) or (None, seconds until one may be ready;
+        # None when nothing is queued)
+        if now - self.last_prune > PRUNE_INTERVAL:
+            self._prune(now)
+        while self.waiting and self.waiting[0][0] <= now:
+            _, _, chat_id = heapq.heappop(self.waiting)
+            heapq.heappush(self.ready, (self.chats[chat_id][0][0], next(self.seq), chat_id))
+
+        timeout = self.waiting[0][0] - now if self.waiting else None
+        if self.ready:
+            global_wait = self.global_bucket.wait_time(now)
+            if global_wait == 0:
+                _, _, chat_id = heapq.heappop(self.ready)
+                self.scheduled.discard(chat_id)
+                self.global_bucket.consume(now)
+                self._chat_bucket(chat_id).consume(now)
+                _, _, message = heapq.heappop(self.chats[chat_id])
+                self.in_flight.add(chat_id)
+                return message, None
+            timeout = global_wait if timeout is None else min(timeout, global_wait)
+        return None, timeout
+
+    def _failed(self, message, error):
+        # (retry, not_before, outcome) of a call that raised error
+        if isinstance(error, self.api_errors) and error.error_code == 429:
+            retry_after = (error.result_json or {}).get('parameters', {}).get('retry_after', 1)
+            return True, time.monotonic() + retry_after, 'rate_limited'
+        transient = isinstance(error, self.network_errors) or (isinstance(error, self.api_errors) and error.error_code >= 500)
+        if transient and message.attempts <= self.max_retries:
+            return True, time.monotonic() + RETRY_BACKOFF * 2 ** (message.attempts - 1), None
+        print(f"Error sending message to {message.chat_id}: {error}")
+        return False, 0, 'dropped'
+
+    def _count(self, outcome, retry):
+        if outcome:
+            self.stats[outcome] += 1
+        if retry:
+            self.stats['retried'] += 1
+
+    def _done(self, message):
+        if message.on_done:
+            try:
+                message.on_done()
+            except Exception as e:
+                print(f"Error finishing message to {message.chat_id}: {e}")
+
+    def _release(self, message, retry, not_before):
+        # The chat may send again: the retried message or its next one
+        if retry:
+            self._push(message)
+        self.in_flight.discard(message.chat_id)
+        if self.chats.get(message.chat_id):
+            self._schedule_chat(message.chat_id, time.monotonic(), not_before)
+        else:
+            self.chats.pop(message.chat_id, None)
+
+class OutboundScheduler(Outbox):
+    # A scheduler thread hands messages to num_senders threads calling the
+    # blocking client; self.condition guards the shared state
+
+    def __init__(self, send, global_rate=30, chat_rate=1, chat_burst=3, max_retries=5, num_senders=4):
+        super().__init__(send, global_rate, chat_rate, chat_burst, max_retries)
+        self.condition = threading.Condition()
+        self.jobs = queue.Queue()
+        threading.Thread(target=self._schedule, name="outbox-scheduler", daemon=True).start()
+        for i in range(num_senders):
+            threading.Thread(target=self._send_loop, name=f"outbox-sender-{i}", daemon=True).start()
+
+    def enqueue_call(self, chat_id, method, *args, priority=PRIORITY_NORMAL, on_done=None, **kwargs):
+        with self.condition:
+            super().enqueue_call(chat_id, method, *args, priority=priority, on_done=on_done, **kwargs)
+
+    def get_stats(self):
+        with self.condition:
+            return super().get_stats()
+
+    def queue_depth(self):
+        with self.condition:
+            return super().queue_depth()
+
+    def _wake(self):
+        self.condition.notify()
+
+    def _schedule(self):
+        with self.condition:
+            while True:
+                message, timeout = self._next_message(time.monotonic())
+                if message:
+                    self.jobs.put(message)
+                    continue
+                self.condition.wait(timeout)
+
+    def _send_loop(self):
+        while True:
+            message = self.jobs.get()
+            message.attempts += 1
+            try:
+                message.method(*message.args, **message.kwargs)
+                retry, not_before, outcome = False, 0, 'sent'
+            except Exception as e:
+                retry, not_before, outcome = self._failed(message, e)
+            # Several sender threads count at once
+            with self.condition:
+                self._count(outcome, retry)
+            if not retry:
+                self._done(message)
+            with self.condition:
+                self._release(message, retry, not_before)
+
+class AsyncOutboundScheduler(Outbox):
+    # Same scheduling on the event loop, for async_bot.py: methods are
+    # coroutine functions (AsyncTeleBot's) awaited by num_senders tasks. Enqueue
+    # from the loop's thread only; start() runs the tasks once the loop is up.
+
+    api_errors = (asyncio_helper.ApiTelegramException,)
+    network_errors = (asyncio_helper.RequestTimeout, aiohttp.ClientError, asyncio.TimeoutError)
+
+    def __init__(self, send, global_rate=30, chat_rate=1, chat_burst=3, max_retries=5, num_senders=4):
+        super().__init__(send, global_rate, chat_rate, chat_burst, max_retries)
+        self.num_senders = num_senders
+        self.wakeup = asyncio.Event()
+        self.jobs = asyncio.Queue()
+        self.tasks = []
+
+    def start(self):
+        self.tasks.append(asyncio.create_task(self._schedule()))
+        for _ in range(self.num_senders):
+            self.tasks.append(asyncio.create_task(self._send_loop()))
+
+    def _wake(self):
+        self.wakeup.set()
+
+    async def _schedule(self):
+        while True:
+            message, timeout = self._next_message(time.monotonic())
+            if message:
+                self.jobs.put_nowait(message)
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_loop(self):
+        while True:
+            message = await self.jobs.get()
+            message.attempts += 1
+            try:
+                await message.method(*message.args, **message.kwargs)
+                retry, not_before, outcome = False, 0, 'sent'
+            except Exception as e:
+                retry, not_before, outcome = self._failed(message, e)
+            self._count(outcome, retry)
+            if not retry:
+                self._done(message)
+            self._release(message, retry, not_before)
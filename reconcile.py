@@ -0,0 +1,187 @@
+import argparse
+import itertools
+import os
+import time
+from datetime import timedelta
+from helpers import get_current_time
+from storage import MongoStorage, INITIAL_LIQUIDITY
+from journal import LIQUIDITY_ACCOUNT, OPENING_CHECKPOINT, get_balance
+
+# Ledger reconciliation: checks every user's balance against the sum of their
+# rows in the transactions collection, the total user balance counter against
+# the balances, and bot liquidity against the liquidity history, what the
+# ledger implies (gifts are the only ledger rows the bot does not pay for) and,
+# once it is opened, the journal's liquidity account.
+# The ledger is summed per user on the server and merged with the users in
+# user_id order, so memory stays bounded however long the ledger is.
+#
+#   python reconcile.py                  check everything
+#   python reconcile.py --incremental    only users with ledger rows since the last run
+#
+# Progress is checkpointed in bot_stats after every batch; an interrupted run
+# resumes where it stopped. Mismatches go to the reconciliation_mismatches
+# collection.
+
+CHECKPOINT = 'ledger_reconciliation'
+
+# Differences up to this are rounding
+TOLERANCE = 0.005
+
+# A ledger row is written just after the balance change it belongs to, so a
+# mismatch is checked again after this many seconds before it is reported
+RECHECK_DELAY = 2
+
+# Incremental runs also look at rows written this long before the last run
+# started, which may have been inserted after it
+WATERMARK_LAG = timedelta(minutes=5)
+
+# Mismatches printed in the report
+REPORT_LIMIT = 20
+
+def merge_by_user(ledger_rows, balance_rows):
+    # Joins the two user_id ordered streams into (user_id, ledger row, balance);
+    # a user missing on one side has nothing there
+    ledger = next(ledger_rows, None)
+    balance = next(balance_rows, None)
+    while ledger is not None or balance is not None:
+        if balance is None or (ledger is not None and ledger['_id'] < balance['user_id']):
+            yield ledger['_id'], ledger, 0
+            ledger = next(ledger_rows, None)
+        elif ledger is None or balance['user_id'] < ledger['_id']:
+            yield balance['user_id'], None, balance.get('balance', 0)
+            balance = next(balance_rows, None)
+        else:
+            yield ledger['_id'], ledger, balance.get('balance', 0)
+            ledger = next(ledger_rows, None)
+            balance = next(balance_rows, None)
+
+def find_mismatches(rows):
+    mismatches = []
+    for user_id, ledger, balance in rows:
+        ledger_sum = ledger['ledger'] if ledger else 0
+        if abs(balance - ledger_sum) > TOLERANCE:
+            mismatches.append({'user_id': user_id, 'balance': balance, 'ledger': ledger_sum, 'difference': balance - ledger_sum})
+    return mismatches
+
+def recheck(storage, mismatches, batch_size):
+    # Keeps the mismatches that are still there after RECHECK_DELAY
+    if not mismatches:
+        return []
+    time.sleep(RECHECK_DELAY)
+    user_ids = [mismatch['user_id'] for mismatch in mismatches]
+    return find_mismatches(merge_by_user(
+        iter(storage.iter_ledger_by_user(user_ids=user_ids, batch_size=batch_size)),
+        iter(storage.iter_user_balances(user_ids=user_ids, batch_size=batch_size))
+    ))
+
+def iter_full(storage, after_user_id, batch_size):
+    return merge_by_user(
+        iter(storage.iter_ledger_by_user(after_user_id, batch_size=batch_size)),
+        iter(storage.iter_user_balances(after_user_id, batch_size=batch_size))
+    )
+
+def iter_incremental(storage, since, after_user_id, batch_size):
+    user_ids = storage.iter_users_touched_since(since, batch_size)
+    if after_user_id is not None:
+        user_ids = itertools.dropwhile(lambda user_id: user_id <= after_user_id, user_ids)
+    while True:
+        batch = list(itertools.islice(user_ids, batch_size))
+        if not batch:
+            return
+        yield from merge_by_user(
+            iter(storage.iter_ledger_by_user(user_ids=batch, batch_size=batch_size)),
+            iter(storage.iter_user_balances(user_ids=batch, batch_size=batch_size))
+        )
+
+def run_reconciliation(storage, incremental=False, batch_size=1000):
+    checkpoint = storage.get_checkpoint(CHECKPOINT) or {}
+    if checkpoint.get('started_at') and not checkpoint.get('finished_at'):
+        state = checkpoint
+        print(f"Resuming {state['mode']} reconciliation after user {state['last_user_id']}")
+    else:
+        if incremental and not checkpoint.get('watermark'):
+            print("No earlier run to continue from, checking everything")
+            incremental = False
+        state = {
+            'mode': 'incremental' if incremental else 'full',
+            'since': checkpoint.get('watermark') if incremental else None,
+            'watermark': checkpoint.get('watermark'),
+            'started_at': get_current_time(),
+            'finished_at': None,
+            'last_user_id': None,
+            'users': 0,
+            'transactions': 0,
+            'mismatches': 0,
+            'ledger_total': 0,
+            'gift_total': 0,
+            'balance_total': 0
+        }
+    storage.save_checkpoint(CHECKPOINT, state)
+
+    start = time.perf_counter()
+    users_before = state['users']
+    if state['mode'] == 'full':
+        rows = iter_full(storage, state['last_user_id'], batch_size)
+    else:
+        rows = iter_incremental(storage, state['since'], state['last_user_id'], batch_size)
+    reported = []
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        mismatches = recheck(storage, find_mismatches(batch), batch_size)
+        for mismatch in mismatches:
+            mismatch.update({'run_started_at': state['started_at'], 'found_at': get_current_time()})
+        storage.record_reconciliation_mismatches(mismatches)
+        reported.extend(mismatches[:REPORT_LIMIT - len(reported)])
+        for _, ledger, balance in batch:
+            if ledger:
+                state['transactions'] += ledger['count']
+                state['ledger_total'] += ledger['ledger']
+                state['gift_total'] += ledger['gifts']
+            state['balance_total'] += balance
+        state['users'] += len(batch)
+        state['mismatches'] += len(mismatches)
+        state['last_user_id'] = batch[-1][0]
+        storage.save_checkpoint(CHECKPOINT, state)
+
+    elapsed = time.perf_counter() - start
+    users = state['users'] - users_before
+    print(f"Reconciled {users} users ({state['transactions']} ledger rows) in {elapsed:.2f}s "
+          f"({users / elapsed if elapsed else 0:.0f} users/s), {state['mismatches']} mismatched balances")
+    for mismatch in reported:
+        print(f"  user {mismatch['user_id']}: balance ${mismatch['balance']:.2f}, ledger ${mismatch['ledger']:.2f}, "
+              f"difference ${mismatch['difference']:.2f}")
+
+    if state['mode'] == 'full':
+        # Totals only mean something over every user
+        liquidity = storage.get_bot_liquidity()
+        checks = [
+            ('Total of balances vs ledger', state['balance_total'], state['ledger_total']),
+            ('Total user balance counter vs balances', storage.get_total_user_balance(), state['balance_total']),
+            ('Bot liquidity vs liquidity history', liquidity, INITIAL_LIQUIDITY + storage.get_liquidity_history_net()),
+            ('Bot liquidity vs ledger', liquidity, INITIAL_LIQUIDITY - (state['ledger_total'] - state['gift_total']))
+        ]
+        if (storage.get_checkpoint(OPENING_CHECKPOINT) or {}).get('finished_at'):
+            checks.append(('Bot liquidity vs journal', liquidity, get_balance(storage, LIQUIDITY_ACCOUNT)))
+        for name, stored, expected in checks:
+            status = "OK" if abs(stored - expected) <= TOLERANCE else f"MISMATCH ({stored - expected:+.2f})"
+            print(f"{name}: ${stored:,.2f} / ${expected:,.2f} {status}")
+        state['totals'] = {name: {'stored': stored, 'expected': expected} for name, stored, expected in checks}
+
+    state['finished_at'] = get_current_time()
+    state['watermark'] = state['started_at'] - WATERMARK_LAG
+    storage.save_checkpoint(CHECKPOINT, state)
+    return state
+
+def main():
+    parser = argparse.ArgumentParser(description="Check user balances and bot liquidity against the transaction ledger")
+    parser.add_argument('--incremental', action='store_true', help="only users with ledger rows since the last run")
+    parser.add_argument('--batch-size', type=int, default=1000, help="users compared per batch")
+    args = parser.parse_args()
+
+    storage = MongoStorage(f"mongodb+srv://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_CLUSTER')}/")
+    run_reconciliation(storage, args.incremental, args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+import argparse
+import bisect
+import functools
+import hashlib
+import os
+import threading
+import time
+import requests
+import telebot
+from telebot import apihelper
+from dispatcher import UserDispatcher
+from webhook import WebhookServer, SECRET_HEADER
+
+# Sharded deployment: a router receives every update from Telegram and forwards
+# it to the worker (a bot.py process with BOT_MODE=worker) that owns the user on
+# a consistent hash ring. Run the router with
+#   python shard.py --workers http://10.0.0.1:8081,http://10.0.0.2:8081
+
+# Header carrying the epoch of the shard map an update was routed with
+EPOCH_HEADER = 'X-Shard-Epoch'
+
+# Points per worker on the hash ring; more points spread users more evenly
+VIRTUAL_NODES = 100
+
+# Seconds between attempts to deliver an update to an unavailable worker
+FORWARD_RETRY_DELAY = 0.5
+MAX_FORWARD_RETRY_DELAY = 10
+
+# Seconds a worker waits for its queue to drain when the shard map changes
+DRAIN_TIMEOUT = 30
+
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+class HashRing:
+    # Consistent hashing: adding or removing one of N workers moves only about
+    # 1/N of the users
+
+    def __init__(self, workers, virtual_nodes=VIRTUAL_NODES):
+        self.workers = list(workers)
+        points = sorted((hash_key(f"{worker}#{i}"), worker) for worker in self.workers for i in range(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [worker for _, worker in points]
+
+    def owner(self, user_id):
+        if not self.hashes:
+            return None
+        return self.owners[bisect.bisect(self.hashes, hash_key(user_id)) % len(self.hashes)]
+
+def get_raw_update_user_id(update):
+    for key in ('message', 'callback_query', 'edited_message'):
+        item = update.get(key)
+        if item and item.get('from'):
+            return item['from']['id']
+    return None
+
+def post_json(session, url, payload, secret, epoch=None, timeout=10):
+    headers = {SECRET_HEADER: secret}
+    if epoch is not None:
+        headers[EPOCH_HEADER] = str(epoch)
+    return session.post(url, json=payload, headers=headers, timeout=timeout)
+
+class ShardWorker:
+    # Worker end of the protocol. POST /shard/map installs a new shard map once
+    # the worker's queue has drained (the router holds updates back meanwhile)
+    # and drops cached users, since some of them now belong to another worker.
+    # If the queue does not drain within DRAIN_TIMEOUT the old map stays and
+    # the answer is 503, so the router asks again. Updates routed with any other
+    # epoch are refused with 409.
+    # POST /shard/invalidate drops users from this worker's cache; workers send
+    # it to the owner of the other party after a cross-shard transfer.
+    # POST /shard/task queues a registered task for a user this worker owns on
+    # that user's lane, e.g. the loan sweep after a transfer from another shard.
+
+    def __init__(self, url, secret, dispatcher, user_cache):
+        self.url = url
+        self.secret = secret
+        self.dispatcher = dispatcher
+        self.user_cache = user_cache
+        self.epoch = None
+        self.ring = HashRing([])
+        self.session = requests.Session()
+        self.tasks = {}
+
+    def accepts(self, headers):
+        return self.epoch is not None and headers.get(EPOCH_HEADER) == str(self.epoch)
+
+    def routes(self):
+        return {
+            '/shard/map': self.handle_map,
+            '/shard/invalidate': self.handle_invalidate,
+            '/shard/task': self.handle_task
+        }
+
+    def register_task(self, task):
+        self.tasks[task.__name__] = task
+
+    def owns(self, user_id):
+        owner = self.ring.owner(user_id)
+        return owner is None or owner == self.url
+
+    def handle_map(self, payload):
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self.dispatcher.queue_depth() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        depth = self.dispatcher.queue_depth()
+        if depth:
+            print(f"Shard map {payload['epoch']} refused: {depth} updates still queued")
+            return 503, {'ok': False, 'error': 'queue not drained', 'queue_depth': depth}
+        self.ring = HashRing(payload['workers'])
+        self.epoch = payload['epoch']
+        self.user_cache.clear()
+        print(f"Shard map {self.epoch}: {len(self.ring.workers)} workers")
+        return 200, {'ok': True, 'epoch': self.epoch}
+
+    def handle_invalidate(self, payload):
+        self.user_cache.invalidate(*payload['user_ids'])
+        return 200, {'ok': True}
+
+    def handle_task(self, payload):
+        task = self.tasks.get(payload['task'])
+        if not task:
+            return 404, {'ok': False, 'error': 'unknown task'}
+        user_id = payload['user_id']
+        if not self.dispatcher.submit(user_id, functools.partial(task, user_id, *payload['args'])):
+            return 503, {'ok': False, 'error': 'queue full'}
+        return 200, {'ok': True}
+
+    def submit_remote(self, user_id, task, *args):
+        # Queues task(user_id, *args) on the worker owning the user. Tried once:
+        # a lost task only skips work the user can still do by hand
+        owner = self.ring.owner(user_id)
+        try:
+            response = post_json(self.session, f"{owner}/shard/task",
+                                 {'task': task.__name__, 'user_id': user_id, 'args': list(args)}, self.secret, timeout=5)
+            response.raise_for_status()
+        except Exception as e:
+            print(f"Error queueing {task.__name__} for {user_id} on {owner}: {e}")
+
+    def invalidate_remote(self, *user_ids):
+        # Best effort: a missed invalidation only leaves a stale cache entry
+        # until it expires, balances themselves are guarded in the database
+        owners = {}
+        for user_id in user_ids:
+            owner = self.ring.owner(user_id)
+            if owner and owner != self.url:
+                owners.setdefault(owner, []).append(user_id)
+        for owner, owned in owners.items():
+            try:
+                post_json(self.session, f"{owner}/shard/invalidate", {'user_ids': owned}, self.secret, timeout=2)
+            except Exception as e:
+                print(f"Error invalidating {owned} on {owner}: {e}")
+
+class ShardRouter:
+    # Forwards updates through per-user lanes, so each user's updates reach
+    # their worker one at a time and in order. set_workers() rebalances: it
+    # waits for forwards in flight, sends the new map to the old and new
+    # workers (each drains its queue first, and is asked again until it has)
+    # and then resumes with the new ring.
+
+    def __init__(self, workers, secret, num_workers=32, max_pending=10000):
+        self.secret = secret
+        self.workers = []
+        self.ring = HashRing([])
+        self.epoch = None
+        self.paused = False
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.rebalance_lock = threading.Lock()
+        self.local = threading.local()
+        self.forwarded = 0
+        self.set_workers(workers)
+        self.dispatcher = UserDispatcher(self.forward, num_workers=num_workers, max_pending=max_pending)
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def send_map(self, worker, epoch, workers):
+        # Sent again while the worker answers 503: its queue still holds updates
+        # of users the new ring may give to another worker
+        delay = FORWARD_RETRY_DELAY
+        while True:
+            response = post_json(self.session(), f"{worker}/shard/map", {'epoch': epoch, 'workers': workers},
+                                 self.secret, timeout=DRAIN_TIMEOUT + 5)
+            if response.status_code != 503:
+                response.raise_for_status()
+                return
+            print(f"Shard map {epoch}: {worker} is still draining its queue")
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_FORWARD_RETRY_DELAY)
+
+    def set_workers(self, workers):
+        with self.rebalance_lock:
+            with self.condition:
+                self.paused = True
+                while self.in_flight:
+                    self.condition.wait()
+            try:
+                epoch = time.time_ns()
+                for worker in dict.fromkeys(self.workers + list(workers)):
+                    try:
+                        self.send_map(worker, epoch, list(workers))
+                    except Exception as e:
+                        # Unreachable workers count as gone: removed ones may
+                        # already be stopped, current ones get the map again on
+                        # their first 409
+                        print(f"Error sending shard map to {worker}: {e}")
+                self.workers = list(workers)
+                self.ring = HashRing(self.workers)
+                self.epoch = epoch
+            finally:
+                with self.condition:
+                    self.paused = False
+                    self.condition.notify_all()
+        print(f"Shard map {self.epoch}: {len(self.workers)} workers")
+
+    def forward(self, update):
+        user_id = get_raw_update_user_id(update)
+        delay = FORWARD_RETRY_DELAY
+        while True:
+            with self.condition:
+                while self.paused:
+                    self.condition.wait()
+                self.in_flight += 1
+                owner = self.ring.owner(user_id)
+                epoch = self.epoch
+            try:
+                status = post_json(self.session(), f"{owner}/webhook", update, self.secret, epoch).status_code
+            except Exception as e:
+                print(f"Error forwarding update {update.get('update_id')} to {owner}: {e}")
+                status = None
+            finally:
+                with self.condition:
+                    self.in_flight -= 1
+                    self.condition.notify_all()
+
+            if status == 200:
+                self.forwarded += 1
+                return
+            if status == 409:
+                # The worker restarted or missed a map change
+                try:
+                    self.send_map(owner, epoch, self.workers)
+                    continue
+                except Exception as e:
+                    print(f"Error sending shard map to {owner}: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_FORWARD_RETRY_DELAY)
+
+    def handle_workers(self, payload):
+        threading.Thread(target=self.set_workers, args=(payload['workers'],), daemon=True).start()
+        return 202, {'ok': True}
+
+    def poll_updates(self, token):
+        offset = None
+        while True:
+            updates = apihelper.get_updates(token, offset=offset, timeout=20, long_polling_timeout=20)
+            for update in updates:
+                offset = update['update_id'] + 1
+                self.dispatcher.submit(get_raw_update_user_id(update), update, block=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Route Telegram updates to bot workers sharded by user id")
+    parser.add_argument('--workers', default=os.getenv("SHARD_WORKERS", ""), help="comma separated worker URLs")
+    parser.add_argument('--port', type=int, default=int(os.getenv("PORT", 8080)))
+    parser.add_argument('--mode', default=os.getenv("BOT_MODE", "polling"), choices=['polling', 'webhook'])
+    parser.add_argument('--forwarders', type=int, default=32, help="threads forwarding updates")
+    args = parser.parse_args()
+
+    token = os.getenv("TOKEN")
+    shard_secret = os.getenv("SHARD_SECRET")
+    webhook_url = os.getenv("WEBHOOK_URL")
+    webhook_secret = os.getenv("WEBHOOK_SECRET")
+    workers = [worker.strip().rstrip('/') for worker in args.workers.split(',') if worker.strip()]
+    if not workers or not shard_secret:
+        raise RuntimeError("The router needs --workers (or SHARD_WORKERS) and SHARD_SECRET")
+
+    router = ShardRouter(workers, shard_secret, num_workers=args.forwarders)
+    # POST /shard/workers {"workers": [...]} with SHARD_SECRET changes the worker set
+    server = WebhookServer(
+        router.dispatcher, get_raw_update_user_id, webhook_secret, port=args.port, parse=lambda update: update,
+        routes={'/shard/workers': router.handle_workers}, route_secret=shard_secret
+    )
+    bot = telebot.TeleBot(token)
+    if args.mode == 'webhook':
+        if not webhook_url or not webhook_secret:
+            raise RuntimeError("Webhook mode needs WEBHOOK_URL and WEBHOOK_SECRET")
+        bot.set_webhook(url=webhook_url, secret_token=webhook_secret)
+        print(f"Routing webhook updates on port {args.port}")
+        server.serve_forever()
+        return
+
+    bot.remove_webhook()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Routing polled updates, admin on port {args.port}")
+    while True:
+        try:
+            router.poll_updates(token)
+        except Exception as e:
+            print(f"Polling error: {e}")
+            time.sleep(15)
+
+if __name__ == "__main__":
+    main()
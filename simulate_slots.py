@@ -0,0 +1,155 @@
+import argparse
+import csv
+import os
+import time
+import numpy as np
+from slots import SYMBOLS, REELS, WIN_MULTIPLIER, MIN_BET, MAX_BET, win_probability, house_edge
+
+# Monte Carlo simulator for the slots game, vectorized with NumPy (not needed
+# by the bot itself: pip install numpy). Each run is one bot with its own
+# liquidity and a pool of players spinning in rounds; the rules come from
+# slots.py, so changing them there changes both the bot and the simulation.
+#
+#   python simulate_slots.py --runs 1000 --players 1000 --rounds 300 --liquidity 10000
+#
+# Bets are drawn uniformly from MIN_BET..MAX_BET, from a file of bet amounts
+# (--bets bets.txt, one per line) or from the slots transactions in MongoDB
+# (--bets mongo, with the usual DB_USER/DB_PASS/DB_CLUSTER variables).
+
+PERCENTILES = [1, 5, 50, 95, 99]
+
+# Rounds shown in the printed liquidity trajectory
+TRAJECTORY_POINTS = 10
+
+def load_bets(source):
+    if source == 'uniform':
+        return None
+    if source == 'mongo':
+        from pymongo import MongoClient
+        client = MongoClient(f"mongodb+srv://{os.getenv('DB_USER')}:{os.getenv('DB_PASS')}@{os.getenv('DB_CLUSTER')}/")
+        cursor = client['bank_bot']['transactions'].find(
+            {'type': {'$in': ['slots_win', 'slots_loss']}},
+            {'_id': False, 'type': True, 'amount': True}
+        )
+        # A win records the net gain, a loss the negative bet
+        bets = [t['amount'] / (WIN_MULTIPLIER - 1) if t['type'] == 'slots_win' else -t['amount'] for t in cursor]
+    else:
+        bets = np.loadtxt(source, ndmin=1)
+    bets = np.asarray(bets, dtype=np.float64)
+    bets = bets[(bets >= MIN_BET) & (bets <= MAX_BET)]
+    if not len(bets):
+        raise SystemExit(f"No bets between {MIN_BET} and {MAX_BET} in {source}")
+    return bets
+
+def draw_bets(rng, bets, size):
+    if bets is None:
+        return rng.uniform(MIN_BET, MAX_BET, size)
+    return bets[rng.integers(0, len(bets), size)]
+
+def simulate(runs, players, rounds, liquidity, balance, bets=None, replace=True, seed=None):
+    rng = np.random.default_rng(seed)
+    bot_liquidity = np.full(runs, liquidity, dtype=np.float64)
+    balances = np.full((runs, players), balance, dtype=np.float64)
+    wagered = np.zeros(runs)
+    bot_gain = np.zeros(runs)
+    forced_losses = np.zeros(runs, dtype=np.int64)
+    started = np.full(runs, players, dtype=np.int64)
+    ruined = np.zeros(runs, dtype=np.int64)
+    trajectory = np.empty((rounds + 1, runs))
+    trajectory[0] = bot_liquidity
+    spins = 0
+
+    for round_index in range(rounds):
+        active = balances >= MIN_BET
+        # Players cannot bet more than their balance
+        bet = np.where(active, np.minimum(draw_bets(rng, bets, (runs, players)), balances), 0)
+        reels = rng.integers(0, len(SYMBOLS), size=(REELS, runs, players), dtype=np.uint8)
+        win = active & (reels[1:] == reels[0]).all(axis=0)
+
+        # Players of a run settle one after another: a win is paid only if the
+        # liquidity left after the earlier wins of the round covers it. Losses
+        # of the round are not counted towards it, which slightly overstates
+        # forced losses when liquidity is nearly exhausted.
+        payout = np.where(win, bet * (WIN_MULTIPLIER - 1), 0)
+        available = bot_liquidity[:, None] - (np.cumsum(payout, axis=1) - payout)
+        paid = win & (bet * WIN_MULTIPLIER <= available)
+
+        gain = np.where(paid, -payout, bet)
+        balances -= gain
+        round_gain = gain.sum(axis=1)
+        bot_liquidity += round_gain
+        bot_gain += round_gain
+        wagered += bet.sum(axis=1)
+        forced_losses += (win & ~paid).sum(axis=1)
+        spins += int(active.sum())
+
+        busted = active & (balances < MIN_BET)
+        ruined += busted.sum(axis=1)
+        if replace:
+            # A new player with a fresh balance takes the seat of a ruined one
+            balances[busted] = balance
+            started += busted.sum(axis=1)
+        trajectory[round_index + 1] = bot_liquidity
+
+    return {
+        'spins': spins,
+        'house_edge': np.divide(bot_gain, wagered, out=np.zeros(runs), where=wagered > 0),
+        'wagered': wagered,
+        'forced_losses': forced_losses,
+        'started': started,
+        'ruined': ruined,
+        'trajectory': trajectory
+    }
+
+def format_percentiles(values, fmt):
+    return ", ".join(f"p{p}={fmt.format(v)}" for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+
+def report(result, liquidity, ruin_level, elapsed):
+    trajectory = result['trajectory']
+    runs = trajectory.shape[1]
+    bot_ruined = (trajectory.min(axis=0) < ruin_level).mean()
+    print(f"Spins: {result['spins']:,} in {elapsed:.2f}s ({result['spins'] / elapsed:,.0f}/s)")
+    print(f"Win probability: {win_probability():.4%}, house edge by the rules: {house_edge():.2%}")
+    print(f"House edge per run: {format_percentiles(result['house_edge'], '{:.2%}')}")
+    print(f"Wagered per run: {format_percentiles(result['wagered'], '${:,.0f}')}")
+    print(f"Wins forced to losses: {result['forced_losses'].sum() / max(result['spins'], 1):.4%} of spins")
+    print(f"Player ruin probability: {result['ruined'].sum() / result['started'].sum():.2%}")
+    print(f"Bot ruin probability (liquidity below ${ruin_level:,.2f}): {bot_ruined:.2%} of {runs} runs")
+    print(f"Liquidity trajectory from ${liquidity:,.2f} (p5 / p50 / p95):")
+    rounds = trajectory.shape[0] - 1
+    for round_index in np.unique(np.linspace(0, rounds, TRAJECTORY_POINTS + 1).astype(int)):
+        p5, p50, p95 = np.percentile(trajectory[round_index], [5, 50, 95])
+        print(f"  round {round_index:>6}: ${p5:,.2f} / ${p50:,.2f} / ${p95:,.2f}")
+
+def write_trajectories(path, trajectory):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['round'] + [f"p{p}" for p in PERCENTILES])
+        for round_index, percentiles in enumerate(np.percentile(trajectory, PERCENTILES, axis=1).T):
+            writer.writerow([round_index] + [f"{v:.2f}" for v in percentiles])
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo simulation of slots house edge and bot liquidity")
+    parser.add_argument('--runs', type=int, default=200, help="independent bots simulated")
+    parser.add_argument('--players', type=int, default=1000, help="players spinning in each run")
+    parser.add_argument('--rounds', type=int, default=500, help="spins per player seat")
+    parser.add_argument('--liquidity', type=float, default=10000, help="starting bot liquidity")
+    parser.add_argument('--balance', type=float, default=100, help="starting balance of each player")
+    parser.add_argument('--bets', default='uniform', help="uniform, mongo or a file with one bet amount per line")
+    parser.add_argument('--no-replace', action='store_true', help="do not replace ruined players")
+    parser.add_argument('--ruin-level', type=float, default=MAX_BET * WIN_MULTIPLIER,
+                        help="liquidity below which a run counts as ruined (default: a maximum win)")
+    parser.add_argument('--trajectories', help="write liquidity percentiles of every round to this CSV file")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    bets = load_bets(args.bets)
+    start = time.perf_counter()
+    result = simulate(args.runs, args.players, args.rounds, args.liquidity, args.balance, bets,
+                      replace=not args.no_replace, seed=args.seed)
+    report(result, args.liquidity, args.ruin_level, time.perf_counter() - start)
+    if args.trajectories:
+        write_trajectories(args.trajectories, result['trajectory'])
+
+if __name__ == "__main__":
+    main()
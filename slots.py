@@ -0,0 +1,29 @@
+import random
+
+# Slots rules shared by bot.py, async_bot.py and simulate_slots.py. A spin shows
+# one symbol per reel, each drawn uniformly and independently; three equal
+# symbols win WIN_MULTIPLIER times the bet (the bet included), anything else
+# loses the bet. A win the bot's liquidity cannot cover is paid as a loss.
+SYMBOLS = ['🍒', '🍋', '🍊', '🍉', '🍇', '💎']
+REELS = 3
+WIN_MULTIPLIER = 2
+
+# Accepted bets in dollars
+MIN_BET = 5
+MAX_BET = 100
+
+def spin():
+    return [random.choice(SYMBOLS) for _ in range(REELS)]
+
+def is_winning(result):
+    return len(set(result)) == 1  # All symbols are the same
+
+def can_pay(bet_amount, bot_liquidity):
+    return bet_amount * WIN_MULTIPLIER <= bot_liquidity
+
+def win_probability():
+    return len(SYMBOLS) / len(SYMBOLS) ** REELS
+
+def house_edge():
+    # Expected share of each bet kept by the bot while liquidity covers wins
+    return 1 - win_probability() * WIN_MULTIPLIER
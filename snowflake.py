@@ -0,0 +1,187 @@
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import uuid
+import time
+from datetime import datetime
+from time import time_ns
+
+# IDs are 63-bit integers: 41 bits of milliseconds since EPOCH_MS (about 69
+# years), 10 bits of node id and a 12-bit per-millisecond sequence
+EPOCH_MS = 1704067200000  # 2024-01-01 00:00:00 UTC
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+TIMESTAMP_SHIFT = NODE_BITS + SEQUENCE_BITS
+MAX_NODE_ID = (1 << NODE_BITS) - 1
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+
+# Seconds a leased node id stays reserved without being renewed
+NODE_LEASE_TTL = int(os.getenv("NODE_LEASE_TTL", 60))
+
+def configured_node_id():
+    # NODE_ID from the environment, or None when the process leases one
+    node_id = os.getenv("NODE_ID")
+    return int(node_id) if node_id is not None else None
+
+def default_node_id():
+    # Node 0 until a lease says otherwise; leases start at 1, so a lone tool
+    # process running as 0 does not share a node with a bot
+    node_id = configured_node_id()
+    return 0 if node_id is None else node_id
+
+class SnowflakeGenerator:
+    # Unique, time-ordered IDs without talking to the database. Uniqueness across
+    # processes comes from the node id, within a process from the sequence. When
+    # the sequence runs out or the clock steps back, the generator keeps counting
+    # on its last timestamp instead of sleeping.
+
+    def __init__(self, node_id=None):
+        # The whole state is the last ID handed out; a new millisecond starts at
+        # sequence 0, otherwise the last ID plus one
+        self.last_id = 0
+        lock = threading.Lock()
+        self.acquire = lock.acquire
+        self.release = lock.release
+        self.year_prefix = None
+        self.year_end_ms = -1
+        self.set_node_id(default_node_id() if node_id is None else node_id)
+
+    def set_node_id(self, node_id):
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f"node_id must be between 0 and {MAX_NODE_ID}")
+        self.acquire()
+        self.node_id = node_id
+        self.node_bits = node_id << SEQUENCE_BITS
+        if self.last_id:
+            # Continue from the millisecond after the last ID, so IDs keep
+            # increasing whichever way the node id moved
+            self.last_id = (((self.last_id >> TIMESTAMP_SHIFT) + 1) << TIMESTAMP_SHIFT) | self.node_bits
+        self.release()
+
+    def next_id(self):
+        candidate = ((time_ns() // 1000000 - EPOCH_MS) << TIMESTAMP_SHIFT) | self.node_bits
+        self.acquire()
+        last_id = self.last_id
+        if candidate > last_id:
+            last_id = candidate
+        elif last_id & SEQUENCE_MASK != SEQUENCE_MASK:
+            last_id += 1
+        else:
+            # Sequence exhausted: borrow the next millisecond
+            last_id = (((last_id >> TIMESTAMP_SHIFT) + 1) << TIMESTAMP_SHIFT) | self.node_bits
+        self.last_id = last_id
+        self.release()
+        return last_id
+
+    def prefix(self, snowflake_id):
+        # "IQyy" for the Baghdad year the ID was made in, recomputed once a year
+        timestamp_ms = (snowflake_id >> TIMESTAMP_SHIFT) + EPOCH_MS
+        if timestamp_ms >= self.year_end_ms or self.year_prefix is None:
+            # Imported here: helpers imports this module for its generator
+            from helpers import baghdad_tz
+            now = datetime.fromtimestamp(timestamp_ms / 1000, baghdad_tz)
+            year_end = baghdad_tz.localize(datetime(now.year + 1, 1, 1))
+            self.year_prefix = f"IQ{now.strftime('%y')}"
+            self.year_end_ms = int(year_end.timestamp() * 1000)
+        return self.year_prefix
+
+    def next_transaction_id(self, user_id=None):
+        snowflake_id = self.next_id()
+        if user_id is None:
+            return f"{self.prefix(snowflake_id)}-{snowflake_id:X}"
+        return f"{self.prefix(snowflake_id)}-{user_id}-{snowflake_id:X}"
+
+class NodeLease:
+    # Keeps a node id reserved in the database for this process, so processes
+    # need no NODE_ID of their own, even in containers that all run as PID 1.
+    # The lease is renewed every ttl / 3 seconds; if it was lost anyway (the
+    # process stalled for longer than ttl), a new node id is leased and the
+    # generator moves to it.
+
+    def __init__(self, storage, generator, ttl=NODE_LEASE_TTL):
+        self.storage = storage
+        self.generator = generator
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.node_id = None
+
+    def acquire(self):
+        node_id = self.storage.lease_node_id(self.owner, self.ttl)
+        if node_id is None:
+            raise RuntimeError(f"No free node id: all {MAX_NODE_ID} are leased, set NODE_ID instead")
+        self.node_id = node_id
+        self.generator.set_node_id(node_id)
+        print(f"Leased node id {node_id}")
+
+    def start(self):
+        self.acquire()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            try:
+                if not self.storage.renew_node_id(self.node_id, self.owner, self.ttl):
+                    print(f"Lease of node id {self.node_id} was lost")
+                    self.acquire()
+            except Exception as e:
+                print(f"Node lease error: {e}")
+
+def generate_ids(node_id, count):
+    generator = SnowflakeGenerator(node_id)
+    return [generator.next_id() for _ in range(count)]
+
+def benchmark(count):
+    generator = SnowflakeGenerator(0)
+    start = time.perf_counter()
+    for _ in range(count):
+        generator.next_id()
+    raw = (time.perf_counter() - start) / count
+    start = time.perf_counter()
+    for _ in range(count):
+        generator.next_transaction_id()
+    formatted = (time.perf_counter() - start) / count
+    print(f"next_id: {raw * 1e9:.0f} ns/call, next_transaction_id: {formatted * 1e9:.0f} ns/call")
+
+def collision_test(count, processes, threads):
+    # Processes with different node ids, plus threads sharing one generator
+    with multiprocessing.Pool(processes) as pool:
+        batches = pool.starmap(generate_ids, [(node_id, count) for node_id in range(processes)])
+
+    generator = SnowflakeGenerator(processes)
+    shared = [[] for _ in range(threads)]
+
+    def run(ids):
+        for _ in range(count // threads):
+            ids.append(generator.next_id())
+
+    workers = [threading.Thread(target=run, args=(ids,)) for ids in shared]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    total = 0
+    seen = set()
+    for ids in batches + shared:
+        if any(a >= b for a, b in zip(ids, ids[1:])):
+            raise AssertionError("IDs from one generator are not increasing")
+        total += len(ids)
+        seen.update(ids)
+    print(f"{total} IDs from {processes} processes and {threads} threads, {total - len(seen)} collisions")
+    if len(seen) != total:
+        raise AssertionError("Duplicate IDs generated")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark and collision test for the Snowflake ID generator")
+    parser.add_argument('--count', type=int, default=1000000, help="IDs per process")
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+    benchmark(args.count)
+    collision_test(args.count, args.processes, args.threads)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import csv
+import io
+from datetime import datetime, timedelta
+from helpers import baghdad_tz, as_utc
+from journal import get_user_balance_at
+
+# Monthly statements: a user's transactions for one month (Baghdad time) as a CSV
+# document. Rows are read in batches from the (user_id, timestamp, _id) index and
+# written as they arrive into a spooled temporary file, which stays in memory
+# up to SPOOL_SIZE bytes and moves to disk beyond that. The opening and closing
+# balances come from the journal when it covers the month.
+#
+# Sent documents are cached by Telegram file_id per (user, month): a past month
+# is sent again from the cache if the statement was generated after the month
+# ended, any other while the user has no newer transaction than the cached
+# statement.
+
+# Months offered in the statement menu, the current one included
+STATEMENT_MONTHS = 6
+
+# Bytes of a statement kept in memory before it is spooled to disk
+SPOOL_SIZE = 1024 * 1024
+
+COLUMNS = ['date', 'transaction_id', 'type', 'amount', 'balance', 'details']
+
+def get_month_range(month):
+    # 'YYYY-MM' -> (first instant, first instant of the next month) in Baghdad time
+    start = datetime.strptime(month, '%Y-%m')
+    end = (start + timedelta(days=32)).replace(day=1)
+    return baghdad_tz.localize(start), baghdad_tz.localize(end)
+
+def get_recent_months(now, count=STATEMENT_MONTHS):
+    months = []
+    month_start = now.astimezone(baghdad_tz).replace(day=1)
+    for _ in range(count):
+        months.append(month_start.strftime('%Y-%m'))
+        month_start = (month_start - timedelta(days=1)).replace(day=1)
+    return months
+
+def is_month_closed(month, now):
+    return as_utc(get_month_range(month)[1]) <= as_utc(now)
+
+def get_statement_filename(month):
+    return f"statement-{month}.csv"
+
+class StatementWriter:
+    # Writes the CSV rows of one statement to a binary file; the balance column
+    # is filled in when the opening balance is known
+
+    def __init__(self, file, month, opening_balance=None):
+        self.text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+        self.writer = csv.writer(self.text)
+        self.balance = opening_balance
+        self.count = 0
+        self.start, self.end = get_month_range(month)
+        self.writer.writerow(COLUMNS)
+        self.writer.writerow([self.start.isoformat(), '', 'opening_balance', '', self.format_balance(), ''])
+
+    def format_balance(self):
+        return '' if self.balance is None else f"{self.balance:.2f}"
+
+    def write(self, transactions):
+        for transaction in transactions:
+            if self.balance is not None:
+                self.balance += transaction['amount']
+            timestamp = as_utc(transaction['timestamp']).astimezone(baghdad_tz)
+            self.writer.writerow([
+                timestamp.isoformat(), transaction['transaction_id'], transaction['type'],
+                f"{transaction['amount']:.2f}", self.format_balance(), format_details(transaction.get('details'))
+            ])
+            self.count += 1
+
+    def close(self):
+        # Leaves the underlying file open for sending
+        self.writer.writerow([self.end.isoformat(), '', 'closing_balance', '', self.format_balance(), ''])
+        self.text.flush()
+        self.text.detach()
+        return self.count
+
+def format_details(details):
+    if not details:
+        return ''
+    return ' '.join(f"{key}={value}" for key, value in details.items())
+
+async def get_opening_balance(storage, user_id, month):
+    start, _ = get_month_range(month)
+    return await get_user_balance_at(storage, user_id, start - timedelta(microseconds=1))
+
+async def render_statement(storage, user_id, month, file, batch_size=500):
+    # Awaits the storage like the flows in flows.py; batches are read one
+    # keyset page at a time. Returns the number of transactions written.
+    start, end = get_month_range(month)
+    writer = StatementWriter(file, month, await get_opening_balance(storage, user_id, month))
+    batch = await storage.get_transaction_batch(user_id, start, end, limit=batch_size)
+    while batch:
+        writer.write(batch)
+        batch = await storage.get_transaction_batch(user_id, start, end, after=batch[-1], limit=batch_size)
+    return writer.close()
+
+def get_latest_transaction_id(user):
+    # _id of the user's newest ledger entry, from the recent activity array
+    recent = (user or {}).get('recent')
+    return recent[-1]['_id'] if recent else None
+
+def is_cache_valid(cached, month, now, latest_transaction_id):
+    if not cached:
+        return False
+    # One generated before the month ended misses the rest of it
+    if is_month_closed(month, now) and cached.get('created_at') and is_month_closed(month, cached['created_at']):
+        return True
+    return cached.get('last_transaction') == latest_transaction_id
@@ -0,0 +1,1441 @@
+import threading
+import bisect
+from collections import Counter
+from datetime import timedelta
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne, ReturnDocument, ASCENDING, DESCENDING, monitoring
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from snowflake import MAX_NODE_ID
+from journal import build_transaction_entry, build_transfer_entry, build_leg_sum_pipeline
+from helpers import (
+    INDEXES, LIQUIDITY_BUCKET_SIZE, RECENT_ACTIVITY_SIZE, TOTAL_BALANCE_PIPELINE, get_current_time, build_transaction,
+    build_liquidity_change, build_recent_push, get_history_key, build_history_query, build_statement_query, split_repayment,
+    build_repayment_update, build_balance_change, build_gift_claim, build_stats_updates, build_transfer, build_repayment
+)
+
+# Liquidity the bot starts with when no liquidity document exists yet
+INITIAL_LIQUIDITY = 100
+
+# bot_stats documents recording that a one-off migration has finished
+USER_DOCUMENTS_MIGRATION = 'migration_user_documents'
+LOANS_MIGRATION = 'migration_loans'
+
+class Storage:
+    # Repository interface used by the bot for balances, transactions, loans,
+    # transfer requests and stats. MongoStorage is the production backend,
+    # MemoryStorage keeps everything in process for benchmarks and load tests.
+
+    def ensure_indexes(self):
+        pass
+
+    def check_query_plans(self):
+        pass
+
+    def migrate_liquidity_history(self):
+        pass
+
+    def migrate_user_documents(self):
+        pass
+
+    def migrate_loans(self):
+        pass
+
+    def ping(self):
+        raise NotImplementedError
+
+    def op_counts(self):
+        raise NotImplementedError
+
+    # Users
+    def get_user(self, user_id):
+        raise NotImplementedError
+
+    def change_user_balance(self, user_id, amount, min_balance=None, transaction=None):
+        # Atomically add amount to the balance and the total user balance counter.
+        # With min_balance the change only applies while balance >= min_balance;
+        # returns the updated user document or None. A transaction is appended to
+        # the user's recent array in the same write and then to the ledger.
+        raise NotImplementedError
+
+    def set_user_fields(self, user_id, fields):
+        raise NotImplementedError
+
+    def claim_daily_gift(self, user_id, amount, transaction, interval):
+        # One conditional write adding the gift and setting last_gift, applied only
+        # when last_gift is missing or older than interval. Returns the updated
+        # user or None when already claimed. The total user balance counter is
+        # left to record_gift_window.
+        raise NotImplementedError
+
+    def record_gift_window(self, window_start, claims, rejected, amount):
+        # Books a window of gift claims at once: the total user balance counter,
+        # with the amount booked per window, and the claim metrics for the window
+        raise NotImplementedError
+
+    def get_total_user_balance(self):
+        raise NotImplementedError
+
+    def reconcile_total_user_balance(self, pending_since=None):
+        # Recomputes the counter from the balances. Gift windows starting at or
+        # after pending_since may not be booked yet: their claims are taken out
+        # of the balances and only what was booked of them is counted.
+        raise NotImplementedError
+
+    # Transactions
+    def log_transaction(self, transaction):
+        raise NotImplementedError
+
+    def get_transaction_history(self, user_id, limit=10):
+        raise NotImplementedError
+
+    def get_transaction_page(self, user_id, limit, cursor=None, newer=False):
+        # Up to limit transactions after the (timestamp_us, _id) cursor: older ones
+        # newest first, or with newer=True newer ones oldest first
+        raise NotImplementedError
+
+    def get_transaction_batch(self, user_id, start, end, after=None, limit=500):
+        # Up to limit of the user's transactions with start <= timestamp < end,
+        # oldest first, after the transaction after (the last one of the
+        # previous batch)
+        raise NotImplementedError
+
+    # Statements
+    def get_statement(self, user_id, month):
+        raise NotImplementedError
+
+    def save_statement(self, user_id, month, file_id, last_transaction, created_at=None):
+        # Telegram file_id of the user's statement for month; last_transaction
+        # is the newest ledger entry of the user and created_at the time (now
+        # with None) when it was generated
+        raise NotImplementedError
+
+    # Liquidity
+    def get_bot_liquidity(self):
+        raise NotImplementedError
+
+    def update_bot_liquidity(self, amount, reason=None):
+        raise NotImplementedError
+
+    # Transfers
+    def insert_transfer_request(self, transfer_request):
+        raise NotImplementedError
+
+    def delete_transfer_request(self, transfer_id, sender_id):
+        raise NotImplementedError
+
+    def execute_transfer(self, transfer_id, sender_id):
+        # Claim the pending request and move the funds atomically; returns
+        # (status, transfer_request, round_trips)
+        raise NotImplementedError
+
+    # Loans
+    def get_user_loans(self, user_id):
+        raise NotImplementedError
+
+    def get_open_loan(self, loan_id, user_id):
+        raise NotImplementedError
+
+    def insert_loan(self, loan):
+        raise NotImplementedError
+
+    def mark_loan_paid(self, loan_id):
+        raise NotImplementedError
+
+    def repay_loan(self, loan_id, user_id, amount=None, auto=False):
+        # Pay amount (everything left with None) off an open loan: the loan's
+        # remaining amount, the user's balance and loan_due, the liquidity and the
+        # ledger change together or not at all. The debit only applies while the
+        # balance covers it. Returns (status, repayment)
+        raise NotImplementedError
+
+    # Loan accrual
+    def iter_loans_to_accrue(self, accrued_before, after_id=None, batch_size=1000):
+        # Open loans last accrued at or before accrued_before (or never), in _id
+        # order after after_id, streamed batch_size documents at a time
+        raise NotImplementedError
+
+    def apply_loan_accruals(self, loan_updates, user_updates):
+        # loan_updates apply only while the loan is open and still has the
+        # last_accrued it was read with; user_updates add to loan_due once per
+        # marker, kept per loan in the user's loan_accruals, so replaying either
+        # after a crash charges nothing twice
+        raise NotImplementedError
+
+    # Snowflake node ids
+    def lease_node_id(self, owner, ttl):
+        # Reserves a node id (1 to MAX_NODE_ID) for owner for ttl seconds: an
+        # expired lease first, else one never leased. None when all are taken.
+        raise NotImplementedError
+
+    def renew_node_id(self, node_id, owner, ttl):
+        # False when the lease expired and another owner took it over
+        raise NotImplementedError
+
+    def count_node_leases(self):
+        # Leases not expired yet: bot processes running without NODE_ID
+        raise NotImplementedError
+
+    # Checkpoints of background jobs
+    def get_checkpoint(self, name):
+        raise NotImplementedError
+
+    def save_checkpoint(self, name, state):
+        raise NotImplementedError
+
+    # Ledger reconciliation
+    def iter_ledger_by_user(self, after_user_id=None, user_ids=None, batch_size=1000):
+        # Per user sums of the ledger in user_id order: {'_id': user_id, 'ledger',
+        # 'gifts', 'count'}, for user_ids or every user after after_user_id
+        raise NotImplementedError
+
+    def iter_user_balances(self, after_user_id=None, user_ids=None, batch_size=1000):
+        # {'user_id', 'balance'} in user_id order, selected like iter_ledger_by_user
+        raise NotImplementedError
+
+    def iter_users_touched_since(self, since, batch_size=1000):
+        # user_id of every user with a ledger row at or after since, in order
+        raise NotImplementedError
+
+    def get_liquidity_history_net(self):
+        raise NotImplementedError
+
+    def record_reconciliation_mismatches(self, mismatches):
+        raise NotImplementedError
+
+    # Exports: documents with since < timestamp <= until (no lower bound with
+    # since None) in timestamp order, streamed batch_size at a time
+    def iter_transactions_between(self, since, until, batch_size=1000):
+        raise NotImplementedError
+
+    def iter_loans_between(self, since, until, batch_size=1000):
+        # Loans by the time they last changed (updated_at: taken, repaid,
+        # charged or paid), as they are now
+        raise NotImplementedError
+
+    def iter_liquidity_changes_between(self, since, until, batch_size=1000):
+        # Individual changes out of the hourly history buckets, in bucket order
+        raise NotImplementedError
+
+    # Journal
+    def post_journal_entries(self, entries):
+        # Appends entries; one whose entry_id is already posted is skipped
+        raise NotImplementedError
+
+    def sum_account_legs(self, account, after=None, until=None):
+        # Sum of the account's legs with after < timestamp <= until
+        raise NotImplementedError
+
+    def sum_accounts_legs(self, accounts):
+        # {account: sum of all its legs} for the accounts with legs
+        raise NotImplementedError
+
+    def get_latest_snapshot(self, account, at=None):
+        # The account's latest snapshot taken at or before at
+        raise NotImplementedError
+
+    def get_latest_snapshots(self, accounts, before):
+        # {account: latest snapshot taken before before} for accounts
+        raise NotImplementedError
+
+    def iter_account_deltas(self, since, until, after_account=None, batch_size=1000):
+        # {'_id': account, 'delta', 'legs'} of the legs with since < timestamp
+        # <= until (no lower bound with since None), in account order after
+        # after_account
+        raise NotImplementedError
+
+    def insert_snapshots(self, snapshots):
+        # Snapshots already taken for the same account and timestamp are skipped
+        raise NotImplementedError
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.counts = Counter()
+
+    def started(self, event):
+        self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+class MongoStorage(Storage):
+    def __init__(self, uri, database='bank_bot'):
+        self.command_counter = CommandCounter()
+        self.client = MongoClient(uri, event_listeners=[self.command_counter])
+        self.db = self.client[database]
+        self.users_collection = self.db['users']
+        self.transactions_collection = self.db['transactions']
+        self.bot_stats_collection = self.db['bot_stats']
+        self.transfer_requests_collection = self.db['transfer_requests']
+        self.loans_collection = self.db['loans']
+        self.liquidity_history_collection = self.db['liquidity_history']
+        self.gift_windows_collection = self.db['gift_windows']
+        self.reconciliation_mismatches_collection = self.db['reconciliation_mismatches']
+        self.journal_collection = self.db['journal']
+        self.journal_snapshots_collection = self.db['journal_snapshots']
+        self.statements_collection = self.db['statements']
+        self.node_leases_collection = self.db['node_leases']
+
+    # Indexes
+    def ensure_indexes(self):
+        for collection_name, keys, unique in INDEXES:
+            self.db[collection_name].create_index(keys, unique=unique)
+
+    def check_query_plans(self):
+        collection_scans = []
+        for name, cursor in get_bot_queries(self.db):
+            plan = cursor.explain()['queryPlanner']['winningPlan']
+            if 'COLLSCAN' in find_plan_stages(plan):
+                collection_scans.append(name)
+        if collection_scans:
+            raise RuntimeError(f"Queries planned as COLLSCAN: {', '.join(collection_scans)}")
+
+    def migrate_liquidity_history(self):
+        # Move the legacy history array off the hot liquidity document
+        stats = self.bot_stats_collection.find_one({'_id': 'liquidity', 'history': {'$exists': True}})
+        if not stats:
+            return
+        buckets = build_liquidity_buckets(stats['history'])
+        if buckets:
+            self.liquidity_history_collection.insert_many(buckets)
+        self.bot_stats_collection.update_one({'_id': 'liquidity'}, {'$unset': {'history': ''}})
+
+    def migrate_user_documents(self):
+        # Backfill the recent activity array and the open loan total of users
+        # created before they were kept on the user document. Runs once: the
+        # filter is not indexed, so every restart would scan all users
+        if self.get_checkpoint(USER_DOCUMENTS_MIGRATION):
+            return
+        for user in self.users_collection.find({'recent': {'$exists': False}}, {'user_id': 1}):
+            transactions = self.transactions_collection.find({'user_id': user['user_id']}).sort('timestamp', -1).limit(RECENT_ACTIVITY_SIZE)
+            fields = build_user_backfill(list(transactions), self.get_user_loans(user['user_id']))
+            self.users_collection.update_one({'_id': user['_id']}, {'$set': fields})
+        self.save_checkpoint(USER_DOCUMENTS_MIGRATION, {'finished_at': get_current_time()})
+
+    def migrate_loans(self):
+        # Runs once, like migrate_user_documents: both filters scan all loans
+        if self.get_checkpoint(LOANS_MIGRATION):
+            return
+        for query, update in build_loan_migrations():
+            self.loans_collection.update_many(query, update)
+        self.save_checkpoint(LOANS_MIGRATION, {'finished_at': get_current_time()})
+
+    def ping(self):
+        self.client.admin.command('ping')
+
+    def op_counts(self):
+        return dict(self.command_counter.counts)
+
+    # Users
+    def get_user(self, user_id):
+        return self.users_collection.find_one({'user_id': user_id})
+
+    def change_user_balance(self, user_id, amount, min_balance=None, transaction=None):
+        # The balance, the running total and the ledger rows commit together
+        query, update, upsert = build_balance_change(user_id, amount, min_balance, transaction)
+        if transaction:
+            entry = build_transaction_entry(transaction)
+        state = {}
+
+        def run(session):
+            state.clear()
+            user = self.users_collection.find_one_and_update(
+                query,
+                update,
+                upsert=upsert,
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            if not user:
+                session.abort_transaction()
+                return
+            self.bot_stats_collection.update_one(
+                {'_id': 'user_balances'},
+                {'$inc': {'total': amount}},
+                upsert=True,
+                session=session
+            )
+            if transaction:
+                self.transactions_collection.insert_one(transaction, session=session)
+                self.journal_collection.insert_one(entry, session=session)
+            state['user'] = user
+
+        with self.client.start_session() as session:
+            session.with_transaction(run)
+        return state.get('user')
+
+    def set_user_fields(self, user_id, fields):
+        return self.users_collection.find_one_and_update(
+            {'user_id': user_id},
+            {'$set': fields},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    def claim_daily_gift(self, user_id, amount, transaction, interval):
+        query, update = build_gift_claim(user_id, amount, transaction, interval)
+        entry = build_transaction_entry(transaction)
+        try:
+            user = self.users_collection.find_one_and_update(
+                query,
+                update,
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The user exists but the filter did not match: claimed within interval
+            return None
+        self.transactions_collection.insert_one(transaction)
+        self.journal_collection.insert_one(entry)
+        return user
+
+    def record_gift_window(self, window_start, claims, rejected, amount):
+        if amount:
+            self.bot_stats_collection.update_one(
+                {'_id': 'user_balances'},
+                {'$inc': {'total': amount, 'gift_flushes': 1, f"booked_gifts.{get_gift_window_key(window_start)}": amount}},
+                upsert=True
+            )
+        self.gift_windows_collection.update_one(
+            {'window': window_start},
+            {'$inc': {'claims': claims, 'rejected': rejected, 'amount': amount}},
+            upsert=True
+        )
+
+    def get_total_user_balance(self):
+        stats = self.bot_stats_collection.find_one({'_id': 'user_balances'})
+        if not stats:
+            return self.reconcile_total_user_balance()
+        return stats['total']
+
+    def reconcile_total_user_balance(self, pending_since=None):
+        while True:
+            stats = self.bot_stats_collection.find_one({'_id': 'user_balances'}) or {}
+            result = list(self.users_collection.aggregate(TOTAL_BALANCE_PIPELINE))
+            total = result[0]['total'] if result else 0
+            update = {'$set': {'total': total, 'reconciled_at': get_current_time()}}
+            if pending_since is not None:
+                result = list(self.transactions_collection.aggregate([
+                    {'$match': {'timestamp': {'$gte': pending_since}, 'type': 'daily_gift'}},
+                    {'$group': {'_id': None, 'total': {'$sum': '$amount'}}}
+                ]))
+                booked, stale = split_booked_gifts(stats.get('booked_gifts', {}), pending_since)
+                total += booked - (result[0]['total'] if result else 0)
+                update['$set']['total'] = total
+                if stale:
+                    update['$unset'] = {f"booked_gifts.{key}": '' for key in stale}
+            try:
+                # Only if no window was booked meanwhile; its $inc would be lost
+                self.bot_stats_collection.update_one(
+                    {'_id': 'user_balances', 'gift_flushes': stats.get('gift_flushes')}, update, upsert=True
+                )
+            except DuplicateKeyError:
+                continue
+            return total
+
+    # Transactions
+    def log_transaction(self, transaction):
+        self.transactions_collection.insert_one(transaction)
+
+    def get_transaction_history(self, user_id, limit=10):
+        transactions = self.transactions_collection.find({'user_id': user_id}).sort('timestamp', -1).limit(limit)
+        return list(transactions)
+
+    def get_transaction_page(self, user_id, limit, cursor=None, newer=False):
+        query, sort = build_history_query(user_id, cursor, newer)
+        return list(self.transactions_collection.find(query).sort(sort).limit(limit))
+
+    def get_transaction_batch(self, user_id, start, end, after=None, limit=500):
+        # The history index walked backwards, so nothing is sorted in memory
+        query, sort = build_statement_query(user_id, start, end, after)
+        return list(self.transactions_collection.find(query).sort(sort).limit(limit))
+
+    # Statements
+    def get_statement(self, user_id, month):
+        return self.statements_collection.find_one({'user_id': user_id, 'month': month})
+
+    def save_statement(self, user_id, month, file_id, last_transaction, created_at=None):
+        self.statements_collection.update_one(
+            {'user_id': user_id, 'month': month},
+            {'$set': {'file_id': file_id, 'last_transaction': last_transaction, 'created_at': created_at or get_current_time()}},
+            upsert=True
+        )
+
+    # Liquidity
+    def get_bot_liquidity(self):
+        stats = self.bot_stats_collection.find_one({'_id': 'liquidity'})
+        if not stats:
+            self.bot_stats_collection.insert_one({'_id': 'liquidity', 'amount': INITIAL_LIQUIDITY})
+            return INITIAL_LIQUIDITY
+        return stats['amount']
+
+    def update_bot_liquidity(self, amount, reason=None):
+        current_time = get_current_time()
+        self.bot_stats_collection.update_one(
+            {'_id': 'liquidity'},
+            {'$inc': {'amount': amount}},
+            upsert=True
+        )
+        self.record_liquidity_change(amount, reason, current_time)
+
+    def record_liquidity_change(self, amount, reason, current_time, session=None):
+        query, update = build_liquidity_change(amount, reason, current_time)
+        self.liquidity_history_collection.update_one(query, update, upsert=True, session=session)
+
+    # Transfers
+    def insert_transfer_request(self, transfer_request):
+        self.transfer_requests_collection.insert_one(transfer_request)
+
+    def delete_transfer_request(self, transfer_id, sender_id):
+        result = self.transfer_requests_collection.delete_one({'transfer_id': transfer_id, 'sender_id': sender_id})
+        return result.deleted_count > 0
+
+    def execute_transfer(self, transfer_id, sender_id):
+        # Claim the request, move the funds, book the fee and write the ledger in one
+        # multi-document transaction. The debit only applies while balance >= total.
+        state = {'round_trips': 0, 'transfer_request': None}
+
+        def run(session):
+            state['round_trips'] = 0
+            state['transfer_request'] = None
+
+            transfer_request = self.transfer_requests_collection.find_one_and_delete(
+                {'transfer_id': transfer_id, 'sender_id': sender_id, 'status': 'pending'},
+                session=session
+            )
+            state['round_trips'] += 1
+            if not transfer_request:
+                session.abort_transaction()
+                return 'not_found'
+            state['transfer_request'] = transfer_request
+
+            fee = transfer_request['fee']
+            transfer_out, transfer_in, user_updates = build_transfer(transfer_request)
+            result = self.users_collection.bulk_write(user_updates, ordered=True, session=session)
+            state['round_trips'] += 1
+            if result.matched_count + result.upserted_count < 2:
+                session.abort_transaction()
+                return 'insufficient_funds'
+
+            current_time = get_current_time()
+            self.bot_stats_collection.bulk_write(build_stats_updates(fee, -fee), session=session)
+            state['round_trips'] += 1
+
+            self.record_liquidity_change(fee, 'transfer_fee', current_time, session=session)
+            state['round_trips'] += 1
+
+            self.transactions_collection.insert_many([transfer_out, transfer_in], session=session)
+            state['round_trips'] += 1
+
+            self.journal_collection.insert_one(build_transfer_entry(transfer_out, transfer_in), session=session)
+            state['round_trips'] += 1
+            return 'completed'
+
+        with self.client.start_session() as session:
+            status = session.with_transaction(run)
+        if status == 'completed':
+            state['round_trips'] += 1  # commit
+        return status, state['transfer_request'], state['round_trips']
+
+    # Loans
+    def get_user_loans(self, user_id):
+        return list(self.loans_collection.find({'user_id': user_id, 'paid': False}))
+
+    def get_open_loan(self, loan_id, user_id):
+        return self.loans_collection.find_one({'loan_id': loan_id, 'user_id': user_id, 'paid': False})
+
+    def insert_loan(self, loan):
+        loan.setdefault('updated_at', loan['timestamp'])
+        self.loans_collection.insert_one(loan)
+        self.users_collection.update_one({'user_id': loan['user_id']}, {'$inc': {'loan_due': loan['total_to_repay']}})
+
+    def mark_loan_paid(self, loan_id):
+        loan = self.loans_collection.find_one_and_update({'loan_id': loan_id, 'paid': False}, {'$set': {'paid': True, 'updated_at': get_current_time()}})
+        if loan:
+            self.users_collection.update_one({'user_id': loan['user_id']}, {'$inc': {'loan_due': -loan['remaining']}})
+
+    def repay_loan(self, loan_id, user_id, amount=None, auto=False):
+        state = {}
+
+        def run(session):
+            state.clear()
+            loan = self.loans_collection.find_one_and_update(
+                {'loan_id': loan_id, 'user_id': user_id, 'paid': False, 'remaining': {'$gt': 0}},
+                build_repayment_update(get_current_time(), amount),
+                session=session
+            )
+            if not loan:
+                session.abort_transaction()
+                return 'not_found'
+
+            repaid, left, transaction, query, update = build_repayment(loan, user_id, amount, auto)
+            user = self.users_collection.find_one_and_update(
+                query,
+                update,
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            if not user:
+                session.abort_transaction()
+                return 'insufficient_funds'
+
+            self.bot_stats_collection.bulk_write(build_stats_updates(repaid, -repaid), session=session)
+            self.record_liquidity_change(repaid, 'loan_repayment', transaction['timestamp'], session=session)
+            self.transactions_collection.insert_one(transaction, session=session)
+            self.journal_collection.insert_one(build_transaction_entry(transaction), session=session)
+            state['repayment'] = {'amount': repaid, 'remaining': left, 'balance': user['balance'], 'transaction': transaction}
+            return 'completed'
+
+        with self.client.start_session() as session:
+            status = session.with_transaction(run)
+        return status, state.get('repayment')
+
+    # Loan accrual
+    def iter_loans_to_accrue(self, accrued_before, after_id=None, batch_size=1000):
+        query = {'paid': False, '$or': [
+            {'last_accrued': {'$lte': accrued_before}},
+            {'last_accrued': {'$exists': False}}
+        ]}
+        if after_id is not None:
+            query['_id'] = {'$gt': after_id}
+        return self.loans_collection.find(query).sort('_id', ASCENDING).batch_size(batch_size)
+
+    def apply_loan_accruals(self, loan_updates, user_updates):
+        current_time = get_current_time()
+        if loan_updates:
+            self.loans_collection.bulk_write([
+                UpdateOne(
+                    {'_id': update['_id'], 'paid': False, 'last_accrued': update['previous']},
+                    {
+                        '$inc': {
+                            'total_to_repay': update['interest'] + update['penalty'],
+                            'remaining': update['interest'] + update['penalty'],
+                            'interest': update['interest'],
+                            'penalty': update['penalty']
+                        },
+                        '$set': dict(
+                            {key: update[key] for key in ('last_accrued', 'due_date') if key in update},
+                            updated_at=current_time
+                        )
+                    }
+                )
+                for update in loan_updates
+            ], ordered=False)
+        if user_updates:
+            self.users_collection.bulk_write([
+                UpdateOne(
+                    {'user_id': update['user_id'], f"loan_accruals.{update['loan_id']}": {'$ne': update['marker']}},
+                    {'$inc': {'loan_due': update['amount']}, '$set': {f"loan_accruals.{update['loan_id']}": update['marker']}}
+                )
+                for update in user_updates
+            ], ordered=False)
+
+    # Snowflake node ids
+    def lease_node_id(self, owner, ttl):
+        now = get_current_time()
+        lease = {'owner': owner, 'expires_at': now + timedelta(seconds=ttl)}
+        expired = self.node_leases_collection.find_one_and_update(
+            {'expires_at': {'$lt': now}}, {'$set': lease}, sort=[('_id', ASCENDING)]
+        )
+        if expired:
+            return expired['_id']
+        while True:
+            leased = {row['_id'] for row in self.node_leases_collection.find({}, {'_id': True})}
+            free = [node_id for node_id in range(1, MAX_NODE_ID + 1) if node_id not in leased]
+            if not free:
+                return None
+            try:
+                self.node_leases_collection.insert_one(dict(lease, _id=free[0]))
+                return free[0]
+            except DuplicateKeyError:
+                # Another process claimed it first
+                continue
+
+    def renew_node_id(self, node_id, owner, ttl):
+        result = self.node_leases_collection.update_one(
+            {'_id': node_id, 'owner': owner},
+            {'$set': {'expires_at': get_current_time() + timedelta(seconds=ttl)}}
+        )
+        return result.matched_count == 1
+
+    def count_node_leases(self):
+        return self.node_leases_collection.count_documents({'expires_at': {'$gte': get_current_time()}})
+
+    # Checkpoints of background jobs
+    def get_checkpoint(self, name):
+        return self.bot_stats_collection.find_one({'_id': name})
+
+    def save_checkpoint(self, name, state):
+        self.bot_stats_collection.replace_one({'_id': name}, state, upsert=True)
+
+    # Ledger reconciliation
+    def iter_ledger_by_user(self, after_user_id=None, user_ids=None, batch_size=1000):
+        # Grouped on the server; allowDiskUse lets the group spill instead of
+        # failing on large ledgers
+        pipeline = [
+            {'$match': build_user_range(after_user_id, user_ids)},
+            {'$group': {
+                '_id': '$user_id',
+                'ledger': {'$sum': '$amount'},
+                'gifts': {'$sum': {'$cond': [{'$eq': ['$type', 'daily_gift']}, '$amount', 0]}},
+                'count': {'$sum': 1}
+            }},
+            {'$sort': {'_id': 1}}
+        ]
+        return self.transactions_collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+
+    def iter_user_balances(self, after_user_id=None, user_ids=None, batch_size=1000):
+        return self.users_collection.find(
+            build_user_range(after_user_id, user_ids),
+            {'_id': False, 'user_id': True, 'balance': True}
+        ).sort('user_id', ASCENDING).batch_size(batch_size)
+
+    def iter_users_touched_since(self, since, batch_size=1000):
+        pipeline = [
+            {'$match': {'timestamp': {'$gte': since}, 'user_id': {'$ne': None}}},
+            {'$group': {'_id': '$user_id'}},
+            {'$sort': {'_id': 1}}
+        ]
+        return (row['_id'] for row in self.transactions_collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size))
+
+    def get_liquidity_history_net(self):
+        result = list(self.liquidity_history_collection.aggregate([
+            {'$group': {'_id': None, 'net': {'$sum': '$net'}}}
+        ]))
+        return result[0]['net'] if result else 0
+
+    def record_reconciliation_mismatches(self, mismatches):
+        if mismatches:
+            self.reconciliation_mismatches_collection.insert_many(mismatches)
+
+    # Exports
+    def iter_transactions_between(self, since, until, batch_size=1000):
+        # Sorted on the timestamp index alone, so nothing is sorted in memory
+        query = {'timestamp': build_time_range(since, until)}
+        return self.transactions_collection.find(query).sort('timestamp', ASCENDING).batch_size(batch_size)
+
+    def iter_loans_between(self, since, until, batch_size=1000):
+        query = {'updated_at': build_time_range(since, until)}
+        return self.loans_collection.find(query).sort('updated_at', ASCENDING).batch_size(batch_size)
+
+    def iter_liquidity_changes_between(self, since, until, batch_size=1000):
+        # Buckets are read in hour order on the (hour, count) index and unwound
+        # to their changes, which are in the order they were appended; sorting
+        # the changes themselves would hold them all in the aggregation
+        hour = {'$lte': until}
+        if since is not None:
+            hour['$gte'] = since.replace(minute=0, second=0, microsecond=0)
+        pipeline = [
+            {'$match': {'hour': hour}},
+            {'$sort': {'hour': 1}},
+            {'$unwind': '$changes'},
+            {'$replaceRoot': {'newRoot': '$changes'}},
+            {'$match': {'timestamp': build_time_range(since, until)}}
+        ]
+        return self.liquidity_history_collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+
+    # Journal
+    def post_journal_entries(self, entries):
+        insert_ignoring_duplicates(self.journal_collection, entries)
+
+    def sum_account_legs(self, account, after=None, until=None):
+        result = list(self.journal_collection.aggregate(build_leg_sum_pipeline(account, after, until)))
+        return result[0]['total'] if result else 0
+
+    def sum_accounts_legs(self, accounts):
+        accounts = list(accounts)
+        pipeline = [
+            {'$match': {'legs.account': {'$in': accounts}}},
+            {'$unwind': '$legs'},
+            {'$match': {'legs.account': {'$in': accounts}}},
+            {'$group': {'_id': '$legs.account', 'total': {'$sum': '$legs.amount'}}}
+        ]
+        return {row['_id']: row['total'] for row in self.journal_collection.aggregate(pipeline)}
+
+    def get_latest_snapshot(self, account, at=None):
+        # One seek on the (account, timestamp) index
+        query = {'account': account}
+        if at is not None:
+            query['timestamp'] = {'$lte': at}
+        return self.journal_snapshots_collection.find_one(query, sort=[('timestamp', DESCENDING)])
+
+    def get_latest_snapshots(self, accounts, before):
+        pipeline = [
+            {'$match': {'account': {'$in': list(accounts)}, 'timestamp': {'$lt': before}}},
+            {'$sort': {'account': 1, 'timestamp': -1}},
+            {'$group': {'_id': '$account', 'snapshot': {'$first': '$$ROOT'}}}
+        ]
+        return {row['_id']: row['snapshot'] for row in self.journal_snapshots_collection.aggregate(pipeline)}
+
+    def iter_account_deltas(self, since, until, after_account=None, batch_size=1000):
+        timestamp = {'$lte': until}
+        if since is not None:
+            timestamp['$gt'] = since
+        pipeline = [{'$match': {'timestamp': timestamp}}, {'$unwind': '$legs'}]
+        if after_account is not None:
+            pipeline.append({'$match': {'legs.account': {'$gt': after_account}}})
+        pipeline += [
+            {'$group': {'_id': '$legs.account', 'delta': {'$sum': '$legs.amount'}, 'legs': {'$sum': 1}}},
+            {'$sort': {'_id': 1}}
+        ]
+        return self.journal_collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+
+    def insert_snapshots(self, snapshots):
+        insert_ignoring_duplicates(self.journal_snapshots_collection, snapshots)
+
+def get_gift_window_key(window_start):
+    # Field name of a gift window in the user_balances stats: epoch seconds
+    return str(int(window_start.timestamp()))
+
+def split_booked_gifts(booked_gifts, pending_since):
+    # (amount booked for the windows starting at or after pending_since, keys
+    # of the older windows, which no longer matter)
+    since = int(pending_since.timestamp())
+    booked = sum(amount for key, amount in booked_gifts.items() if int(key) >= since)
+    return booked, [key for key in booked_gifts if int(key) < since]
+
+def build_time_range(since, until):
+    time_range = {'$lte': until}
+    if since is not None:
+        time_range['$gt'] = since
+    return time_range
+
+def in_time_range(timestamp, since, until):
+    return (since is None or timestamp > since) and timestamp <= until
+
+def insert_ignoring_duplicates(collection, documents):
+    # Unordered insert that treats documents already there as written
+    if not documents:
+        return
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+
+def build_user_range(after_user_id=None, user_ids=None):
+    if user_ids is not None:
+        return {'user_id': {'$in': list(user_ids)}}
+    if after_user_id is not None:
+        return {'user_id': {'$gt': after_user_id}}
+    # Ledger rows from before per-user logging (bot_liquidity_change) have no user
+    return {'user_id': {'$ne': None}}
+
+def in_user_range(user_id, after_user_id=None, user_ids=None):
+    if user_id is None:
+        return False
+    if user_ids is not None:
+        return user_id in user_ids
+    return after_user_id is None or user_id > after_user_id
+
+def get_bot_queries(db):
+    # Every query shape the bot issues, with placeholder values; db is a
+    # pymongo or Motor database
+    query, sort = build_history_query(0, (0, ObjectId()))
+    statement_query, statement_sort = build_statement_query(0, get_current_time(), get_current_time())
+    return [
+        ('users by user_id', db['users'].find({'user_id': 0})),
+        ('transaction history', db['transactions'].find({'user_id': 0}).sort('timestamp', -1).limit(10)),
+        ('transaction history page', db['transactions'].find(query).sort(sort).limit(10)),
+        ('statement transactions', db['transactions'].find(statement_query).sort(statement_sort)),
+        ('statement cache', db['statements'].find({'user_id': 0, 'month': ''})),
+        ('transfer request', db['transfer_requests'].find({'transfer_id': '', 'sender_id': 0, 'status': 'pending'})),
+        ('open loans', db['loans'].find({'user_id': 0, 'paid': False})),
+        ('loan by id', db['loans'].find({'loan_id': '', 'user_id': 0, 'paid': False})),
+        ('loan update', db['loans'].find({'loan_id': ''})),
+        ('loans to accrue', db['loans'].find({'paid': False, '_id': {'$gt': ObjectId()}}).sort('_id', 1)),
+        ('gift window', db['gift_windows'].find({'window': get_current_time()})),
+        ('liquidity bucket', db['liquidity_history'].find({'hour': get_current_time(), 'count': {'$lt': LIQUIDITY_BUCKET_SIZE}})),
+        ('account legs', db['journal'].find({'legs.account': '', 'timestamp': {'$gt': get_current_time()}})),
+        ('latest snapshot', db['journal_snapshots'].find({'account': ''}).sort('timestamp', -1).limit(1)),
+    ]
+
+def build_liquidity_buckets(history):
+    # Legacy liquidity history array -> hourly liquidity_history buckets
+    buckets = []
+    for change in history:
+        hour = change['timestamp'].replace(minute=0, second=0, microsecond=0)
+        if not buckets or buckets[-1]['hour'] != hour or buckets[-1]['count'] >= LIQUIDITY_BUCKET_SIZE:
+            buckets.append({'hour': hour, 'count': 0, 'net': 0, 'changes': []})
+        buckets[-1]['changes'].append({'amount': change['amount'], 'reason': None, 'timestamp': change['timestamp']})
+        buckets[-1]['count'] += 1
+        buckets[-1]['net'] += change['amount']
+    return buckets
+
+def build_user_backfill(transactions, loans):
+    # Fields of a user from before recent and loan_due; transactions newest first
+    recent = [
+        {key: value for key, value in transaction.items() if key != 'user_id'}
+        for transaction in reversed(transactions)
+    ]
+    loan_due = sum(loan.get('remaining', loan['total_to_repay']) for loan in loans)
+    return {'recent': recent, 'loan_due': loan_due}
+
+def build_loan_migrations():
+    return [
+        # Loans from before partial repayments owe their whole total
+        ({'remaining': {'$exists': False}}, [{'$set': {'remaining': {'$cond': ['$paid', 0, '$total_to_repay']}, 'repaid': 0}}]),
+        # When loans from before updated_at last changed is unknown: now, so the
+        # next incremental export has them all once
+        ({'updated_at': {'$exists': False}}, {'$set': {'updated_at': get_current_time()}}),
+    ]
+
+def find_plan_stages(plan):
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(find_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(find_plan_stages(value))
+    return stages
+
+def copy_document(document):
+    # dict() would still share lists such as recent with the store
+    return {key: list(value) if isinstance(value, list) else value for key, value in document.items()}
+
+class MemoryStorage(Storage):
+    # Thread-safe in-process backend: every method runs under one lock, which
+    # also makes the transfer atomic. Documents are copied in and out so callers
+    # never share state with the store.
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.counts = Counter()
+        self.users = {}
+        self.transactions = []
+        self.user_transactions = {}
+        self.bot_stats = {}
+        self.transfer_requests = {}
+        self.loans = {}
+        self.user_loans = {}
+        self.liquidity_history = []
+        self.gift_windows = {}
+        self.reconciliation_mismatches = []
+        self.journal = []
+        self.journal_ids = set()
+        self.account_legs = {}
+        self.journal_snapshots = {}
+        self.statements = {}
+        self.node_leases = {}
+
+    def _count(self, operation):
+        self.counts[operation] += 1
+
+    def ping(self):
+        self._count('ping')
+
+    def op_counts(self):
+        with self.lock:
+            return dict(self.counts)
+
+    # Users
+    def get_user(self, user_id):
+        with self.lock:
+            self._count('get_user')
+            user = self.users.get(user_id)
+            return copy_document(user) if user else None
+
+    def change_user_balance(self, user_id, amount, min_balance=None, transaction=None):
+        with self.lock:
+            self._count('change_user_balance')
+            user = self.users.get(user_id)
+            if min_balance is not None and (not user or user.get('balance', 0) < min_balance):
+                return None
+            if not user:
+                user = self.users[user_id] = {'_id': ObjectId(), 'user_id': user_id}
+            user['balance'] = user.get('balance', 0) + amount
+            self._inc_stat('user_balances', 'total', amount)
+            if transaction:
+                self._push_recent(user, transaction)
+                self._insert_transaction(transaction)
+                self._post_entry(build_transaction_entry(transaction))
+            return copy_document(user)
+
+    def _push_recent(self, user, transaction):
+        # New list each time: copies handed out share the old one
+        push = build_recent_push(transaction)['recent']
+        user['recent'] = (user.get('recent', []) + push['$each'])[push['$slice']:]
+
+    def set_user_fields(self, user_id, fields):
+        with self.lock:
+            self._count('set_user_fields')
+            user = self.users.get(user_id)
+            if not user:
+                user = self.users[user_id] = {'_id': ObjectId(), 'user_id': user_id}
+            user.update(fields)
+            return copy_document(user)
+
+    def claim_daily_gift(self, user_id, amount, transaction, interval):
+        with self.lock:
+            self._count('claim_daily_gift')
+            current_time = transaction['timestamp']
+            user = self.users.get(user_id)
+            if user and 'last_gift' in user and user['last_gift'] > current_time - interval:
+                return None
+            if not user:
+                user = self.users[user_id] = {'_id': ObjectId(), 'user_id': user_id}
+            user['balance'] = user.get('balance', 0) + amount
+            user['last_gift'] = current_time
+            self._push_recent(user, transaction)
+            self._insert_transaction(transaction)
+            self._post_entry(build_transaction_entry(transaction))
+            return copy_document(user)
+
+    def record_gift_window(self, window_start, claims, rejected, amount):
+        with self.lock:
+            self._count('record_gift_window')
+            self._inc_stat('user_balances', 'total', amount)
+            if amount:
+                booked = self.bot_stats['user_balances'].setdefault('booked_gifts', {})
+                key = get_gift_window_key(window_start)
+                booked[key] = booked.get(key, 0) + amount
+            window = self.gift_windows.setdefault(window_start, {'window': window_start, 'claims': 0, 'rejected': 0, 'amount': 0})
+            window['claims'] += claims
+            window['rejected'] += rejected
+            window['amount'] += amount
+
+    def get_total_user_balance(self):
+        with self.lock:
+            self._count('get_total_user_balance')
+            stats = self.bot_stats.get('user_balances')
+            if not stats:
+                return self.reconcile_total_user_balance()
+            return stats['total']
+
+    def reconcile_total_user_balance(self, pending_since=None):
+        with self.lock:
+            self._count('reconcile_total_user_balance')
+            stats = self.bot_stats.setdefault('user_balances', {'_id': 'user_balances'})
+            total = sum(user.get('balance', 0) for user in self.users.values())
+            if pending_since is not None:
+                booked, stale = split_booked_gifts(stats.get('booked_gifts', {}), pending_since)
+                total += booked - sum(
+                    transaction['amount'] for transaction in self.transactions
+                    if transaction['type'] == 'daily_gift' and transaction['timestamp'] >= pending_since
+                )
+                for key in stale:
+                    del stats['booked_gifts'][key]
+            stats.update({'total': total, 'reconciled_at': get_current_time()})
+            return total
+
+    def _inc_stat(self, stat_id, field, amount):
+        stats = self.bot_stats.setdefault(stat_id, {'_id': stat_id})
+        stats[field] = stats.get(field, 0) + amount
+
+    # Transactions
+    def log_transaction(self, transaction):
+        with self.lock:
+            self._count('log_transaction')
+            self._insert_transaction(transaction)
+
+    def _insert_transaction(self, transaction):
+        transaction = dict(transaction)
+        transaction.setdefault('_id', ObjectId())
+        self.transactions.append(transaction)
+        # Kept in (timestamp, _id) order, the memory equivalent of the history index
+        bisect.insort(self.user_transactions.setdefault(transaction['user_id'], []), transaction, key=get_history_key)
+
+    def get_transaction_history(self, user_id, limit=10):
+        with self.lock:
+            self._count('get_transaction_history')
+            transactions = self.user_transactions.get(user_id, [])
+            return [dict(transaction) for transaction in reversed(transactions[-limit:])]
+
+    def get_transaction_page(self, user_id, limit, cursor=None, newer=False):
+        with self.lock:
+            self._count('get_transaction_page')
+            transactions = self.user_transactions.get(user_id, [])
+            if newer:
+                start = bisect.bisect_right(transactions, cursor, key=get_history_key) if cursor else 0
+                page = transactions[start:start + limit]
+            else:
+                end = bisect.bisect_left(transactions, cursor, key=get_history_key) if cursor else len(transactions)
+                page = list(reversed(transactions[max(0, end - limit):end]))
+            return [dict(transaction) for transaction in page]
+
+    def get_transaction_batch(self, user_id, start, end, after=None, limit=500):
+        with self.lock:
+            self._count('get_transaction_batch')
+            transactions = self.user_transactions.get(user_id, [])
+            if after:
+                first = bisect.bisect_right(transactions, get_history_key(after), key=get_history_key)
+            else:
+                first = bisect.bisect_left(transactions, start, key=lambda transaction: transaction['timestamp'])
+            last = bisect.bisect_left(transactions, end, key=lambda transaction: transaction['timestamp'])
+            return [dict(transaction) for transaction in transactions[first:min(last, first + limit)]]
+
+    # Statements
+    def get_statement(self, user_id, month):
+        with self.lock:
+            self._count('get_statement')
+            statement = self.statements.get((user_id, month))
+            return dict(statement) if statement else None
+
+    def save_statement(self, user_id, month, file_id, last_transaction, created_at=None):
+        with self.lock:
+            self._count('save_statement')
+            self.statements[(user_id, month)] = {
+                'user_id': user_id, 'month': month, 'file_id': file_id,
+                'last_transaction': last_transaction, 'created_at': created_at or get_current_time()
+            }
+
+    # Liquidity
+    def get_bot_liquidity(self):
+        with self.lock:
+            self._count('get_bot_liquidity')
+            stats = self.bot_stats.get('liquidity')
+            if not stats:
+                self.bot_stats['liquidity'] = {'_id': 'liquidity', 'amount': INITIAL_LIQUIDITY}
+                return INITIAL_LIQUIDITY
+            return stats['amount']
+
+    def update_bot_liquidity(self, amount, reason=None):
+        with self.lock:
+            self._count('update_bot_liquidity')
+            self._inc_stat('liquidity', 'amount', amount)
+            self._record_liquidity_change(amount, reason, get_current_time())
+
+    def _record_liquidity_change(self, amount, reason, current_time):
+        hour = current_time.replace(minute=0, second=0, microsecond=0)
+        if not self.liquidity_history or self.liquidity_history[-1]['hour'] != hour \
+                or self.liquidity_history[-1]['count'] >= LIQUIDITY_BUCKET_SIZE:
+            self.liquidity_history.append({'_id': ObjectId(), 'hour': hour, 'count': 0, 'net': 0, 'changes': []})
+        bucket = self.liquidity_history[-1]
+        bucket['changes'].append({'amount': amount, 'reason': reason, 'timestamp': current_time})
+        bucket['count'] += 1
+        bucket['net'] += amount
+
+    # Transfers
+    def insert_transfer_request(self, transfer_request):
+        with self.lock:
+            self._count('insert_transfer_request')
+            self.transfer_requests[transfer_request['transfer_id']] = dict(transfer_request)
+
+    def delete_transfer_request(self, transfer_id, sender_id):
+        with self.lock:
+            self._count('delete_transfer_request')
+            transfer_request = self.transfer_requests.get(transfer_id)
+            if not transfer_request or transfer_request['sender_id'] != sender_id:
+                return False
+            del self.transfer_requests[transfer_id]
+            return True
+
+    def execute_transfer(self, transfer_id, sender_id):
+        with self.lock:
+            self._count('execute_transfer')
+            transfer_request = self.transfer_requests.get(transfer_id)
+            if not transfer_request or transfer_request['sender_id'] != sender_id or transfer_request['status'] != 'pending':
+                return 'not_found', None, 0
+
+            recipient_id = transfer_request['recipient_id']
+            amount = transfer_request['amount']
+            fee = transfer_request['fee']
+            total_amount = amount + fee
+
+            sender = self.users.get(sender_id)
+            if not sender or sender.get('balance', 0) < total_amount:
+                return 'insufficient_funds', dict(transfer_request), 0
+
+            del self.transfer_requests[transfer_id]
+            sender['balance'] -= total_amount
+            recipient = self.users.get(recipient_id)
+            if not recipient:
+                recipient = self.users[recipient_id] = {'_id': ObjectId(), 'user_id': recipient_id, 'balance': 0}
+            recipient['balance'] = recipient.get('balance', 0) + amount
+
+            current_time = get_current_time()
+            self._inc_stat('liquidity', 'amount', fee)
+            self._inc_stat('user_balances', 'total', -fee)
+            self._record_liquidity_change(fee, 'transfer_fee', current_time)
+            transfer_out = build_transaction(sender_id, 'transfer_out', -total_amount,
+                                             {'recipient_id': recipient_id, 'transfer_id': transfer_id}, transfer_id)
+            transfer_in = build_transaction(recipient_id, 'transfer_in', amount,
+                                            {'sender_id': sender_id, 'transfer_id': transfer_id}, transfer_id)
+            self._push_recent(sender, transfer_out)
+            self._push_recent(recipient, transfer_in)
+            self._insert_transaction(transfer_out)
+            self._insert_transaction(transfer_in)
+            self._post_entry(build_transfer_entry(transfer_out, transfer_in))
+            return 'completed', dict(transfer_request), 0
+
+    # Loans
+    def get_user_loans(self, user_id):
+        with self.lock:
+            self._count('get_user_loans')
+            loans = (self.loans[loan_id] for loan_id in self.user_loans.get(user_id, []))
+            return [dict(loan) for loan in loans if not loan['paid']]
+
+    def get_open_loan(self, loan_id, user_id):
+        with self.lock:
+            self._count('get_open_loan')
+            loan = self.loans.get(loan_id)
+            if not loan or loan['user_id'] != user_id or loan['paid']:
+                return None
+            return dict(loan)
+
+    def insert_loan(self, loan):
+        with self.lock:
+            self._count('insert_loan')
+            loan = dict(loan)
+            loan.setdefault('_id', ObjectId())
+            loan.setdefault('remaining', loan['total_to_repay'])
+            loan.setdefault('updated_at', loan['timestamp'])
+            self.loans[loan['loan_id']] = loan
+            self.user_loans.setdefault(loan['user_id'], []).append(loan['loan_id'])
+            user = self.users.get(loan['user_id'])
+            if user:
+                user['loan_due'] = user.get('loan_due', 0) + loan['total_to_repay']
+
+    def mark_loan_paid(self, loan_id):
+        with self.lock:
+            self._count('mark_loan_paid')
+            loan = self.loans[loan_id]
+            if loan['paid']:
+                return
+            loan['paid'] = True
+            loan['updated_at'] = get_current_time()
+            user = self.users.get(loan['user_id'])
+            if user:
+                user['loan_due'] = user.get('loan_due', 0) - loan['remaining']
+
+    def repay_loan(self, loan_id, user_id, amount=None, auto=False):
+        with self.lock:
+            self._count('repay_loan')
+            loan = self.loans.get(loan_id)
+            if not loan or loan['user_id'] != user_id or loan['paid'] or loan['remaining'] <= 0:
+                return 'not_found', None
+            repaid, left = split_repayment(loan['remaining'], amount)
+            user = self.users.get(user_id)
+            if not user or user.get('balance', 0) < repaid:
+                return 'insufficient_funds', None
+            transaction = build_transaction(user_id, 'loan_repayment', -repaid, {'loan_id': loan_id, 'auto': auto})
+            user['balance'] -= repaid
+            user['loan_due'] = user.get('loan_due', 0) + left - loan['remaining']
+            loan['repaid'] = loan.get('repaid', 0) + repaid
+            loan['remaining'] = left
+            loan['paid'] = left == 0
+            loan['updated_at'] = transaction['timestamp']
+            self._inc_stat('liquidity', 'amount', repaid)
+            self._inc_stat('user_balances', 'total', -repaid)
+            self._record_liquidity_change(repaid, 'loan_repayment', transaction['timestamp'])
+            self._push_recent(user, transaction)
+            self._insert_transaction(transaction)
+            self._post_entry(build_transaction_entry(transaction))
+            return 'completed', {'amount': repaid, 'remaining': left, 'balance': user['balance'], 'transaction': transaction}
+
+    # Loan accrual
+    def iter_loans_to_accrue(self, accrued_before, after_id=None, batch_size=1000):
+        with self.lock:
+            self._count('iter_loans_to_accrue')
+            loans = sorted(
+                (dict(loan) for loan in self.loans.values()
+                 if not loan['paid'] and (after_id is None or loan['_id'] > after_id)
+                 and ('last_accrued' not in loan or loan['last_accrued'] <= accrued_before)),
+                key=lambda loan: loan['_id']
+            )
+        return iter(loans)
+
+    def apply_loan_accruals(self, loan_updates, user_updates):
+        with self.lock:
+            self._count('apply_loan_accruals')
+            for update in loan_updates:
+                loan = self.loans.get(update['loan_id'])
+                if not loan or loan['paid'] or loan.get('last_accrued') != update['previous']:
+                    continue
+                loan['total_to_repay'] += update['interest'] + update['penalty']
+                loan['remaining'] += update['interest'] + update['penalty']
+                loan['interest'] = loan.get('interest', 0) + update['interest']
+                loan['penalty'] = loan.get('penalty', 0) + update['penalty']
+                loan['last_accrued'] = update['last_accrued']
+                if 'due_date' in update:
+                    loan['due_date'] = update['due_date']
+                loan['updated_at'] = get_current_time()
+            for update in user_updates:
+                user = self.users.get(update['user_id'])
+                if not user or user.get('loan_accruals', {}).get(update['loan_id']) == update['marker']:
+                    continue
+                user['loan_due'] = user.get('loan_due', 0) + update['amount']
+                user.setdefault('loan_accruals', {})[update['loan_id']] = update['marker']
+
+    # Snowflake node ids
+    def lease_node_id(self, owner, ttl):
+        with self.lock:
+            self._count('lease_node_id')
+            now = get_current_time()
+            for node_id in range(1, MAX_NODE_ID + 1):
+                lease = self.node_leases.get(node_id)
+                if not lease or lease['expires_at'] < now:
+                    self.node_leases[node_id] = {'owner': owner, 'expires_at': now + timedelta(seconds=ttl)}
+                    return node_id
+            return None
+
+    def renew_node_id(self, node_id, owner, ttl):
+        with self.lock:
+            self._count('renew_node_id')
+            lease = self.node_leases.get(node_id)
+            if not lease or lease['owner'] != owner:
+                return False
+            lease['expires_at'] = get_current_time() + timedelta(seconds=ttl)
+            return True
+
+    def count_node_leases(self):
+        with self.lock:
+            self._count('count_node_leases')
+            now = get_current_time()
+            return sum(1 for lease in self.node_leases.values() if lease['expires_at'] >= now)
+
+    # Checkpoints of background jobs
+    def get_checkpoint(self, name):
+        with self.lock:
+            self._count('get_checkpoint')
+            state = self.bot_stats.get(name)
+            return copy_document(state) if state else None
+
+    def save_checkpoint(self, name, state):
+        with self.lock:
+            self._count('save_checkpoint')
+            self.bot_stats[name] = copy_document(dict(state, _id=name))
+
+    # Ledger reconciliation
+    def iter_ledger_by_user(self, after_user_id=None, user_ids=None, batch_size=1000):
+        with self.lock:
+            self._count('iter_ledger_by_user')
+            rows = []
+            for user_id, transactions in self.user_transactions.items():
+                if not in_user_range(user_id, after_user_id, user_ids) or not transactions:
+                    continue
+                rows.append({
+                    '_id': user_id,
+                    'ledger': sum(transaction['amount'] for transaction in transactions),
+                    'gifts': sum(transaction['amount'] for transaction in transactions if transaction['type'] == 'daily_gift'),
+                    'count': len(transactions)
+                })
+        return iter(sorted(rows, key=lambda row: row['_id']))
+
+    def iter_user_balances(self, after_user_id=None, user_ids=None, batch_size=1000):
+        with self.lock:
+            self._count('iter_user_balances')
+            rows = [
+                {'user_id': user_id, 'balance': user.get('balance', 0)}
+                for user_id, user in self.users.items() if in_user_range(user_id, after_user_id, user_ids)
+            ]
+        return iter(sorted(rows, key=lambda row: row['user_id']))
+
+    def iter_users_touched_since(self, since, batch_size=1000):
+        with self.lock:
+            self._count('iter_users_touched_since')
+            return iter(sorted({
+                transaction['user_id'] for transaction in self.transactions
+                if transaction['timestamp'] >= since and transaction['user_id'] is not None
+            }))
+
+    def get_liquidity_history_net(self):
+        with self.lock:
+            self._count('get_liquidity_history_net')
+            return sum(bucket['net'] for bucket in self.liquidity_history)
+
+    def record_reconciliation_mismatches(self, mismatches):
+        with self.lock:
+            self._count('record_reconciliation_mismatches')
+            self.reconciliation_mismatches.extend(dict(mismatch) for mismatch in mismatches)
+
+    # Exports
+    def iter_transactions_between(self, since, until, batch_size=1000):
+        with self.lock:
+            self._count('iter_transactions_between')
+            transactions = [dict(transaction) for transaction in self.transactions if in_time_range(transaction['timestamp'], since, until)]
+        return iter(sorted(transactions, key=lambda transaction: transaction['timestamp']))
+
+    def iter_loans_between(self, since, until, batch_size=1000):
+        with self.lock:
+            self._count('iter_loans_between')
+            loans = [dict(loan) for loan in self.loans.values() if in_time_range(loan['updated_at'], since, until)]
+        return iter(sorted(loans, key=lambda loan: loan['updated_at']))
+
+    def iter_liquidity_changes_between(self, since, until, batch_size=1000):
+        with self.lock:
+            self._count('iter_liquidity_changes_between')
+            changes = [
+                dict(change) for bucket in self.liquidity_history for change in bucket['changes']
+                if in_time_range(change['timestamp'], since, until)
+            ]
+        return iter(sorted(changes, key=lambda change: change['timestamp']))
+
+    # Journal
+    def post_journal_entries(self, entries):
+        with self.lock:
+            self._count('post_journal_entries')
+            for entry in entries:
+                self._post_entry(entry)
+
+    def _post_entry(self, entry):
+        if entry['entry_id'] in self.journal_ids:
+            return
+        self.journal_ids.add(entry['entry_id'])
+        self.journal.append(dict(entry))
+        # Legs of each account kept in timestamp order, the memory equivalent
+        # of the (legs.account, timestamp) index
+        for leg in entry['legs']:
+            bisect.insort(self.account_legs.setdefault(leg['account'], []), (entry['timestamp'], leg['amount']),
+                          key=lambda posted: posted[0])
+
+    def sum_account_legs(self, account, after=None, until=None):
+        with self.lock:
+            self._count('sum_account_legs')
+            legs = self.account_legs.get(account, [])
+            start = bisect.bisect_right(legs, after, key=lambda leg: leg[0]) if after is not None else 0
+            end = bisect.bisect_right(legs, until, key=lambda leg: leg[0]) if until is not None else len(legs)
+            return sum(amount for _, amount in legs[start:end])
+
+    def sum_accounts_legs(self, accounts):
+        with self.lock:
+            self._count('sum_accounts_legs')
+            return {
+                account: sum(amount for _, amount in self.account_legs[account])
+                for account in accounts if account in self.account_legs
+            }
+
+    def get_latest_snapshot(self, account, at=None):
+        with self.lock:
+            self._count('get_latest_snapshot')
+            snapshots = self.journal_snapshots.get(account, [])
+            end = bisect.bisect_right(snapshots, at, key=lambda snapshot: snapshot['timestamp']) if at is not None else len(snapshots)
+            return dict(snapshots[end - 1]) if end else None
+
+    def get_latest_snapshots(self, accounts, before):
+        with self.lock:
+            self._count('get_latest_snapshots')
+            latest = {}
+            for account in accounts:
+                snapshots = self.journal_snapshots.get(account, [])
+                end = bisect.bisect_left(snapshots, before, key=lambda snapshot: snapshot['timestamp'])
+                if end:
+                    latest[account] = dict(snapshots[end - 1])
+            return latest
+
+    def iter_account_deltas(self, since, until, after_account=None, batch_size=1000):
+        with self.lock:
+            self._count('iter_account_deltas')
+            rows = []
+            for account, legs in self.account_legs.items():
+                if after_account is not None and account <= after_account:
+                    continue
+                start = bisect.bisect_right(legs, since, key=lambda leg: leg[0]) if since is not None else 0
+                end = bisect.bisect_right(legs, until, key=lambda leg: leg[0])
+                if end > start:
+                    rows.append({'_id': account, 'delta': sum(amount for _, amount in legs[start:end]), 'legs': end - start})
+        return iter(sorted(rows, key=lambda row: row['_id']))
+
+    def insert_snapshots(self, snapshots):
+        with self.lock:
+            self._count('insert_snapshots')
+            for snapshot in snapshots:
+                taken = self.journal_snapshots.setdefault(snapshot['account'], [])
+                if any(existing['timestamp'] == snapshot['timestamp'] for existing in taken):
+                    continue
+                bisect.insort(taken, dict(snapshot), key=lambda snapshot: snapshot['timestamp'])
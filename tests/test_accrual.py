@@ -0,0 +1,41 @@
+from datetime import timedelta
+from storage import MemoryStorage
+from helpers import get_current_time, as_utc
+from accrual import run_loan_accrual, CHECKPOINT, LOAN_TERM, LOAN_PERIOD_INTEREST
+
+def insert_loan(storage, loan_id, user_id, amount, taken_at):
+    storage.insert_loan({
+        'loan_id': loan_id,
+        'user_id': user_id,
+        'amount': amount,
+        'interest': amount * 0.25,
+        'penalty': 0,
+        'total_to_repay': amount * 1.25,
+        'paid': False,
+        'timestamp': taken_at,
+        'due_date': taken_at + LOAN_TERM,
+        'last_accrued': taken_at
+    })
+
+def test_resumed_run_charges_each_loan_of_a_user_once():
+    storage = MemoryStorage()
+    storage.set_user_fields(1, {'balance': 0})
+    taken_at = get_current_time() - timedelta(days=1, hours=1)
+    insert_loan(storage, 'IQ24-A', 1, 100.0, taken_at)
+    insert_loan(storage, 'IQ24-B', 1, 200.0, taken_at)
+    loan_due = storage.get_user(1)['loan_due']
+
+    assert run_loan_accrual(storage)['charged'] == 2
+    charged = storage.get_user(1)['loan_due'] - loan_due
+    assert abs(charged - 300.0 * LOAN_PERIOD_INTEREST) < 1e-9
+
+    # Crash after both user updates were written: the resumed run replays them
+    state = storage.get_checkpoint(CHECKPOINT)
+    pending = [
+        {'user_id': 1, 'loan_id': loan_id, 'amount': amount * LOAN_PERIOD_INTEREST,
+         'marker': f"{loan_id}@{as_utc(taken_at + timedelta(days=1)).isoformat()}"}
+        for loan_id, amount in [('IQ24-A', 100.0), ('IQ24-B', 200.0)]
+    ]
+    storage.save_checkpoint(CHECKPOINT, dict(state, finished_at=None, pending=pending))
+    run_loan_accrual(storage)
+    assert storage.get_user(1)['loan_due'] - loan_due == charged
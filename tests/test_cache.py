@@ -0,0 +1,28 @@
+import time
+from cache import UserCache
+
+def test_invalidate_drops_the_cached_user():
+    cache = UserCache()
+    cache.put(1, {'balance': 10.0})
+    cache.put(2, {'balance': 5.0})
+    cache.invalidate(1, 2)
+    assert cache.get(1) is None
+    assert cache.get(2) is None
+
+def test_entries_expire_after_ttl():
+    cache = UserCache(ttl=0.01)
+    cache.put(1, {'balance': 10.0})
+    assert cache.get(1) == {'balance': 10.0}
+    time.sleep(0.02)
+    assert cache.get(1) is None
+    assert cache.stats()['size'] == 0
+
+def test_least_recently_used_is_evicted_first():
+    cache = UserCache(max_size=2)
+    cache.put(1, 'a')
+    cache.put(2, 'b')
+    cache.get(1)
+    cache.put(3, 'c')
+    assert cache.get(2) is None
+    assert cache.get(1) == 'a'
+    assert cache.get(3) == 'c'
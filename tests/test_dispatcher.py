@@ -0,0 +1,46 @@
+import threading
+import time
+from dispatcher import UserDispatcher
+
+def test_one_users_updates_run_in_order():
+    handled = []
+    done = threading.Event()
+    def handler(item):
+        user_id, n = item
+        # Later updates finish faster, so only the lane keeps them in order
+        time.sleep(0.001 * (20 - n))
+        handled.append(item)
+        if len(handled) == 60:
+            done.set()
+    dispatcher = UserDispatcher(handler, num_workers=8)
+    for n in range(20):
+        for user_id in (1, 2, 3):
+            dispatcher.submit(user_id, (user_id, n))
+    assert done.wait(5)
+    dispatcher.stop()
+    for user_id in (1, 2, 3):
+        assert [n for key, n in handled if key == user_id] == list(range(20))
+
+def test_different_users_run_in_parallel():
+    both_running = threading.Barrier(2, timeout=5)
+    done = threading.Event()
+    def handler(item):
+        both_running.wait()
+        if item == 2:
+            done.set()
+    dispatcher = UserDispatcher(handler, num_workers=2)
+    dispatcher.submit(1, 1)
+    dispatcher.submit(2, 2)
+    assert done.wait(5)
+    dispatcher.stop()
+
+def test_bounded_submit_refuses_when_full():
+    release = threading.Event()
+    dispatcher = UserDispatcher(lambda item: release.wait(5), num_workers=1, max_pending=2)
+    assert dispatcher.submit(1, 'a')
+    assert dispatcher.submit(1, 'b')
+    assert not dispatcher.submit(2, 'c')
+    assert dispatcher.queue_depth() == 2
+    release.set()
+    assert dispatcher.submit(2, 'c', block=True)
+    dispatcher.stop()
@@ -0,0 +1,30 @@
+import csv
+from datetime import timedelta
+import export
+from export import export_source
+from storage import MemoryStorage
+from helpers import get_current_time
+
+def read_rows(path):
+    with open(path, newline='', encoding='utf-8') as file:
+        return list(csv.DictReader(file))
+
+def test_incremental_export_has_repaid_loans_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(export, 'WATERMARK_LAG', timedelta(0))
+    storage = MemoryStorage()
+    storage.set_user_fields(1, {'balance': 100.0})
+    taken_at = get_current_time()
+    storage.insert_loan({
+        'loan_id': 'IQ24-A', 'user_id': 1, 'amount': 40.0, 'interest': 10.0, 'total_to_repay': 50.0,
+        'paid': False, 'timestamp': taken_at, 'due_date': taken_at + timedelta(days=7)
+    })
+    state = export_source(storage, 'loans', str(tmp_path))
+    assert [row['remaining'] for row in read_rows(state['files'][0])] == ['50.0']
+
+    storage.repay_loan('IQ24-A', 1, 20.0)
+    state = export_source(storage, 'loans', str(tmp_path), incremental=True)
+    rows = read_rows(state['files'][0])
+    assert [(row['loan_id'], row['remaining']) for row in rows] == [('IQ24-A', '30.0')]
+
+    state = export_source(storage, 'loans', str(tmp_path), incremental=True)
+    assert state['rows'] == 0
@@ -0,0 +1,90 @@
+import asyncio
+import pytest
+import flows
+import messages
+from flows import BankApp, Awaitable, run_flow
+from storage import MemoryStorage
+from conversations import MemoryConversationStore
+from cache import UserCache
+from gifts import GiftWindow
+
+class RecordingOutbox:
+    def __init__(self):
+        self.sent = []
+        self.calls = []
+
+    def enqueue(self, chat_id, text, priority=None, **kwargs):
+        self.sent.append((chat_id, text, kwargs))
+
+    def enqueue_call(self, chat_id, method, *args, **kwargs):
+        self.calls.append((chat_id, method))
+
+    def queue_depth(self):
+        return 0
+
+    def get_stats(self):
+        return {'sent': len(self.sent), 'retried': 0, 'dropped': 0}
+
+class RecordingApi:
+    def __init__(self):
+        self.answers = []
+
+    def answer_callback_query(self, callback_query_id, text=None):
+        self.answers.append(text)
+
+def make_app(run=run_flow):
+    storage = MemoryStorage()
+    outbox = RecordingOutbox()
+    api = RecordingApi()
+    app = BankApp(
+        Awaitable(storage), Awaitable(MemoryConversationStore()), Awaitable(api), outbox, run,
+        UserCache(), GiftWindow(storage, 60)
+    )
+    return app, storage, outbox, api
+
+def last_text(outbox, chat_id):
+    return [text for sent_to, text, _ in outbox.sent if sent_to == chat_id][-1]
+
+def request_transfer(app, outbox, sender_id, recipient_id, amount):
+    for text in ('💸 تحويل', str(recipient_id), str(amount)):
+        run_flow(flows.handle_message(app, sender_id, text))
+    keyboard = outbox.sent[-1][2]['reply_markup']
+    return keyboard.keyboard[0][0].callback_data
+
+def test_transfer_refreshes_cached_balances():
+    app, storage, outbox, api = make_app()
+    storage.set_user_fields(1, {'balance': 100.0})
+    storage.set_user_fields(2, {'balance': 5.0})
+    # Both users cached before the transfer
+    assert run_flow(flows.get_user_balance(app, 1)) == 100.0
+    assert run_flow(flows.get_user_balance(app, 2)) == 5.0
+
+    confirm = request_transfer(app, outbox, 1, 2, 10)
+    run_flow(flows.handle_callback(app, 1, 'q1', confirm, 7))
+    assert api.answers == [messages.TRANSFER_CONFIRMED]
+
+    assert run_flow(flows.get_user_balance(app, 1)) == pytest.approx(89.8)
+    assert run_flow(flows.get_user_balance(app, 2)) == 15.0
+    run_flow(flows.check_balance(app, 1))
+    assert '$89.80' in last_text(outbox, 1)
+
+def test_second_confirm_is_refused():
+    app, storage, outbox, api = make_app()
+    storage.set_user_fields(1, {'balance': 100.0})
+    confirm = request_transfer(app, outbox, 1, 2, 10)
+    run_flow(flows.handle_callback(app, 1, 'q1', confirm, 7))
+    run_flow(flows.handle_callback(app, 1, 'q2', confirm, 7))
+    assert api.answers == [messages.TRANSFER_CONFIRMED, messages.TRANSFER_NOT_FOUND]
+    assert app.get_transfer_stats()['count'] == 2
+
+def test_same_flows_on_the_event_loop():
+    app, storage, outbox, _ = make_app(run=lambda flow: flow)
+    storage.set_user_fields(1, {'balance': 42.0})
+    asyncio.run(app.run(flows.handle_message(app, 1, '💰 رصيدي')))
+    assert '$42.00' in last_text(outbox, 1)
+
+def test_run_flow_refuses_a_flow_that_suspends():
+    async def sleeping():
+        await asyncio.sleep(0)
+    with pytest.raises(RuntimeError):
+        run_flow(sleeping())
@@ -0,0 +1,36 @@
+from datetime import timedelta
+from storage import MemoryStorage
+from helpers import build_transaction
+from gifts import GiftWindow
+
+def claim(storage, gift_window, user_id, amount):
+    transaction = build_transaction(user_id, 'daily_gift', amount)
+    storage.claim_daily_gift(user_id, amount, transaction, timedelta(days=1))
+    gift_window.count(amount, transaction['timestamp'])
+
+def balances(storage):
+    return sum(storage.get_user(user_id)['balance'] for user_id in (1, 2, 3))
+
+def test_reconcile_leaves_out_pending_windows():
+    storage = MemoryStorage()
+    storage.reconcile_total_user_balance()
+    # Two processes, each with its own window
+    first, second = GiftWindow(storage, 60), GiftWindow(storage, 60)
+    claim(storage, first, 1, 1.0)
+    claim(storage, second, 2, 2.0)
+    first.flush()
+    claim(storage, first, 3, 4.0)
+    # Booked: 1.0; pending: 2.0 in the second process and 4.0 in the first
+    assert storage.reconcile_total_user_balance(first.pending_since()) == 1.0
+    first.flush()
+    second.flush()
+    assert storage.get_total_user_balance() == balances(storage) == 7.0
+
+def test_pending_counts_every_unbooked_window():
+    storage = MemoryStorage()
+    gift_window = GiftWindow(storage, 60)
+    claim(storage, gift_window, 1, 1.0)
+    gift_window.count()
+    assert gift_window.pending() == {'claims': 1, 'rejected': 1, 'amount': 1.0}
+    gift_window.flush()
+    assert gift_window.pending() == {'claims': 0, 'rejected': 0, 'amount': 0}
@@ -0,0 +1,11 @@
+import pytest
+from helpers import parse_amount
+
+@pytest.mark.parametrize('text', ['nan', 'NaN', 'inf', '-inf', 'Infinity', '1e999', 'abc', ''])
+def test_parse_amount_rejects_non_finite_and_bad_amounts(text):
+    with pytest.raises(ValueError):
+        parse_amount(text)
+
+def test_parse_amount_accepts_finite_amounts():
+    assert parse_amount('0.01') == 0.01
+    assert parse_amount(' 25 ') == 25.0
@@ -0,0 +1,23 @@
+import pytest
+from storage import MemoryStorage, INITIAL_LIQUIDITY
+from helpers import build_transaction
+from journal import post_opening_balances, is_opening_running, get_balance, user_account, LIQUIDITY_ACCOUNT
+
+def test_opening_does_not_count_entries_posted_before_it():
+    storage = MemoryStorage()
+    storage.set_user_fields(1, {'balance': 10.0})
+    storage.get_bot_liquidity()
+    # Posted by a bot that ran before the journal was opened
+    storage.change_user_balance(1, 5.0, transaction=build_transaction(1, 'loan', 5.0))
+    storage.update_bot_liquidity(-5.0, 'loan')
+    post_opening_balances(storage)
+    assert get_balance(storage, user_account(1)) == 15.0
+    assert get_balance(storage, LIQUIDITY_ACCOUNT) == INITIAL_LIQUIDITY - 5.0
+
+def test_opening_refuses_while_bots_run():
+    storage = MemoryStorage()
+    storage.lease_node_id('bot', 60)
+    with pytest.raises(RuntimeError):
+        post_opening_balances(storage)
+    assert not is_opening_running(storage)
+    assert storage.get_checkpoint('journal_opening').get('finished_at') is None
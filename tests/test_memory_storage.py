@@ -0,0 +1,56 @@
+from datetime import timedelta
+from storage import MemoryStorage
+from helpers import build_transaction, get_current_time
+
+def test_balance_change_below_min_balance_is_refused():
+    storage = MemoryStorage()
+    storage.set_user_fields(1, {'balance': 10.0})
+    transaction = build_transaction(1, 'slots_loss', -20.0)
+    assert storage.change_user_balance(1, -20.0, min_balance=20.0, transaction=transaction) is None
+    assert storage.get_user(1)['balance'] == 10.0
+    assert storage.get_transaction_history(1) == []
+    # Never creates the user either
+    assert storage.change_user_balance(2, -1.0, min_balance=1.0) is None
+    assert storage.get_user(2) is None
+
+def test_returned_documents_are_copies():
+    storage = MemoryStorage()
+    user = storage.change_user_balance(1, 10.0, transaction=build_transaction(1, 'daily_gift', 10.0))
+    user['balance'] = 1000.0
+    user['recent'].append('x')
+    stored = storage.get_user(1)
+    assert stored['balance'] == 10.0
+    assert len(stored['recent']) == 1
+
+def test_total_balance_follows_every_write():
+    storage = MemoryStorage()
+    storage.change_user_balance(1, 100.0, transaction=build_transaction(1, 'daily_gift', 100.0))
+    storage.insert_transfer_request({
+        'transfer_id': 'T1', 'sender_id': 1, 'recipient_id': 2, 'amount': 50.0, 'fee': 1.0,
+        'status': 'pending', 'timestamp': get_current_time()
+    })
+    storage.execute_transfer('T1', 1)
+    taken_at = get_current_time()
+    storage.insert_loan({
+        'loan_id': 'IQ24-A', 'user_id': 2, 'amount': 20.0, 'interest': 5.0, 'total_to_repay': 25.0,
+        'paid': False, 'timestamp': taken_at, 'due_date': taken_at + timedelta(days=7)
+    })
+    storage.repay_loan('IQ24-A', 2, 10.0)
+    assert storage.get_total_user_balance() == 100.0 - 1.0 - 10.0
+    assert storage.reconcile_total_user_balance() == storage.get_total_user_balance()
+
+def test_partial_repayments_close_the_loan():
+    storage = MemoryStorage()
+    storage.set_user_fields(1, {'balance': 30.0})
+    taken_at = get_current_time()
+    storage.insert_loan({
+        'loan_id': 'IQ24-A', 'user_id': 1, 'amount': 20.0, 'interest': 5.0, 'total_to_repay': 25.0,
+        'paid': False, 'timestamp': taken_at, 'due_date': taken_at + timedelta(days=7)
+    })
+    status, result = storage.repay_loan('IQ24-A', 1, 10.0)
+    assert status == 'completed' and result['remaining'] == 15.0
+    status, result = storage.repay_loan('IQ24-A', 1)
+    assert status == 'completed' and result['amount'] == 15.0 and result['remaining'] == 0
+    assert storage.get_user_loans(1) == []
+    assert storage.repay_loan('IQ24-A', 1)[0] == 'not_found'
+    assert storage.get_user(1)['balance'] == 5.0
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+from telebot import asyncio_helper
+from telebot.apihelper import ApiTelegramException
+import outbox
+from outbox import OutboundScheduler, AsyncOutboundScheduler, PRIORITY_TRANSACTIONAL, PRIORITY_LOW
+
+def server_error():
+    return ApiTelegramException('sendDocument', None, {'error_code': 502, 'description': 'Bad Gateway'})
+
+def run_until_done(scheduler, chat_id, method):
+    done = threading.Event()
+    calls = []
+    closed = []
+    def on_done():
+        closed.append(len(calls))
+        done.set()
+    def call():
+        calls.append(1)
+        method(len(calls))
+    scheduler.enqueue_call(chat_id, call, on_done=on_done)
+    assert done.wait(5)
+    return calls, closed
+
+def test_on_done_runs_once_after_retries(monkeypatch):
+    monkeypatch.setattr(outbox, 'RETRY_BACKOFF', 0.01)
+    scheduler = OutboundScheduler(None, max_retries=3)
+
+    def fail_twice(attempt):
+        if attempt <= 2:
+            raise server_error()
+    calls, closed = run_until_done(scheduler, 1, fail_twice)
+    assert closed == [3]
+    assert scheduler.get_stats()['sent'] == 1
+
+def test_on_done_runs_when_dropped(monkeypatch):
+    monkeypatch.setattr(outbox, 'RETRY_BACKOFF', 0.01)
+    scheduler = OutboundScheduler(None, max_retries=1)
+
+    def always_fail(attempt):
+        raise server_error()
+    calls, closed = run_until_done(scheduler, 2, always_fail)
+    assert closed == [2]
+    assert scheduler.get_stats()['dropped'] == 1
+
+def test_async_outbox_keeps_chat_order_and_retries(monkeypatch):
+    monkeypatch.setattr(outbox, 'RETRY_BACKOFF', 0.01)
+    sent = []
+    failures = {'b': 1}
+
+    async def send_message(chat_id, text):
+        if failures.get(text):
+            failures[text] -= 1
+            raise asyncio_helper.ApiTelegramException('sendMessage', None, {'error_code': 502, 'description': 'Bad Gateway'})
+        sent.append((chat_id, text))
+
+    async def run():
+        scheduler = AsyncOutboundScheduler(send_message, chat_rate=1000, chat_burst=1000)
+        scheduler.start()
+        scheduler.enqueue(1, 'a')
+        scheduler.enqueue(1, 'b')
+        scheduler.enqueue(1, 'c', PRIORITY_LOW)
+        scheduler.enqueue(2, 'receipt', PRIORITY_TRANSACTIONAL)
+        for _ in range(500):
+            if len(sent) == 4:
+                break
+            await asyncio.sleep(0.01)
+        return scheduler.get_stats()
+
+    stats = asyncio.run(run())
+    assert [text for chat_id, text in sent if chat_id == 1] == ['a', 'b', 'c']
+    assert stats['sent'] == 4 and stats['retried'] == 1
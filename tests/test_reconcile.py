@@ -0,0 +1,32 @@
+from storage import MemoryStorage, INITIAL_LIQUIDITY
+from helpers import build_transaction
+from reconcile import run_reconciliation
+
+def seed(storage):
+    for user_id, amount in [(1, 5.0), (2, 3.0)]:
+        storage.change_user_balance(user_id, amount, transaction=build_transaction(user_id, 'loan', amount))
+        storage.update_bot_liquidity(-amount, 'loan')
+    # Written by log_transaction(None, 'bot_liquidity_change', ...) before
+    # ledger rows were per user
+    storage.log_transaction(build_transaction(None, 'bot_liquidity_change', 7.0, {'type': 'system'}))
+
+def test_full_run_skips_rows_without_user():
+    storage = MemoryStorage()
+    seed(storage)
+    state = run_reconciliation(storage)
+    assert state['users'] == 2
+    assert state['mismatches'] == 0
+    assert state['ledger_total'] == 8.0
+    totals = state['totals']
+    assert totals['Total of balances vs ledger']['expected'] == 8.0
+    assert totals['Bot liquidity vs ledger']['expected'] == INITIAL_LIQUIDITY - 8.0
+
+def test_incremental_run_skips_rows_without_user():
+    storage = MemoryStorage()
+    run_reconciliation(storage)
+    seed(storage)
+    state = storage.get_checkpoint('ledger_reconciliation')
+    storage.save_checkpoint('ledger_reconciliation', dict(state, watermark=state['started_at'].replace(year=2000)))
+    state = run_reconciliation(storage, incremental=True)
+    assert state['users'] == 2
+    assert state['mismatches'] == 0
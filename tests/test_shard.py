@@ -0,0 +1,53 @@
+import shard
+from shard import ShardWorker
+from cache import UserCache
+
+class QueuedDispatcher:
+    def __init__(self):
+        self.depth = 0
+
+    def queue_depth(self):
+        return self.depth
+
+def test_map_is_refused_until_the_queue_drains(monkeypatch):
+    monkeypatch.setattr(shard, 'DRAIN_TIMEOUT', 0.05)
+    dispatcher = QueuedDispatcher()
+    worker = ShardWorker('http://a', 'secret', dispatcher, UserCache())
+    assert worker.handle_map({'epoch': 1, 'workers': ['http://a']})[0] == 200
+
+    dispatcher.depth = 3
+    status, payload = worker.handle_map({'epoch': 2, 'workers': ['http://a', 'http://b']})
+    assert status == 503
+    assert payload['queue_depth'] == 3
+    assert worker.epoch == 1
+    assert worker.ring.workers == ['http://a']
+
+    dispatcher.depth = 0
+    assert worker.handle_map({'epoch': 2, 'workers': ['http://a', 'http://b']})[0] == 200
+    assert worker.epoch == 2
+
+class RecordingDispatcher(QueuedDispatcher):
+    def __init__(self):
+        super().__init__()
+        self.items = []
+
+    def submit(self, key, item):
+        self.items.append((key, item))
+        return True
+
+def test_task_for_an_owned_user_runs_on_their_lane():
+    dispatcher = RecordingDispatcher()
+    worker = ShardWorker('http://a', 'secret', dispatcher, UserCache())
+    worker.handle_map({'epoch': 1, 'workers': ['http://a', 'http://b']})
+    swept = []
+    def auto_repay_loans(user_id, amount):
+        swept.append((user_id, amount))
+    worker.register_task(auto_repay_loans)
+
+    assert worker.handle_task({'task': 'auto_repay_loans', 'user_id': 7, 'args': [25.0]})[0] == 200
+    key, item = dispatcher.items[0]
+    assert key == 7 and swept == []
+    item()
+    assert swept == [(7, 25.0)]
+    assert worker.handle_task({'task': 'other', 'user_id': 7, 'args': []})[0] == 404
+    assert [worker.owns(user_id) for user_id in range(50)].count(True) not in (0, 50)
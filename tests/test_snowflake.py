@@ -0,0 +1,34 @@
+import time
+from snowflake import SnowflakeGenerator, NodeLease, SEQUENCE_BITS, MAX_NODE_ID
+from storage import MemoryStorage
+
+def node_of(snowflake_id):
+    return (snowflake_id >> SEQUENCE_BITS) & MAX_NODE_ID
+
+def test_processes_lease_distinct_node_ids():
+    storage = MemoryStorage()
+    leases = [NodeLease(storage, SnowflakeGenerator()) for _ in range(3)]
+    for lease in leases:
+        lease.acquire()
+    assert sorted(lease.node_id for lease in leases) == [1, 2, 3]
+    assert all(node_of(lease.generator.next_id()) == lease.node_id for lease in leases)
+
+def test_expired_lease_is_taken_over():
+    storage = MemoryStorage()
+    first = NodeLease(storage, SnowflakeGenerator(), ttl=0)
+    first.acquire()
+    time.sleep(0.01)
+    second = NodeLease(storage, SnowflakeGenerator())
+    second.acquire()
+    assert second.node_id == first.node_id
+    assert not storage.renew_node_id(first.node_id, first.owner, 60)
+    assert storage.renew_node_id(second.node_id, second.owner, 60)
+
+def test_ids_keep_increasing_across_node_change():
+    generator = SnowflakeGenerator(MAX_NODE_ID)
+    before = [generator.next_id() for _ in range(1000)]
+    generator.set_node_id(1)
+    after = [generator.next_id() for _ in range(1000)]
+    ids = before + after
+    assert all(a < b for a, b in zip(ids, ids[1:]))
+    assert {node_of(snowflake_id) for snowflake_id in after} == {1}
@@ -0,0 +1,37 @@
+import csv
+import io
+from datetime import timedelta
+from statements import is_cache_valid, get_month_range, get_recent_months, render_statement
+from storage import MemoryStorage
+from flows import Awaitable, run_flow
+from helpers import get_current_time, build_transaction
+
+def test_statement_cached_mid_month_is_not_trusted_after_it_closes():
+    start, end = get_month_range('2024-10')
+    cached = {'file_id': 'f', 'last_transaction': 'a', 'created_at': start + timedelta(days=19)}
+    after = end + timedelta(days=3)
+    assert not is_cache_valid(cached, '2024-10', after, 'b')
+    # Nothing happened since it was generated
+    assert is_cache_valid(cached, '2024-10', after, 'a')
+
+def test_statement_cached_after_the_month_closed_is_kept():
+    _, end = get_month_range('2024-10')
+    cached = {'file_id': 'f', 'last_transaction': 'a', 'created_at': end + timedelta(hours=1)}
+    assert is_cache_valid(cached, '2024-10', end + timedelta(days=30), 'b')
+
+def test_current_month_follows_the_latest_transaction():
+    start, _ = get_month_range('2024-10')
+    cached = {'file_id': 'f', 'last_transaction': 'a', 'created_at': start + timedelta(days=1)}
+    now = start + timedelta(days=2)
+    assert is_cache_valid(cached, '2024-10', now, 'a')
+    assert not is_cache_valid(cached, '2024-10', now, 'b')
+
+def test_statement_reads_every_row_across_batches():
+    storage = MemoryStorage()
+    for amount in range(1, 6):
+        storage.change_user_balance(1, float(amount), transaction=build_transaction(1, 'daily_gift', float(amount)))
+    month = get_recent_months(get_current_time())[0]
+    statement = io.BytesIO()
+    assert run_flow(render_statement(Awaitable(storage), 1, month, statement, batch_size=2)) == 5
+    rows = list(csv.reader(io.StringIO(statement.getvalue().decode('utf-8-sig'))))
+    assert [row[3] for row in rows[2:-1]] == ['1.00', '2.00', '3.00', '4.00', '5.00']
@@ -0,0 +1,52 @@
+import threading
+from storage import MemoryStorage
+from helpers import get_current_time
+
+def request_transfer(storage, transfer_id, sender_id, recipient_id, amount):
+    storage.insert_transfer_request({
+        'transfer_id': transfer_id,
+        'sender_id': sender_id,
+        'recipient_id': recipient_id,
+        'amount': amount,
+        'fee': amount * 0.02,
+        'status': 'pending',
+        'timestamp': get_current_time()
+    })
+
+def balances(storage, *user_ids):
+    return [storage.get_user(user_id)['balance'] for user_id in user_ids]
+
+def test_insufficient_funds_leaves_both_balances_untouched():
+    storage = MemoryStorage()
+    storage.set_user_fields(1, {'balance': 10.0})
+    storage.set_user_fields(2, {'balance': 5.0})
+    request_transfer(storage, 'T1', 1, 2, 10.0)
+
+    status, _, _ = storage.execute_transfer('T1', 1)
+    assert status == 'insufficient_funds'
+    assert balances(storage, 1, 2) == [10.0, 5.0]
+    assert storage.get_transaction_history(1) == storage.get_transaction_history(2) == []
+    assert storage.get_bot_liquidity() == 100
+
+def test_double_confirm_executes_once():
+    storage = MemoryStorage()
+    storage.set_user_fields(1, {'balance': 100.0})
+    request_transfer(storage, 'T1', 1, 2, 10.0)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(storage.execute_transfer('T1', 1)[0])) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == ['completed'] + ['not_found'] * 7
+    assert balances(storage, 1, 2) == [100.0 - 10.2, 10.0]
+    assert len(storage.get_transaction_history(1)) == len(storage.get_transaction_history(2)) == 1
+
+def test_only_the_sender_can_confirm():
+    storage = MemoryStorage()
+    storage.set_user_fields(1, {'balance': 100.0})
+    request_transfer(storage, 'T1', 1, 2, 10.0)
+    assert storage.execute_transfer('T1', 2)[0] == 'not_found'
+    assert storage.execute_transfer('T1', 1)[0] == 'completed'
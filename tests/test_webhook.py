@@ -0,0 +1,41 @@
+import http.client
+import json
+import threading
+from webhook import WebhookServer, SECRET_HEADER
+
+class AcceptingDispatcher:
+    def __init__(self):
+        self.items = []
+
+    def submit(self, key, item):
+        self.items.append(item)
+        return True
+
+    def queue_depth(self):
+        return len(self.items)
+
+def post(server, headers):
+    connection = http.client.HTTPConnection('127.0.0.1', server.server.server_address[1], timeout=5)
+    body = json.dumps({'update_id': 1}).encode()
+    connection.putrequest('POST', '/webhook')
+    connection.putheader('Content-Length', str(len(body)))
+    for name, value in headers.items():
+        connection.putheader(name, value)
+    connection.endheaders(body)
+    status = connection.getresponse().status
+    connection.close()
+    return status
+
+def test_secret_token_is_checked():
+    dispatcher = AcceptingDispatcher()
+    server = WebhookServer(dispatcher, lambda update: 1, 'sécret', host='127.0.0.1', port=0, parse=lambda body: body)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        assert post(server, {}) == 401
+        assert post(server, {SECRET_HEADER: 'wrong'}) == 401
+        # Header values arrive as latin-1; non-ASCII must be refused, not crash
+        assert post(server, {SECRET_HEADER: 'ü'.encode('latin-1')}) == 401
+        assert post(server, {SECRET_HEADER: 'sécret'.encode()}) == 200
+        assert dispatcher.items == [{'update_id': 1}]
+    finally:
+        server.shutdown()
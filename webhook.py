@@ -0,0 +1,116 @@
+import hmac
+import json
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from telebot.types import Update
+
+# Header Telegram sends with the secret_token given to setWebhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+class WebhookServer:
+    # Embedded HTTP server receiving Telegram updates. POST <path> validates the
+    # secret token and hands the update to the dispatcher; when the dispatcher's
+    # bounded queue is full it answers 503 so Telegram retries later.
+    # GET /health reports the queue depth.
+    # parse turns the JSON body into the item submitted (an Update by default),
+    # accept(headers) can refuse an update with 409, and routes maps extra POST
+    # paths to handler(payload) -> (status, payload), authenticated with
+    # route_secret (the secret token by default).
+
+    def __init__(self, dispatcher, get_key, secret_token, host='0.0.0.0', port=8080, path='/webhook',
+                 parse=Update.de_json, accept=None, routes=None, route_secret=None):
+        self.dispatcher = dispatcher
+        self.get_key = get_key
+        self.secret_token = secret_token
+        self.path = path
+        self.parse = parse
+        self.accept = accept
+        self.routes = routes or {}
+        self.route_secret = route_secret or secret_token
+        self.received = 0
+        self.rejected = 0
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+
+    def make_handler(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if self.path != '/health':
+                    self.respond(404, {'ok': False})
+                    return
+                self.respond(200, {
+                    'ok': True,
+                    'queue_depth': webhook.dispatcher.queue_depth(),
+                    'received': webhook.received,
+                    'rejected': webhook.rejected
+                })
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                if self.path in webhook.routes:
+                    self.handle_route(body)
+                    return
+                if self.path != webhook.path:
+                    self.respond(404, {'ok': False})
+                    return
+                if not self.authorized(webhook.secret_token):
+                    self.respond(401, {'ok': False})
+                    return
+                if webhook.accept and not webhook.accept(self.headers):
+                    self.respond(409, {'ok': False})
+                    return
+                try:
+                    update = webhook.parse(json.loads(body))
+                except Exception as e:
+                    print(f"Invalid webhook update: {e}")
+                    self.respond(400, {'ok': False})
+                    return
+                if not webhook.dispatcher.submit(webhook.get_key(update), update):
+                    webhook.rejected += 1
+                    self.respond(503, {'ok': False})
+                    return
+                webhook.received += 1
+                self.respond(200, {'ok': True})
+
+            def authorized(self, secret):
+                token = self.headers.get(SECRET_HEADER)
+                if not secret or token is None:
+                    return False
+                # As bytes: compare_digest refuses str with non-ASCII characters.
+                # http.server decodes header values as latin-1, which gives back the raw bytes
+                return hmac.compare_digest(token.encode('latin-1'), secret.encode())
+
+            def handle_route(self, body):
+                if not self.authorized(webhook.route_secret):
+                    self.respond(401, {'ok': False})
+                    return
+                try:
+                    status, payload = webhook.routes[self.path](json.loads(body or b'{}'))
+                except Exception as e:
+                    print(f"Error handling {self.path}: {e}")
+                    status, payload = 500, {'ok': False}
+                self.respond(status, payload)
+
+            def respond(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()